@@ -0,0 +1,167 @@
+"""
+Local HTTP server imitating the parts of Reddit API used by Reddit Archiver (OAuth token, submission
+with its comments, /api/morechildren and "continue this thread"), serving a submission from fixtures.
+
+Like Reddit, listings only hold a limited number of comments and a limited depth, the rest being
+replaced by "load more comments" and "continue this thread" stubs. Every response carries rate-limit
+headers, and can be delayed to simulate the latency of the real API.
+"""
+# stdlib
+import collections, json, threading, time, urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeReddit(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, submission, comments, latency=0.05, listing_limit=200, max_depth=10, rate_limit=100000, rate_limit_reset=600, port=0):
+        super().__init__(('127.0.0.1', port), FakeRedditHandler)
+        self.submission = submission
+        self.comments = {comment['name']: comment for comment in comments}
+        self.children = collections.defaultdict(list)
+        for comment in comments:
+            self.children[comment['parent_id']].append(comment['name'])
+        self.latency = latency
+        self.listing_limit = listing_limit
+        self.max_depth = max_depth
+        self.rate_limit = rate_limit
+        self.rate_limit_reset = rate_limit_reset
+        self.nb_requests = collections.Counter()
+        self._lock = threading.Lock()
+
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+    def start(self):
+        """
+        Serves requests in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+    def count(self, endpoint):
+        with self._lock:
+            self.nb_requests[endpoint] += 1
+            return sum(self.nb_requests.values())
+
+
+    def subtree_size(self, name):
+        size = 0
+        queue = collections.deque([name])
+        while queue:
+            size += 1
+            queue.extend(self.children[queue.popleft()])
+        return size
+
+
+    def thing(self, name, replies=None):
+        data = dict(self.comments[name])
+        data['replies'] = '' if not replies else {'kind': 'Listing', 'data': {'children': replies}}
+        return {'kind': 't1', 'data': data}
+
+
+    def continue_stub(self, parent):
+        return {'kind': 'more', 'data': {'id': '_', 'name': 't1__', 'parent_id': parent, 'count': 0, 'depth': 0, 'children': []}}
+
+
+    def more_stub(self, parent, names):
+        return {'kind': 'more', 'data': {'id': names[0][3:], 'name': names[0], 'parent_id': parent, 'count': sum(self.subtree_size(name) for name in names), 'depth': 0, 'children': [name[3:] for name in names]}}
+
+
+    def listing(self, root):
+        """
+        Nested replies of root, limited in number and depth
+        """
+        budget = self.listing_limit
+
+        def replies(parent, depth):
+            nonlocal budget
+            things = []
+            children = self.children[parent]
+            for i, name in enumerate(children):
+                if budget <= 0:
+                    things.append(self.more_stub(parent, children[i:]))
+                    break
+                budget -= 1
+                if depth == self.max_depth and self.children[name]:
+                    things.append(self.thing(name, [self.continue_stub(name)]))
+                else:
+                    things.append(self.thing(name, replies(name, depth+1)))
+            return things
+
+        return replies(root, 1)
+
+
+    def morechildren(self, ids):
+        """
+        Flat list of the requested comments, each followed by its replies (limited in depth)
+        """
+        things = []
+        for short_id in ids:
+            stack = [('t1_'+short_id, 1)]
+            while stack:
+                name, depth = stack.pop()
+                if name not in self.comments:
+                    continue
+                things.append(self.thing(name))
+                if depth == self.max_depth and self.children[name]:
+                    things.append(self.continue_stub(name))
+                else:
+                    stack.extend((child, depth+1) for child in reversed(self.children[name]))
+        return {'json': {'errors': [], 'data': {'things': things}}}
+
+
+class FakeRedditHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        self.handle_request()
+
+
+    def do_POST(self):
+        self.handle_request()
+
+
+    def handle_request(self):
+        server = self.server
+        url = urllib.parse.urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        length = int(self.headers.get('Content-Length', 0))
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode()) if length else {}
+
+        if parts[-3:] == ['api', 'v1', 'access_token']:
+            return self.respond({'access_token': 'fake-token', 'token_type': 'bearer', 'expires_in': 3600, 'scope': 'read'}, 'access_token')
+
+        time.sleep(server.latency)
+        if parts[:2] == ['api', 'morechildren']:
+            return self.respond(server.morechildren(form['children'][0].split(',')), 'morechildren')
+        elif parts[0] == 'comments' and len(parts) == 4:
+            parent = 't1_'+parts[3]
+            listing = [server.thing(parent, server.listing(parent))]
+            return self.respond([{'kind': 'Listing', 'data': {'children': [{'kind': 't3', 'data': server.submission}]}}, {'kind': 'Listing', 'data': {'children': listing}}], 'continue')
+        elif parts[0] == 'comments':
+            listing = server.listing(server.submission['name'])
+            return self.respond([{'kind': 'Listing', 'data': {'children': [{'kind': 't3', 'data': server.submission}]}}, {'kind': 'Listing', 'data': {'children': listing}}], 'submission')
+
+        self.send_response(404)
+        self.end_headers()
+
+
+    def respond(self, payload, endpoint):
+        used = self.server.count(endpoint)
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-ratelimit-used', str(used))
+        self.send_header('x-ratelimit-remaining', str(max(self.server.rate_limit-used, 0)))
+        self.send_header('x-ratelimit-reset', str(self.server.rate_limit_reset))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,131 @@
+"""
+Compares the classic HTML archive (downloader.generate_html) with the lazy-loading one (downloader.generate_lazy_html)
+on a large synthetic submission: time to generate, size, and what the browser has to go through before it can show the first comments.
+
+Without a browser, "before first paint" is given as the number of bytes to parse and of elements to lay out before the first
+comments are shown (the whole document for the classic format, the beginning of the document up to the first chunk for the lazy one).
+With --chrome, the first contentful paint is also measured by a headless Chrome (or Chromium).
+
+Run from the repository root:
+    python dev/benchmarks/first_paint.py [--comments N] [--shape mixed|wide|deep] [--chrome PATH] [--fixture recorded.json]
+"""
+# stdlib
+import argparse, json, os, re, shutil, subprocess, sys, tempfile, time, types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', '..', 'src')
+sys.path.insert(0, SRC)
+
+import fixtures
+
+# Reports the first contentful paint in the title of the page, for the headless browser to dump it
+PAINT_PROBE = '<script>new PerformanceObserver(function(l){l.getEntries().forEach(function(e){if(e.name=="first-contentful-paint")document.title="FCP "+e.startTime})}).observe({type:"paint",buffered:true})</script>'
+
+
+def prepare_workdir():
+    """
+    The app reads its configuration and writes its logs in the current directory: giving it a temporary one
+    """
+    workdir = tempfile.mkdtemp(prefix='redditarchiver-bench-')
+    shutil.copy(os.path.join(SRC, 'config.yml.example'), os.path.join(workdir, 'config.yml'))
+    for directory in ('logs', 'output', 'data'):
+        os.mkdir(os.path.join(workdir, directory))
+    os.chdir(workdir)
+    return workdir
+
+
+def build(submission_data, comments):
+    """
+    Builds what downloader.download_submission returns, from a submission in the format of fixtures
+    """
+    import downloader
+    from tree import CommentTree
+
+    submission = types.SimpleNamespace(**submission_data)
+    submission.subreddit = types.SimpleNamespace(display_name=submission_data['subreddit'])
+    submission.author = types.SimpleNamespace(name=submission_data['author'])
+
+    comments_index = CommentTree(submission_data['name'])
+    comments_forest = [None]
+    for comment in comments:
+        comments_index.add(comment['name'], comment['parent_id'])
+        comments_forest.append(downloader.record_from_json(comment))
+    return submission, comments_index, comments_forest
+
+
+def generate(generator, submission, comments_index, comments_forest, path):
+    start = time.perf_counter()
+    with open(path, 'w', encoding='utf-8') as f:
+        for fragment in generator(submission, submission.id, 'now', None, comments_index, comments_forest):
+            f.write(fragment)
+    return time.perf_counter()-start
+
+
+def opening_tags(html):
+    return html.count('<')-html.count('</')
+
+
+def before_first_paint(path, lazy):
+    """
+    Returns the number of bytes and of elements the browser goes through before the first comments can be shown
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        document = f.read()
+    if lazy:
+        # The first chunk is rendered by the script that follows it: its comments are made of the same elements as in the classic format
+        # (div, header and 6 links, then the body)
+        end = document.index('renderChunk();</script>')+len('renderChunk();</script>')
+        chunk = re.search(r'<script type="application/json" id="c0">(.*?)</script>', document, re.S)
+        records = json.loads(chunk.group(1)) if chunk else []
+        elements = opening_tags(re.sub(r'<script.*?</script>', '', document[:end], flags=re.S))+sum(8+opening_tags(record[8]) for record in records)
+    else:
+        end = len(document)
+        elements = opening_tags(re.sub(r'<script.*?</script>', '', document, flags=re.S))
+    return len(document[:end].encode('utf-8')), elements
+
+
+def first_contentful_paint(chrome, path):
+    """
+    Opens the archive in a headless browser, and returns its first contentful paint (in milliseconds)
+    """
+    probed = path+'.probe.html'
+    with open(path, 'r', encoding='utf-8') as f, open(probed, 'w', encoding='utf-8') as g:
+        document = f.read()
+        g.write(document.replace('<head>', '<head>'+PAINT_PROBE, 1))
+    output = subprocess.run([chrome, '--headless=new', '--disable-gpu', '--no-sandbox', '--dump-dom', 'file://'+probed], capture_output=True, text=True, timeout=600).stdout
+    match = re.search(r'<title>FCP ([0-9.]+)</title>', output)
+    return float(match.group(1)) if match else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--shape', choices=fixtures.SHAPES, default='mixed')
+    parser.add_argument('--chrome', help='path to a Chrome or Chromium executable, to measure the first contentful paint')
+    parser.add_argument('--fixture', help='recorded submission to use instead of a synthetic one (see fixtures.load)')
+    args = parser.parse_args()
+
+    if args.fixture:
+        submission_data, comments = fixtures.load(os.path.abspath(args.fixture))
+    else:
+        submission_data, comments = fixtures.synthetic_thread(args.comments, shape=args.shape)
+
+    workdir = prepare_workdir()
+    try:
+        import downloader
+        downloader.render_cache = None
+        submission, comments_index, comments_forest = build(submission_data, comments)
+        print(f'{len(comments)} comments ({args.shape if not args.fixture else args.fixture})')
+
+        for name, generator, lazy in (('classic', downloader.generate_html, False), ('lazy', downloader.generate_lazy_html, True)):
+            path = os.path.join(workdir, 'output', f'{name}.html')
+            seconds = generate(generator, submission, comments_index, comments_forest, path)
+            nb_bytes, elements = before_first_paint(path, lazy)
+            line = f'{name:8} generated in {seconds:6.2f} s, {os.path.getsize(path)/1e6:7.1f} MB, before first paint: {nb_bytes/1e6:7.2f} MB to parse, {elements:8} elements'
+            if args.chrome:
+                fcp = first_contentful_paint(args.chrome, path)
+                line += ', first contentful paint: '+('unknown' if fcp is None else f'{fcp:.0f} ms')
+            print(line)
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir)
@@ -0,0 +1,52 @@
+"""
+Synthetic submissions used by the benchmarks, in the format sent by Reddit API.
+"""
+# stdlib
+import json, random
+
+
+SHAPES = ('mixed', 'wide', 'deep')
+
+PLAIN_BODIES = ('[deleted]', '[removed]', 'lol', 'This.', 'Thanks for sharing', 'I agree with you on that one', 'Source?')
+MARKDOWN_BODIES = ('This is *really* **important**:\n\n1. first\n2. second', '> quoted text\n\nMy answer, with a [link](https://example.com)', 'Some `code` and ~~strikethrough~~\n\n    indented code block', '# Header\n\n* item\n* item\n\n---\n\nFooter with &amp; and <tags>')
+
+
+def synthetic_thread(nb_comments, shape='mixed', markdown=0.3, seed=0, distinct=False):
+    """
+    Returns the submission and the list of its comments (as the "data" part of Reddit API objects), parents always coming before their children.
+    shape is "wide" (mostly top-level comments), "deep" (a single chain of replies) or "mixed" (a bit of both, like most real threads).
+    markdown is the share of comments with markdown formatting.
+    If distinct is True, all markdown bodies are different (as in real threads), so that none can reuse the rendering of an identical one.
+    """
+    rng = random.Random(seed)
+    authors = [f'user{i}' for i in range(max(nb_comments//20, 10))]
+    submission = {'id': 'bench', 'name': 't3_bench', 'title': f'Benchmark submission ({shape}, {nb_comments} comments)', 'subreddit': 'benchmark', 'subreddit_name_prefixed': 'r/benchmark', 'permalink': '/r/benchmark/comments/bench/benchmark_submission/', 'num_comments': nb_comments, 'score': 1234, 'upvote_ratio': 0.95, 'link_flair_text': None, 'stickied': False, 'spoiler': False, 'over_18': False, 'is_original_content': False, 'locked': False, 'author': 'op', 'created_utc': 1600000000.0, 'selftext': 'The *submission* itself', 'is_self': True}
+
+    comments = []
+    for i in range(nb_comments):
+        if shape == 'deep':
+            parent = comments[-1]['name'] if comments else 't3_bench'
+        elif shape == 'wide':
+            parent = 't3_bench' if i == 0 or rng.random() < 0.9 else comments[rng.randrange(i)]['name']
+        else:
+            parent = 't3_bench' if i == 0 or rng.random() < 0.2 else comments[rng.randrange(max(0, i-50), i)]['name']
+
+        if rng.random() < markdown:
+            body = rng.choice(MARKDOWN_BODIES)
+            if distinct:
+                body += f'\n\nEdit {i}: *thanks* for the [replies](https://example.com/{i})'
+        else:
+            body = rng.choice(PLAIN_BODIES)
+
+        comments.append({'id': f'c{i:x}', 'name': f't1_c{i:x}', 'parent_id': parent, 'link_id': 't3_bench', 'author': '[deleted]' if body == '[deleted]' else rng.choice(authors), 'body': body, 'distinguished': 'moderator' if rng.random() < 0.01 else None, 'edited': 1600000500.0 if rng.random() < 0.05 else False, 'permalink': f'/r/benchmark/comments/bench/benchmark_submission/c{i:x}/', 'is_submitter': rng.random() < 0.02, 'score': rng.randint(-20, 2000), 'created_utc': 1600000000.0+i*7, 'replies': ''})
+
+    return submission, comments
+
+
+def load(path):
+    """
+    Loads a submission recorded as JSON ({"submission": ..., "comments": [...]}, same format as synthetic_thread)
+    """
+    with open(path, 'r') as f:
+        recorded = json.load(f)
+    return recorded['submission'], recorded['comments']
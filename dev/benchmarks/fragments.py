@@ -0,0 +1,182 @@
+"""
+Measures how fast downloader.generate_html builds the HTML fragment of each comment (comments per second), compared with
+the per-comment loop it had before the static parts were built once and the dates cached (kept below as generate_html_before).
+
+Bodies are plain text without cache, so that their rendering (see pipeline.py, render phase) takes as little of the time as possible.
+Both versions must give the same document, which is checked first.
+
+Run from the repository root:
+    python dev/benchmarks/fragments.py [--comments N] [--shape mixed|wide|deep] [--repeat N]
+"""
+# stdlib
+import argparse, datetime, os, shutil, sys, tempfile, time, types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', '..', 'src')
+sys.path.insert(0, SRC)
+
+import fixtures
+
+
+def prepare_workdir():
+    """
+    The app reads its configuration and writes its logs in the current directory: giving it a temporary one
+    """
+    workdir = tempfile.mkdtemp(prefix='redditarchiver-bench-')
+    shutil.copy(os.path.join(SRC, 'config.yml.example'), os.path.join(workdir, 'config.yml'))
+    for directory in ('logs', 'output', 'data'):
+        os.mkdir(os.path.join(workdir, directory))
+    os.chdir(workdir)
+    return workdir
+
+
+def build(submission_data, comments):
+    """
+    Builds what downloader.download_submission returns, from a submission in the format of fixtures
+    """
+    import downloader
+    from tree import CommentTree
+
+    submission = types.SimpleNamespace(**submission_data)
+    submission.subreddit = types.SimpleNamespace(display_name=submission_data['subreddit'])
+    submission.author = types.SimpleNamespace(name=submission_data['author'])
+
+    comments_index = CommentTree(submission_data['name'])
+    comments_forest = [None]
+    for comment in comments:
+        comments_index.add(comment['name'], comment['parent_id'])
+        comments_forest.append(downloader.record_from_json(comment))
+    return submission, comments_index, comments_forest
+
+
+def generate_html_before(submission, submission_id, now_str, sort, comments_index, comments_forest, stats=None, progress=None):
+    """
+    downloader.generate_html as it was before: classes, dates and lookups computed again for each comment
+    """
+    from downloader import submission_header, render_bodies, render_cache, JobProgress, NONE, PROGRESS_INTERVAL, HTML_JS
+    from config import config
+
+    html_head, html_submission, html_firstpost = submission_header(submission, submission_id, now_str, sort)
+    if progress is None:
+        progress = JobProgress()
+
+    yield html_head
+    yield html_submission
+    yield html_firstpost
+
+    rendered_bodies = render_bodies((comments_forest[node].body for node in comments_index.walk()), processes=config['app'].get('render-processes', 0), cache=render_cache, stats=stats)
+
+    previous_comment_level = 1
+    comment_counter = 1
+    for node in comments_index.walk():
+        current_comment_level = comments_index.depth[node]
+        current_comment_id = comments_index.names[node]
+        comment = comments_forest[node]
+
+        if current_comment_level <= previous_comment_level:
+            yield '</div>'*(previous_comment_level-current_comment_level+1)
+
+        classes = ''
+        if current_comment_level == 1:
+            classes += 'f '
+        if comment.distinguished == 'admin':
+            classes += 'a '
+        elif comment.distinguished == 'moderator':
+            classes += 'm '
+        elif comment.is_submitter:
+            classes += 'p '
+        elif current_comment_level % 2 == 0:
+            classes += 'e '
+        else:
+            classes += 'o '
+        classes += 'l'+str(current_comment_level)[-1]
+        html_comment = f'<div class="{classes}" id="{current_comment_id}">'
+
+        previous_sibling_node = comments_index.previous_sibling[node]
+        if previous_sibling_node == NONE:
+            previous_sibling = ''
+            previous_sibling_d = ' D'
+        else:
+            previous_sibling = comments_index.names[previous_sibling_node]
+            previous_sibling_d = ''
+
+        next_sibling_node = comments_index.next_sibling[node]
+        if next_sibling_node == NONE:
+            next_sibling = ''
+            next_sibling_d = ' D'
+        else:
+            next_sibling = comments_index.names[next_sibling_node]
+            next_sibling_d = ''
+
+        parent = comments_index.names[comments_index.parent[node]]
+
+        time_comment = datetime.datetime.fromtimestamp(comment.created_utc)
+        time_comment_str = time_comment.strftime(config["defaults"]["dateformat"])
+
+        html_comment += f"""<header><a href="{config['reddit']['root']}/u/{comment.author}">{comment.author}</a>, on <a href="{config['reddit']['root']}{comment.permalink}">{time_comment_str}</a> ({comment.score}{'' if comment.edited is False else ', edited'}) <a href="#{parent}" class="n P">▣</a> <a href="#{previous_sibling}" class="n A{previous_sibling_d}">🠉</a> <a href="#{next_sibling}" class="n B{next_sibling_d}">🠋</a> <a href="#{current_comment_id}" class="n S">◯</a></header>{next(rendered_bodies)}"""
+        yield html_comment
+
+        previous_comment_level = current_comment_level
+        if comment_counter % PROGRESS_INTERVAL == 0:
+            progress.rendered(comment_counter, len(comments_index)-1)
+        comment_counter += 1
+
+    progress.rendered(comment_counter-1, len(comments_index)-1)
+    yield HTML_JS
+
+
+def generate(generator, submission, comments_index, comments_forest):
+    """
+    Returns the time it takes to go through the whole document, and its length
+    """
+    start = time.perf_counter()
+    length = 0
+    for fragment in generator(submission, submission.id, 'now', None, comments_index, comments_forest):
+        length += len(fragment)
+    return time.perf_counter()-start, length
+
+
+def format_dates(format_date, timestamps):
+    start = time.perf_counter()
+    for timestamp in timestamps:
+        format_date(timestamp)
+    return time.perf_counter()-start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--shape', choices=fixtures.SHAPES, default='mixed')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each version: the best one is kept')
+    args = parser.parse_args()
+
+    submission_data, comments = fixtures.synthetic_thread(args.comments, shape=args.shape, markdown=0)
+
+    workdir = prepare_workdir()
+    try:
+        import downloader
+        from config import config
+        from formatting import DateFormatter
+
+        downloader.render_cache = None
+        config['app']['render-processes'] = 0
+        submission, comments_index, comments_forest = build(submission_data, comments)
+        print(f'{len(comments)} comments ({args.shape}), best of {args.repeat}')
+
+        document = lambda generator: ''.join(generator(submission, submission.id, 'now', None, comments_index, comments_forest))
+        if document(generate_html_before) != document(downloader.generate_html):
+            print('The two versions do not give the same document')
+            sys.exit(1)
+
+        for name, generator in (('before', generate_html_before), ('after', downloader.generate_html)):
+            seconds = min(generate(generator, submission, comments_index, comments_forest)[0] for i in range(args.repeat))
+            print(f'generate_html {name:7} {seconds:7.3f} s  {len(comments)/seconds:10.0f} comments/s')
+
+        dateformat = config["defaults"]["dateformat"]
+        timestamps = [comment['created_utc'] for comment in comments]
+        for name, format_date in (('strftime', lambda timestamp: datetime.datetime.fromtimestamp(timestamp).strftime(dateformat)), ('cached', None)):
+            seconds = min(format_dates(format_date or DateFormatter(dateformat), timestamps) for i in range(args.repeat))
+            print(f'dates {name:15} {seconds:7.3f} s  {len(timestamps)/seconds:10.0f} dates/s')
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir)
@@ -0,0 +1,74 @@
+"""
+Checks that importing the app (what every gunicorn worker does when it boots) stays fast: measures it with python -X importtime,
+and fails if PRAW, markdown2 or the scheduler are imported with it, or if the app takes more than its budget on top of Flask.
+
+Flask itself is not counted in the budget, as the app cannot start without it (and its import time depends a lot on the machine).
+
+Run from the repository root:
+    python dev/benchmarks/import_time.py [--runs N] [--budget MS]
+"""
+# stdlib
+import argparse, os, re, shutil, statistics, subprocess, sys, tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.abspath(os.path.join(HERE, '..', '..', 'src'))
+
+# Modules only needed once a job runs, a user authenticates, or in the process running the scheduled tasks
+FORBIDDEN = ('praw', 'prawcore', 'markdown2', 'requests', 'apscheduler', 'flask_apscheduler')
+
+# Time (in milliseconds) the app may take to import, Flask excluded
+BUDGET = 120
+
+
+def prepare_workdir():
+    """
+    The app reads its configuration in the current directory: giving it a temporary one
+    """
+    workdir = tempfile.mkdtemp(prefix='redditarchiver-bench-')
+    shutil.copy(os.path.join(SRC, 'config.yml.example'), os.path.join(workdir, 'config.yml'))
+    for directory in ('logs', 'output', 'data'):
+        os.mkdir(os.path.join(workdir, directory))
+    return workdir
+
+
+def measure(workdir):
+    """
+    Imports the app in a new interpreter, and returns the cumulative import time (in microseconds) of each module
+    """
+    env = dict(os.environ, PYTHONPATH=SRC)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=workdir, env=env, capture_output=True, text=True, check=True).stderr
+    times = {}
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)', line)
+        if match:
+            times[match.group(2)] = int(match.group(1))
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=BUDGET, help='time (in ms) the app may take to import, Flask excluded')
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    try:
+        runs = [measure(workdir) for i in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir)
+
+    total = statistics.median(run['app'] for run in runs)/1000
+    flask = statistics.median(run.get('flask', 0) for run in runs)/1000
+    print(f'import app: {total:.1f} ms (of which flask: {flask:.1f} ms, app: {total-flask:.1f} ms, budget: {args.budget:.0f} ms)')
+
+    failed = False
+    imported = [module for module in FORBIDDEN if module in runs[0]]
+    if imported:
+        print(f'Imported with the app, but should not be: {", ".join(imported)}')
+        failed = True
+    if total-flask > args.budget:
+        print('Over budget. Slowest imports:')
+        for module, microseconds in sorted(runs[0].items(), key=lambda item: -item[1])[:15]:
+            print(f'    {microseconds/1000:8.1f} ms  {module}')
+        failed = True
+    sys.exit(1 if failed else 0)
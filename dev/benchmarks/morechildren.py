@@ -0,0 +1,68 @@
+"""
+Compares the time taken to expand all the "load more comments" stubs of a submission, between PRAW
+(replace_more, one request after the other) and fetcher.MoreChildrenFetcher (concurrent requests),
+against a local fake Reddit API (see fakereddit.py).
+
+Run from the repository root:
+    python dev/benchmarks/morechildren.py [--comments N] [--shape mixed|wide|deep] [--latency SECONDS] [--workers N] [--fixture recorded.json]
+"""
+# stdlib
+import argparse, os, shutil, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', '..', 'src')
+sys.path.insert(0, SRC)
+
+import fixtures, fakereddit
+
+
+def prepare_workdir():
+    """
+    The app reads its configuration and writes its logs in the current directory: giving it a temporary one
+    """
+    workdir = tempfile.mkdtemp(prefix='redditarchiver-bench-')
+    shutil.copy(os.path.join(SRC, 'config.yml.example'), os.path.join(workdir, 'config.yml'))
+    for directory in ('logs', 'output', 'data'):
+        os.mkdir(os.path.join(workdir, directory))
+    os.chdir(workdir)
+    return workdir
+
+
+def run(server, workers):
+    import praw
+    import downloader
+    from config import config
+
+    config['app']['fetch-workers'] = workers
+    reddit = praw.Reddit(client_id='bench', client_secret='bench', refresh_token='bench', user_agent='benchmark', oauth_url=server.url, reddit_url=server.url, check_for_updates=False)
+    submission = reddit.submission(id='bench')
+    submission.num_comments
+
+    server.nb_requests.clear()
+    start = time.perf_counter()
+    submission, comments_index, comments_forest = downloader.download_submission(submission, 'bench')
+    elapsed = time.perf_counter()-start
+    return elapsed, len(comments_index)-1, sum(server.nb_requests.values())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--shape', choices=fixtures.SHAPES, default='mixed')
+    parser.add_argument('--latency', type=float, default=0.05, help='delay of every response of the fake API, in seconds')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--fixture', help='recorded submission to use instead of a synthetic one')
+    args = parser.parse_args()
+
+    submission, comments = fixtures.load(args.fixture) if args.fixture else fixtures.synthetic_thread(args.comments, args.shape)
+    workdir = prepare_workdir()
+    server = fakereddit.FakeReddit(submission, comments, latency=args.latency).start()
+
+    try:
+        print(f'{len(comments)} comments ({args.shape}), {args.latency*1000:.0f} ms per request')
+        for label, workers in (('serial (PRAW replace_more)', 0), (f'parallel ({args.workers} workers)', args.workers)):
+            elapsed, nb_comments, nb_requests = run(server, workers)
+            print(f'{label:<30} {elapsed:8.2f} s  {nb_requests:6} requests  {nb_comments} comments')
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir)
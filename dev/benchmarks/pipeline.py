@@ -0,0 +1,231 @@
+"""
+Benchmarks the whole pipeline of a job (download, rendering of the bodies, generation of the HTML file) on synthetic submissions
+served by a local fake Reddit API (see fakereddit.py), and compares the results with a stored baseline.
+
+For each case and each phase, it measures the wall time, the peak memory (RSS) during the phase, and the size of what is written.
+Cases are run in processes of their own (the fake API in yet another one), so that they do not share their memory.
+
+    fetch       downloader.download_submission: PRAW requests, "load more comments" stubs, building of the tree
+    render      formatting.render_bodies over all the comment bodies (markdown), without cache
+    html        downloader.generate_html written to disk with downloader.write_file (rendering included)
+    lazy        same, with downloader.generate_lazy_html
+
+Run from the repository root:
+    python dev/benchmarks/pipeline.py [--quick] [--cases wide,deep,...] [--repeat N] [--save]
+
+Without --save, results are compared with the baseline (pipeline-baseline.json), and the script exits with an error if a phase
+got slower, bigger or used more memory than the tolerances below. The baseline only means something on the machine that
+recorded it: record one (--save) before working on a change, and compare after.
+"""
+# stdlib
+import argparse, json, multiprocessing, os, platform, resource, shutil, subprocess, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', '..', 'src')
+sys.path.insert(0, SRC)
+
+import fixtures, fakereddit
+
+BASELINE = os.path.join(HERE, 'pipeline-baseline.json')
+
+# Cases: number of comments, shape of the thread (see fixtures.synthetic_thread), share of comments with markdown
+CASES = {
+    'wide': (20000, 'wide', 0.3),
+    'deep': (1500, 'deep', 0.3),
+    'markdown': (10000, 'mixed', 1.0),
+    'large': (100000, 'mixed', 0.3),
+}
+PHASES = ('fetch', 'render', 'html', 'lazy')
+
+# A phase is a regression if it takes this much more (relative) than in the baseline
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.15
+SIZE_TOLERANCE = 0.01
+
+
+def prepare_workdir():
+    """
+    The app reads its configuration and writes its logs in the current directory: giving it a temporary one
+    """
+    workdir = tempfile.mkdtemp(prefix='redditarchiver-bench-')
+    shutil.copy(os.path.join(SRC, 'config.yml.example'), os.path.join(workdir, 'config.yml'))
+    for directory in ('logs', 'output', 'data'):
+        os.mkdir(os.path.join(workdir, directory))
+    os.chdir(workdir)
+    return workdir
+
+
+def serve(nb_comments, shape, markdown, pipe):
+    """
+    Runs the fake Reddit API (in a process of its own), and sends its URL through pipe.
+    Its rate limit resets all the time, so that PRAW never waits: fetch measures the work of the app, not the rate limit.
+    """
+    submission, comments = fixtures.synthetic_thread(nb_comments, shape=shape, markdown=markdown, distinct=True)
+    server = fakereddit.FakeReddit(submission, comments, latency=0, rate_limit_reset=0)
+    pipe.send(server.url)
+    server.serve_forever()
+
+
+def reset_peak_memory():
+    """
+    Resets the peak RSS of this process (Linux only: on other systems, the peak of the whole process is measured)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory():
+    """
+    Returns the peak RSS (in bytes) since the last reset_peak_memory
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+
+
+def measure(function):
+    """
+    Runs function, and returns its result along with the time it took and the peak memory during it
+    """
+    reset_peak_memory()
+    start = time.perf_counter()
+    result = function()
+    return result, {'seconds': time.perf_counter()-start, 'peak_rss': peak_memory()}
+
+
+def run_case(name, fetch_workers):
+    """
+    Runs all the phases of a case, in this process. Returns the measures by phase.
+    """
+    nb_comments, shape, markdown = CASES[name]
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    server = multiprocessing.Process(target=serve, args=(nb_comments, shape, markdown, sender), daemon=True)
+    server.start()
+    url = receiver.recv()
+
+    workdir = prepare_workdir()
+    try:
+        import praw
+        import downloader, formatting
+        from config import config
+
+        config['app']['fetch-workers'] = fetch_workers
+        config['app']['render-processes'] = 0
+        downloader.render_cache = None
+        results = {}
+
+        reddit = praw.Reddit(client_id='bench', client_secret='bench', refresh_token='bench', user_agent='benchmark', oauth_url=url, reddit_url=url, check_for_updates=False)
+        submission = reddit.submission(id='bench')
+        (submission, comments_index, comments_forest), results['fetch'] = measure(lambda: downloader.download_submission(submission, 'bench'))
+        results['fetch']['comments'] = len(comments_index)-1
+
+        bodies = [comments_forest[node].body for node in comments_index.walk()]
+        rendered, results['render'] = measure(lambda: sum(len(body.encode('utf-8')) for body in formatting.render_bodies(bodies)))
+        results['render']['output_bytes'] = rendered
+
+        output = os.path.join(workdir, 'output')
+        for phase, generator in (('html', downloader.generate_html), ('lazy', downloader.generate_lazy_html)):
+            filename, results[phase] = measure(lambda: downloader.write_file(generator(submission, 'bench', 'now', None, comments_index, comments_forest), output))
+            results[phase]['output_bytes'] = os.path.getsize(os.path.join(output, filename))
+            os.remove(os.path.join(output, filename))
+        return results
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir)
+        server.terminate()
+
+
+def run(cases, repeat, quick, fetch_workers):
+    """
+    Runs each case repeat times (each time in a new process), and keeps the best time and memory of each phase
+    """
+    results = {}
+    for name in cases:
+        runs = []
+        for i in range(repeat):
+            command = [sys.executable, __file__, '--run-case', name, '--fetch-workers', str(fetch_workers)]+(['--quick'] if quick else [])
+            runs.append(json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout))
+        results[name] = {phase: {key: min(run[phase][key] for run in runs) for key in runs[0][phase]} for phase in PHASES}
+        print_case(name, results[name])
+    return results
+
+
+def print_case(name, phases):
+    print(f"{name} ({phases['fetch']['comments']} comments)")
+    for phase in PHASES:
+        measures = phases[phase]
+        line = f"    {phase:8} {measures['seconds']:8.2f} s  {measures['peak_rss']/1e6:8.1f} MB peak"
+        if 'output_bytes' in measures:
+            line += f"  {measures['output_bytes']/1e6:8.1f} MB written"
+        print(line)
+
+
+def compare(results, baseline):
+    """
+    Returns the regressions of results, compared with baseline
+    """
+    regressions = []
+    for name, phases in results.items():
+        if name not in baseline['cases']:
+            continue
+        for phase, measures in phases.items():
+            reference = baseline['cases'][name].get(phase, {})
+            for key, tolerance in (('seconds', TIME_TOLERANCE), ('peak_rss', MEMORY_TOLERANCE), ('output_bytes', SIZE_TOLERANCE)):
+                if key in measures and reference.get(key) and measures[key] > reference[key]*(1+tolerance):
+                    regressions.append(f'{name}/{phase}: {key} {reference[key]:.6g} -> {measures[key]:.6g} (+{measures[key]/reference[key]-1:.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', default=','.join(CASES), help='comma-separated list of cases to run, among: '+', '.join(CASES))
+    parser.add_argument('--quick', action='store_true', help='ten times fewer comments (the deep case keeps its depth)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each case: the best one is kept')
+    parser.add_argument('--fetch-workers', type=int, default=0, help='see app.fetch-workers (0: PRAW replace_more)')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.quick:
+        CASES = {name: (nb_comments if shape == 'deep' else nb_comments//10, shape, markdown) for name, (nb_comments, shape, markdown) in CASES.items()}
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.fetch_workers)))
+        sys.exit(0)
+
+    cases = [name for name in args.cases.split(',') if name]
+    results = run(cases, args.repeat, args.quick, args.fetch_workers)
+    machine = {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count(), 'quick': args.quick, 'fetch_workers': args.fetch_workers}
+
+    if args.save:
+        with open(BASELINE, 'w') as f:
+            json.dump({'machine': machine, 'cases': results}, f, indent=2)
+            f.write('\n')
+        print(f'Baseline saved in {BASELINE}')
+        sys.exit(0)
+
+    if not os.path.isfile(BASELINE):
+        print('No baseline to compare with (see --save)')
+        sys.exit(0)
+    with open(BASELINE, 'r') as f:
+        baseline = json.load(f)
+    if {key: value for key, value in baseline['machine'].items() if key in ('quick', 'fetch_workers')} != {'quick': args.quick, 'fetch_workers': args.fetch_workers}:
+        print(f"The baseline was recorded with other options ({baseline['machine']}): not comparing")
+        sys.exit(0)
+    if baseline['machine'] != machine:
+        print(f"Warning: the baseline was recorded on another machine ({baseline['machine']['platform']}, Python {baseline['machine']['python']})")
+
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print('Regression: '+regression)
+    if not regressions:
+        print('No regression compared with the baseline')
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,71 @@
+"""
+Memory used per comment by the structures built in downloader.download_submission,
+before (one dict per comment + one anytree node per comment) and after (slotted records + array-backed tree).
+
+Run from the repository root:
+    python dev/benchmarks/records_memory.py [number of comments]
+
+The "before" figures need anytree to be installed (it is no longer a dependency of the app).
+"""
+# stdlib
+import os, random, sys, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+
+# Project modules
+from tree import CommentTree, CommentRecord
+
+
+def synthetic_thread(nb_comments, seed=0):
+    """
+    Returns a list of (fullname, parent fullname, attributes) tuples, parents always coming before their children
+    """
+    rng = random.Random(seed)
+    authors = [f'user{i}' for i in range(2000)]
+    comments = []
+    for i in range(nb_comments):
+        parent = 't3_root' if i == 0 or rng.random() < 0.2 else comments[rng.randrange(max(0, i-50), i)][0]
+        attributes = (authors[rng.randrange(len(authors))], f'Comment body number {i}', None, False, f'/r/test/comments/root/_/c{i}/', False, rng.randint(-10, 1000), 1600000000.0+i)
+        comments.append((f't1_c{i}', parent, attributes))
+    return comments
+
+
+def measure(build, comments):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    structures = build(comments)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del structures
+    return (after-before)/len(comments)
+
+
+def build_before(comments):
+    from anytree import Node
+    comments_index = {'t3_root': Node('t3_root')}
+    comments_forest = {}
+    for name, parent, (a, b, d, e, l, o, s, t) in comments:
+        comments_index[name] = Node(name, parent=comments_index[parent])
+        comments_forest[name] = {'a': a, 'b': b, 'd': d, 'e': e, 'l': l, 'o': o, 's': s, 't': t}
+    return comments_index, comments_forest
+
+
+def build_after(comments):
+    comments_index = CommentTree('t3_root')
+    comments_forest = [None]
+    for name, parent, attributes in comments:
+        comments_index.add(name, parent)
+        comments_forest.append(CommentRecord(*attributes))
+    return comments_index, comments_forest
+
+
+if __name__ == '__main__':
+    nb_comments = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    comments = synthetic_thread(nb_comments)
+    print(f'{nb_comments} comments (string values excluded, they are shared by both structures)')
+
+    try:
+        print(f'before (dicts + anytree): {measure(build_before, comments):8.1f} bytes per comment')
+    except ImportError:
+        print('before (dicts + anytree): skipped, anytree is not installed')
+    print(f'after (records + arrays): {measure(build_after, comments):8.1f} bytes per comment')
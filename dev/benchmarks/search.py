@@ -0,0 +1,134 @@
+"""
+Measures the full-text index of the archived comments (search.py): how fast comments are indexed (the first time, and again
+when the same submissions are downloaded again), and how long searches take as the index grows.
+
+Bodies are made of words drawn from a vocabulary with a Zipf distribution, like real text: some words are found in most comments,
+others in a handful. Each query is timed on its first page and on a page far down (page 40), sorted by relevance and by "recent".
+
+Run from the repository root:
+    python dev/benchmarks/search.py [--comments N] [--submission-size N] [--repeat N]
+"""
+# stdlib
+import argparse, os, random, shutil, statistics, sys, tempfile, time, types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, '..', '..', 'src')
+sys.path.insert(0, SRC)
+
+VOCABULARY_SIZE = 50000
+WORDS_PER_COMMENT = (5, 60)
+# Pages far down the results
+DEEP_PAGE = 40
+
+
+def prepare_workdir():
+    """
+    The app reads its configuration and writes its logs in the current directory: giving it a temporary one
+    """
+    workdir = tempfile.mkdtemp(prefix='redditarchiver-bench-')
+    shutil.copy(os.path.join(SRC, 'config.yml.example'), os.path.join(workdir, 'config.yml'))
+    for directory in ('logs', 'output', 'data'):
+        os.mkdir(os.path.join(workdir, directory))
+    os.chdir(workdir)
+    return workdir
+
+
+def vocabulary(rng):
+    """
+    Returns the words (the first ones being the most frequent), and the cumulative weights to draw them with
+    """
+    words = []
+    while len(words) < VOCABULARY_SIZE:
+        word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rng.randint(3, 10)))
+        words.append(word)
+    weights = [1/(rank+1) for rank in range(VOCABULARY_SIZE)]
+    cumulative = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return words, cumulative
+
+
+def build(number, size, rng, words, cumulative):
+    """
+    Builds a submission of size comments, as downloader.download_submission returns it
+    """
+    from tree import CommentTree, CommentRecord
+
+    submission = types.SimpleNamespace(id=f's{number}', title=f'Submission {number}', permalink=f'/r/benchmark/comments/s{number}/submission/', created_utc=1600000000.0, selftext='', author=types.SimpleNamespace(name='op'))
+    submission.subreddit = types.SimpleNamespace(display_name='benchmark')
+    comments_index = CommentTree(f't3_s{number}')
+    comments_forest = [None]
+    for i in range(size):
+        name = f't1_s{number}c{i:x}'
+        parent = f't3_s{number}' if i == 0 or rng.random() < 0.2 else comments_index.names[rng.randrange(max(1, i-50), i+1)]
+        comments_index.add(name, parent)
+        body = ' '.join(rng.choices(words, cum_weights=cumulative, k=rng.randint(*WORDS_PER_COMMENT)))
+        comments_forest.append(CommentRecord(f'user{rng.randrange(10000)}', body, None, False, f'/r/benchmark/comments/s{number}/submission/c{i:x}/', False, rng.randint(-20, 2000), 1600000000.0+i*7))
+    return submission, comments_index, comments_forest
+
+
+def timed(function, repeat):
+    """
+    Returns the median time (in milliseconds) of function, and its last result
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter()-start)*1000)
+    return statistics.median(times), result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comments', type=int, default=500000)
+    parser.add_argument('--submission-size', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each query: the median is kept')
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    try:
+        import search
+
+        rng = random.Random(0)
+        words, cumulative = vocabulary(rng)
+        nb_submissions = max(args.comments//args.submission_size, 1)
+
+        indexing = 0
+        for number in range(nb_submissions):
+            submission, comments_index, comments_forest = build(number, args.submission_size, rng, words, cumulative)
+            start = time.perf_counter()
+            search.index_comments(submission, submission.id, comments_index, comments_forest)
+            indexing += time.perf_counter()-start
+        total = nb_submissions*args.submission_size
+        print(f'{total} comments in {nb_submissions} submissions, index of {os.path.getsize(search.DATABASE)/1e6:.0f} MB')
+        print(f'indexing          {total/indexing:10.0f} comments/s')
+
+        # The last submission downloaded again: unchanged, then with new scores for a tenth of its comments
+        start = time.perf_counter()
+        written = search.index_comments(submission, submission.id, comments_index, comments_forest)
+        print(f'again, unchanged  {args.submission_size/(time.perf_counter()-start):10.0f} comments/s ({written} written)')
+        for node in range(1, len(comments_index), 10):
+            comments_forest[node].score += 1
+        start = time.perf_counter()
+        written = search.index_comments(submission, submission.id, comments_index, comments_forest)
+        print(f'again, 10% scores {args.submission_size/(time.perf_counter()-start):10.0f} comments/s ({written} written)')
+
+        # Words found in most comments, in some, and in a few
+        for label, word in (('common', words[0]), ('medium', words[200]), ('rare', words[20000]), ('two words', f'{words[3]} {words[500]}'), ('prefix', words[100][:3]+'*')):
+            line = f'{label:10} {word[:22]:22}'
+            for sort in ('relevance', 'recent'):
+                first, (results, following) = timed(lambda: search.search(word, sort=sort), args.repeat)
+                # Going down the pages as a client would, then timing the last one
+                page, number = {}, 1
+                while number < DEEP_PAGE and following is not None:
+                    page, number = following, number+1
+                    results, following = search.search(word, sort=sort, **page)
+                deep, _ = timed(lambda: search.search(word, sort=sort, **page), args.repeat)
+                line += f'  {sort}: {first:7.1f} ms, page {number}: {deep:7.1f} ms'
+            print(line)
+    finally:
+        os.chdir(HERE)
+        shutil.rmtree(workdir)
@@ -1,18 +1,44 @@
 # Project modules
-import auth, controllers, models
-from config import config
+import auth, controllers, jobqueue, metrics, models
+from config import config, setup_logging
 
 # 3rd party modules
-import flask, flask_apscheduler
+import flask
 
 # stdlib
-import logging, os, datetime
+import logging, os, threading, time, fcntl
 
-app = flask.Flask(__name__)
+# Routes of the app, registered on it by create_app
+routes = flask.Blueprint('routes', __name__)
 log = logging.getLogger('redditarchiver_main')
 
+# Only one process of the deployment (the one holding this lock) runs the scheduled tasks
+SCHEDULER_LOCK = "data/scheduler.lock"
+# How often (in seconds) the other processes try to take the lock, to take over if the process holding it stops
+SCHEDULER_LOCK_RETRY = 60
 
-@app.before_request
+_scheduler = None
+
+
+def create_app(background=True):
+    """
+    Creates the app. Unless background is False (for tests and tools), the jobs queue, the sharing of metrics
+    and the scheduled tasks are started along with it.
+    """
+    setup_logging()
+    app = flask.Flask(__name__)
+    app.register_blueprint(routes)
+
+    if background:
+        # With standalone workers, jobs are run by worker.py processes, not by the web app
+        jobqueue.start(0 if config['app'].get('standalone-workers', False) else config['app'].get('job-workers', 2))
+        # Metrics of this process are shared with the other gunicorn workers (see metrics.gather)
+        metrics.start()
+        start_scheduler(app)
+    return app
+
+
+@routes.before_app_request
 def before_request_callback():
     """
     Initialises cookie and Reddit token
@@ -34,7 +60,7 @@ def before_request_callback():
     flask.g.data = {}
 
     # Manage cookies
-    if flask.request.endpoint not in ('token', 'favicon', 'status', 'download'):
+    if flask.request.endpoint not in ('routes.token', 'routes.favicon', 'routes.status', 'routes.status_stream', 'routes.download', 'routes.metrics_endpoint'):
         auth.manage_cookie()
         flask.g.token = models.read_token(flask.g.db, flask.g.cookie)
 
@@ -44,7 +70,7 @@ def before_request_callback():
 # Routes                     #
 # -------------------------- #
 
-@app.route("/")
+@routes.route("/")
 def main():
     """
     Landing page, where the form to download is.
@@ -59,7 +85,7 @@ def main():
     return flask.g.resp
 
 
-@app.route("/favicon.ico")
+@routes.route("/favicon.ico")
 def favicon():
     """
     Self-explanatory, I guess?
@@ -67,7 +93,7 @@ def favicon():
     return flask.send_from_directory(os.path.join(os.getcwd(), 'static', 'images'), 'favicon.ico')
 
 
-@app.route("/token")
+@routes.route("/token")
 def token():
     """
     Interception of token given by Reddit
@@ -86,7 +112,7 @@ def token():
     return flask.redirect("/", code=303)
 
 
-@app.route("/request", methods=['POST'])
+@routes.route("/request", methods=['POST'])
 def request():
     """
     Requests a job
@@ -102,7 +128,37 @@ def request():
     return flask.g.resp
 
 
-@app.route("/status/<job_id>")
+@routes.route("/batch", methods=['POST'])
+def batch():
+    """
+    Requests the download of several submissions at once
+    """
+    flask.g.resp.status, flask.g.resp.data = controllers.request_batch()
+    flask.g.resp.mimetype = 'application/json'
+    return flask.g.resp
+
+
+@routes.route("/batch/<batch_id>")
+def batch_status(batch_id):
+    """
+    Requests the status of the jobs of a batch
+    """
+    flask.g.resp.status, flask.g.resp.data = controllers.batch_status(batch_id)
+    flask.g.resp.mimetype = 'application/json'
+    return flask.g.resp
+
+
+@routes.route("/search")
+def search():
+    """
+    Looks for comments in the archived submissions
+    """
+    flask.g.resp.status, flask.g.resp.data = controllers.search_comments()
+    flask.g.resp.mimetype = 'application/json'
+    return flask.g.resp
+
+
+@routes.route("/status/<job_id>")
 def status(job_id):
     """
     Requests the status of a job
@@ -111,15 +167,39 @@ def status(job_id):
     return flask.g.resp
 
 
-@app.route("/download/<job_id>")
+@routes.route("/status/<job_id>/stream")
+def status_stream(job_id):
+    """
+    Follows the status of a job as it changes (Server-Sent Events).
+    When too many are open, the browser is told to poll /status instead.
+    """
+    if not controllers.open_stream():
+        return "Too many status streams are open, poll /status instead.", 503, {'Retry-After': '5'}
+    response = flask.Response(flask.stream_with_context(controllers.status_stream(job_id)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called when the stream ends, even if the client went away before it started
+    response.call_on_close(controllers.close_stream)
+    return response
+
+
+@routes.route("/metrics")
+def metrics_endpoint():
+    """
+    Operational metrics, to be read by Prometheus
+    """
+    flask.g.resp.data = controllers.metrics_text()
+    flask.g.resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return flask.g.resp
+
+
+@routes.route("/download/<job_id>")
 def download(job_id):
     """
     Downloads the result of a job
     """
     log.info(f"Download requested for job {job_id}")
-    filename = controllers.get_filename(job_id)
+    filename, download_name = controllers.get_filename(job_id)
     
-    return flask.send_from_directory(os.path.join(os.getcwd(), 'output'), filename, as_attachment=True)
+    return controllers.send_archive(filename, download_name)
 
 
 
@@ -127,30 +207,56 @@ def download(job_id):
 # Schedulers                 #
 # -------------------------- #
 
-scheduler = flask_apscheduler.APScheduler()
-scheduler.init_app(app)
-scheduler.start()
+def start_scheduler(app):
+    """
+    Starts the scheduler of the cleanup tasks, as soon as this process gets the scheduler lock.
+    With several gunicorn workers, the tasks are run by only one of them.
+    """
+    global _scheduler
+    if _scheduler is not None:
+        return
+
+    def work():
+        with open(SCHEDULER_LOCK, 'a') as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(SCHEDULER_LOCK_RETRY)
+
+            import flask_apscheduler
+            scheduler = flask_apscheduler.APScheduler()
+            scheduler.init_app(app)
+            scheduler.add_job(id='st_cleanup_downloads', func=cleanup_downloads, trigger='interval', hours=1)
+            scheduler.add_job(id='st_cleanup_snapshots', func=cleanup_snapshots, trigger='interval', hours=1)
+            scheduler.add_job(id='st_cleanup_sessions', func=cleanup_sessions, trigger='interval', hours=24)
+            scheduler.start()
+            log.info('Scheduler started in this process')
+
+            # The lock is held as long as the process lives
+            threading.Event().wait()
+
+    _scheduler = threading.Thread(target=work, name='scheduler-lock', daemon=True)
+    _scheduler.start()
+
 
-@scheduler.task('interval', id='st_cleanup_downloads', hours=1)
 def cleanup_downloads():
     """
-    Remove all downloads older than 24 hours
+    Remove the downloads that do not fit in the quota, or unused for too long
     """
     controllers.cleanup_downloads()
 
 
-@scheduler.task('interval', id='st_cleanup_sessions', hours=24)
-def cleanup_sessions():
+def cleanup_snapshots():
     """
-    Remove all sessions unused since 3 months
+    Remove all stored snapshots too old to be used
     """
-    controllers.cleanup_sessions()
+    controllers.cleanup_snapshots()
 
 
-@scheduler.task('interval', id='st_calculate_average_eta', hours=24, start_date=datetime.datetime.now()+datetime.timedelta(seconds=10))
-def calculate_average_eta():
+def cleanup_sessions():
     """
-    Calculates average time to download a thread (depending on the number of replies) so we can give a good ETA estimation.
-    Runs at startup then once every 24h.
+    Remove all sessions unused since 3 months
     """
-    controllers.calculate_average_eta()
+    controllers.cleanup_sessions()
@@ -0,0 +1,103 @@
+# Project modules
+import downloader, jobqueue, models, utils
+from config import config, setup_logging
+
+# stdlib
+import argparse, concurrent.futures, logging, secrets, sys, time
+
+log = logging.getLogger('redditarchiver_main')
+
+# How often (in seconds) jobs run by another process (such as the web app) are checked
+POLL_INTERVAL = 5
+
+
+def read_submissions(arguments, files):
+    """
+    Returns the submissions (URLs or IDs) given on the command line and in files (one per line, lines starting with # being ignored)
+    """
+    submissions = list(arguments)
+    for path in files:
+        with (sys.stdin if path == '-' else open(path, 'r')) as f:
+            submissions.extend(line.strip() for line in f if line.strip() and not line.strip().startswith('#'))
+    return submissions
+
+
+def work(batch_id, token):
+    """
+    Runs the queued jobs of the batch, one after the other, until there is none left
+    """
+    db = models.connect()
+    while True:
+        job = models.claim_job(db, jobqueue.worker_id(), batch=batch_id)
+        if job is None:
+            return
+        jobqueue.run(db, job['id'], job['submission'], token, job['output_format'])
+
+
+def run_batch(submissions, workers, token=None, output_format=None):
+    """
+    Downloads submissions, workers at a time. Returns (submission, job) pairs, job being None for invalid submissions.
+    All downloads share the same Reddit client, and so the same rate-limit budget.
+    Submissions already being downloaded (by the web app, or twice in the list) are downloaded only once.
+    """
+    db = models.connect()
+    batch_id = secrets.token_urlsafe(16)
+    job_ids = []
+    for submission in submissions:
+        submission_id = utils.extract_id(submission)
+        if submission_id is None:
+            job_ids.append(None)
+            continue
+        job_id = secrets.token_urlsafe(16)
+        # Private batch: the jobs are run here, with the token given, and not by a web app using the same database
+        models.create_job(db, job_id, submission_id, None, batch=batch_id, output_format=output_format, private=True)
+        job_ids.append(job_id)
+
+    jobqueue.start_heartbeat()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(work, batch_id, token) for i in range(workers)]:
+            future.result()
+
+    # Jobs attached to a job of another process may not be done yet: they get their result when the other job finishes,
+    # or are put back in queue if it was run with another token (see models.requeue_attached_jobs), and are then run here
+    while True:
+        jobs = {job['id']: job for job in models.read_batch(db, batch_id)}
+        if all(job['status'] in ("success", "failure") for job in jobs.values()):
+            break
+        work(batch_id, token)
+        time.sleep(POLL_INTERVAL)
+
+    return [(submission, None if job_id is None else jobs[job_id]) for submission, job_id in zip(submissions, job_ids)]
+
+
+def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description=f"Downloads Reddit submissions as files (in {config['paths']['output']}), without the web app. Run it from the directory of the app, where its config file is.")
+    parser.add_argument('submissions', nargs='*', help='URLs or IDs of the submissions to download')
+    parser.add_argument('-f', '--file', action='append', default=[], help='file listing URLs or IDs of submissions, one per line ("-" for standard input)')
+    parser.add_argument('-w', '--workers', type=int, default=config['app'].get('job-workers', 2), help='number of submissions downloaded at the same time (defaults to app.job-workers)')
+    parser.add_argument('-o', '--format', choices=downloader.OUTPUT_FORMATS, help='format of the files (defaults to app.output-format)')
+    parser.add_argument('-t', '--token', help='Reddit refresh token to download as a user (without it, submissions are read anonymously)')
+    args = parser.parse_args()
+
+    submissions = read_submissions(args.submissions, args.file)
+    if not submissions:
+        parser.error('no submission given')
+
+    failures = 0
+    for submission, job in run_batch(submissions, max(args.workers, 1), token=args.token, output_format=args.format):
+        if job is None:
+            failures += 1
+            print(f'{submission}\tfailure\tBAD_URL')
+        elif job['status'] == "success":
+            print(f"{submission}\tsuccess\t{job['filename']}")
+        else:
+            failures += 1
+            print(f"{submission}\tfailure\t{job['failure_reason']}")
+
+    print(f'{len(submissions)-failures} of {len(submissions)} submissions downloaded', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
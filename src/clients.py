@@ -0,0 +1,121 @@
+# Project modules
+from config import config
+from fetcher import RateBudget
+import metrics
+
+# 3rd party modules
+import praw, prawcore
+
+# stdlib
+import threading, time, logging, weakref
+
+log = logging.getLogger('redditarchiver_main')
+
+# Clients unused for this long (in seconds) are dropped
+IDLE_TIMEOUT = 900
+
+# Reddit clients, by refresh token and thread: [client, last use]. PRAW is not thread-safe: each client is only used by one thread
+# (the thread of a job, and the threads of its fetcher through access_token, under the lock of the client, see lock)
+_clients = {}
+_lock = threading.Lock()
+
+# Refresh token and lock of each client
+_tokens = weakref.WeakKeyDictionary()
+_locks = weakref.WeakKeyDictionary()
+
+# Rate-limit budget of each refresh token, shared by all the requests made for it at the same time, whatever the thread (see fetcher.RateBudget)
+_budgets = weakref.WeakValueDictionary()
+
+# Number of requests made to Reddit by each thread (see CountingRequestor)
+_requests = threading.local()
+
+
+class CountingRequestor(prawcore.Requestor):
+    """
+    PRAW requestor counting the requests made by the current thread, so that a job knows how many API calls it made.
+    Their latency and the rate limit left are also measured (see metrics).
+    """
+    def request(self, *args, **kwargs):
+        _requests.count = getattr(_requests, 'count', 0)+1
+        start = time.perf_counter()
+        response = super().request(*args, **kwargs)
+        metrics.REDDIT_REQUEST_DURATION.observe(time.perf_counter()-start, client='praw')
+        if 'x-ratelimit-remaining' in response.headers:
+            metrics.REDDIT_RATELIMIT_REMAINING.set(float(response.headers['x-ratelimit-remaining']))
+        return response
+
+
+def nb_requests():
+    """
+    Returns the number of requests made to Reddit by the current thread so far
+    """
+    return getattr(_requests, 'count', 0)
+
+
+def new_client(refresh_token=None):
+    """
+    Creates a Reddit client, authenticated for a user if a refresh token is given
+    """
+    if refresh_token is None:
+        return praw.Reddit(client_id=config['reddit']['client-id'], client_secret=config['reddit']['client-secret'], redirect_uri=f"{config['app']['url']}/token", user_agent=config['reddit']['agent'], requestor_class=CountingRequestor)
+    else:
+        return praw.Reddit(client_id=config['reddit']['client-id'], client_secret=config['reddit']['client-secret'], refresh_token=refresh_token, user_agent=config['reddit']['agent'], requestor_class=CountingRequestor)
+
+
+def get(refresh_token=None):
+    """
+    Returns the Reddit client of the current thread for a refresh token (or the unauthenticated one if None), creating it if needed.
+    Clients are kept between calls, so their HTTP session and their access token are reused until they expire.
+    """
+    now = time.monotonic()
+    key = (refresh_token, threading.get_ident())
+    with _lock:
+        # Evicting the clients that were not used for a while (such as the ones of threads that stopped)
+        for old_key in [old_key for old_key, (client, last_use) in _clients.items() if now-last_use > IDLE_TIMEOUT]:
+            del _clients[old_key]
+
+        if key not in _clients:
+            remember(key, new_client(refresh_token))
+        _clients[key][1] = now
+        return _clients[key][0]
+
+
+def remember(key, client):
+    """
+    Adds a client to the pool (the lock of the pool being held)
+    """
+    _clients[key] = [client, time.monotonic()]
+    _tokens[client] = key[0]
+    _locks[client] = threading.Lock()
+
+
+def lock(client):
+    """
+    Returns the lock to hold when a client is used by other threads than its own (to refresh its access token, see downloader.access_token)
+    """
+    with _lock:
+        return _locks[client]
+
+
+def budget(client):
+    """
+    Returns the rate-limit budget of a client: Reddit counts requests by account, so all the downloads made for the same user draw from the same budget
+    """
+    with _lock:
+        token = _tokens[client]
+        budget = _budgets.get(token)
+        if budget is None:
+            budget = _budgets[token] = RateBudget()
+        return budget
+
+
+def authorize(code):
+    """
+    Exchanges the code given by Reddit for a refresh token, and returns it.
+    The client used for that is then authenticated for the user, so it is kept for their upcoming requests (made by the same thread).
+    """
+    client = new_client()
+    refresh_token = client.auth.authorize(code)
+    with _lock:
+        remember((refresh_token, threading.get_ident()), client)
+    return refresh_token
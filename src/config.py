@@ -27,21 +27,31 @@ config['app']['project'] = "https://github.com/Ailothaen/RedditArchiver"
 config['reddit']['agent'] = f"{config['app']['name']} v{config['app']['version']} (by u/ailothaen)"
 config['runtime'] = {}
 config['runtime']['average'] = 30
+config['runtime']['render_average'] = None
 
 log = logging.getLogger('redditarchiver_main')
-log.setLevel(logging.INFO) # Define minimum severity here
-handler = RotatingFileHandler('./logs/main.log', maxBytes=1000000, backupCount=10) # Log file of 1 MB, 10 previous files kept
-formatter = logging.Formatter('[%(asctime)s][%(module)s][%(levelname)s] %(message)s', '%Y-%m-%d %H:%M:%S %z') # Custom line format and time format to include the module and delimit all of this well
-handler.setFormatter(formatter)
-log.addHandler(handler)
-log.info("+----------------------------------------+")
-log.info("|     ;;;;;                              |")
-log.info("|     ;;;;;         R e d d i t          |")
-log.info("|     ;;;;;       A r c h i v e r        |")
-log.info("|   ..;;;;;..                            |")
-log.info("|    ':::::'          v {}            |".format(config['app']['version']))
-log.info("|      ':`                               |")
-log.info("+----------------------------------------+")
-python_version = sys.version.replace("\n", " ")
-log.info(f"Python version: {python_version}")
-log.debug("Config: {}".format(str(config)))
+
+
+def setup_logging():
+    """
+    Writes the logs of the app in logs/main.log. Called by the entry points (app.create_app, cli), not at import,
+    so that importing a module of the app has no side effect.
+    """
+    if log.handlers:
+        return
+    log.setLevel(logging.INFO) # Define minimum severity here
+    handler = RotatingFileHandler('./logs/main.log', maxBytes=1000000, backupCount=10) # Log file of 1 MB, 10 previous files kept
+    formatter = logging.Formatter('[%(asctime)s][%(module)s][%(levelname)s] %(message)s', '%Y-%m-%d %H:%M:%S %z') # Custom line format and time format to include the module and delimit all of this well
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+    log.info("+----------------------------------------+")
+    log.info("|     ;;;;;                              |")
+    log.info("|     ;;;;;         R e d d i t          |")
+    log.info("|     ;;;;;       A r c h i v e r        |")
+    log.info("|   ..;;;;;..                            |")
+    log.info("|    ':::::'          v {}            |".format(config['app']['version']))
+    log.info("|      ':`                               |")
+    log.info("+----------------------------------------+")
+    python_version = sys.version.replace("\n", " ")
+    log.info(f"Python version: {python_version}")
+    log.debug("Config: {}".format(str(config)))
@@ -1,19 +1,41 @@
 # Project modules
-import downloader, models, utils
+# (clients and downloader load PRAW and markdown2: they are imported where they are used, so that starting the app does not wait for them)
+import events, jobqueue, metrics, models, utils
 from config import config
 
 # 3rd party modules
-import flask, praw
+import flask, werkzeug.utils
 
 # stdlib
-import threading, secrets, logging, json, datetime, os
+import secrets, logging, json, datetime, os, queue, gzip, threading, time, urllib.parse
 
 log = logging.getLogger('redditarchiver_main')
 
+# Batches of submissions: maximum number of submissions, and priority of their jobs (lower than the ones requested one at a time)
+BATCH_MAX_SIZE = 500
+BATCH_PRIORITY = -1
+
+# Size of the parts sent when an archive is decompressed on the fly
+DOWNLOAD_CHUNK_SIZE = 256*1024
+
+# How often (in seconds) something is sent on idle status streams, so that proxies do not close them
+STREAM_KEEPALIVE = 15
+# How often (in seconds) status streams read their job in database, when it is queued or run by another process (which publishes nothing
+# here, see events): like the pages polling /status. Jobs run by this process are only read again after STREAM_KEEPALIVE seconds without events.
+STREAM_POLL_INTERVAL = 5
+# Each open status stream holds a thread of the web server: past app.max-status-streams streams in this process, clients are
+# answered 503 and poll /status instead, so that there are always threads left for the other requests
+_streams_open = 0
+_streams_lock = threading.Lock()
+
+# Averages used to estimate the time left to jobs are calculated again after this many seconds (see calculate_average_eta)
+AVERAGES_MAX_AGE = 86400
+_averages_calculated_at = None
+
 
 def request():
     """
-    Initiates a submission-saving request (= job)
+    Initiates a submission-saving request (= job), which is put in queue until a worker takes it
     """
     job_id = secrets.token_urlsafe(16)
     submission = flask.request.form.get("submission-id")
@@ -23,23 +45,132 @@ def request():
         log.error(f'{job_id}: URL not valid ({submission})')
         raise ValueError("BAD_URL")
 
-    models.create_job(flask.g.db, job_id, submission_id, flask.g.cookie)
+    output_format = read_output_format(flask.request.form.get("format"))
+    if output_format is False:
+        log.error(f'{job_id}: output format not valid ({flask.request.form.get("format")})')
+        raise ValueError("BAD_FORMAT")
 
-    worker = threading.Thread(target=downloader.main, args=(submission_id, flask.g.token, job_id))
-    worker.name = job_id
-    worker.daemon = True
+    served_by = models.create_job(flask.g.db, job_id, submission_id, flask.g.cookie, output_format=output_format)
+    if served_by is None:
+        log.info(f'{job_id}: Job queued (submission {submission_id}, token {flask.g.token})')
+        jobqueue.notify()
+    else:
+        log.info(f'{job_id}: Submission {submission_id} is already being downloaded, job attached to {served_by}')
 
-    log.info(f'{job_id}: Job starting (submission {submission_id}, token {flask.g.token})')
-    worker.start()
-    
     return job_id
 
 
+def request_batch():
+    """
+    Initiates the download of several submissions at once (a batch). Submissions are given as a list of URLs or IDs,
+    either in a JSON body ({"submissions": [...], "format": ...}) or in the form fields "submissions" (one per line) and "format".
+    Each valid submission gets its own job, queued after the submissions requested one at a time.
+    """
+    body = flask.request.get_json(silent=True)
+    if body is not None and not isinstance(body, dict):
+        return 400, json.dumps({"batch": None, "error_message": 'Please send a JSON object, such as {"submissions": [...]}.'})
+    if body is not None:
+        submissions = body.get("submissions", [])
+        output_format = read_output_format(body.get("format"))
+    else:
+        submissions = flask.request.form.get("submissions", "").split()
+        output_format = read_output_format(flask.request.form.get("format"))
+
+    if not isinstance(submissions, list) or not submissions or len(submissions) > BATCH_MAX_SIZE:
+        return 400, json.dumps({"batch": None, "error_message": f"Please give between 1 and {BATCH_MAX_SIZE} submissions."})
+    if output_format is False:
+        return 400, json.dumps({"batch": None, "error_message": error_message('BAD_FORMAT')})
+
+    batch_id = secrets.token_urlsafe(16)
+    invalid = []
+    for submission in submissions:
+        job_id = secrets.token_urlsafe(16)
+        submission_id = utils.extract_id(str(submission))
+        if submission_id is None:
+            log.error(f'{batch_id}: URL not valid ({submission})')
+            invalid.append(submission)
+            continue
+        served_by = models.create_job(flask.g.db, job_id, submission_id, flask.g.cookie, priority=BATCH_PRIORITY, batch=batch_id, output_format=output_format)
+        if served_by is None:
+            jobqueue.notify()
+
+    log.info(f'{batch_id}: Batch of {len(submissions)} submissions requested (token {flask.g.token})')
+    data = batch_payload(batch_id)
+    data["invalid"] = invalid
+    return 202, json.dumps(data)
+
+
+def read_output_format(output_format):
+    """
+    Checks an output format given with a request: returns it, None if none was given (app.output-format is then used), or False if it is not valid
+    """
+    import downloader
+    if not output_format:
+        return None
+    return output_format if output_format in downloader.OUTPUT_FORMATS else False
+
+
+def batch_status(batch_id):
+    """
+    Queries the status of every job of a batch
+    """
+    data = batch_payload(batch_id)
+    if not data["jobs"]:
+        return 404, json.dumps(data)
+    elif all(job["status"] in ("success", "failure") for job in data["jobs"]):
+        return 200, json.dumps(data)
+    else:
+        return 409, json.dumps(data)
+
+
+def batch_payload(batch_id):
+    jobs = []
+    for job in models.read_batch(flask.g.db, batch_id):
+        # Jobs attached to another one have its status
+        status = models.read_job(flask.g.db, job['served_by'])['status'] if job['status'] == "attached" else job['status']
+        jobs.append({"job_id": job['id'], "submission": job['submission'], "status": status, "error_message": error_message(job['failure_reason']), "download": f"{config['app']['url']}/download/{job['id']}" if status == "success" else None})
+    return {"batch": batch_id, "jobs": jobs}
+
+
+def search_comments():
+    """
+    Looks for comments in the archived submissions (see search.search), with the query string parameters q (the words to look for),
+    sort ("relevance" or "recent"), page or before (to get the next pages, as given in "next"), and submission (to look only in one submission).
+    Only the submissions requested with the token of the user are searched.
+    """
+    if not config['app'].get('search-index', False):
+        return 404, json.dumps({"results": [], "next": None, "error_message": "Search is not enabled on this instance."})
+
+    if flask.g.token is None:
+        return 401, json.dumps({"results": [], "next": None, "error_message": "Please allow Reddit Archiver to read Reddit on your behalf first: only the submissions requested with your account are searched."})
+
+    import search
+    args = flask.request.args
+    query = args.get("q", "")
+    sort = args.get("sort", "relevance")
+    submission_id = utils.extract_id(args["submission"]) if args.get("submission") else None
+    if args.get("submission") and submission_id is None:
+        return 400, json.dumps({"results": [], "next": None, "error_message": error_message('BAD_URL')})
+    try:
+        page = max(int(args.get("page", 1)), 1)
+        before = int(args["before"]) if args.get("before") else None
+    except ValueError:
+        return 400, json.dumps({"results": [], "next": None, "error_message": "Page numbers must be integers."})
+    if not query.strip() or len(query) > search.QUERY_MAX_LENGTH or sort not in ("relevance", "recent"):
+        return 400, json.dumps({"results": [], "next": None, "error_message": f"Please give some words to look for (at most {search.QUERY_MAX_LENGTH} characters), and a sort among relevance and recent."})
+
+    results, following = search.search(query, flask.g.token, sort=sort, page=page, before=before, submission=None if submission_id is None else 't3_'+submission_id)
+    if following is not None:
+        following = '/search?'+urllib.parse.urlencode({"q": query, "sort": sort, **({"submission": submission_id} if submission_id else {}), **following})
+    return 200, json.dumps({"results": results, "next": following})
+
+
 def craft_authentication_url():
     """
     Makes the authentication URL, for the user to allow Reddit to read submissions through their account
     """
-    reddit = praw.Reddit(client_id=config['reddit']['client-id'], client_secret=config['reddit']['client-secret'], redirect_uri=f"{config['app']['url']}/token", user_agent=config['reddit']['agent'])
+    import clients
+    reddit = clients.get()
     return reddit.auth.url(duration="permanent", scopes=['read'], state=flask.g.cookie)
 
 
@@ -48,9 +179,9 @@ def get_refresh_token():
     Gets refresh token from the code given by Reddit
     (more info: https://praw.readthedocs.io/en/stable/getting_started/authentication.html)
     """
+    import clients
     code = flask.request.args.get('code')
-    reddit = praw.Reddit(client_id=config['reddit']['client-id'], client_secret=config['reddit']['client-secret'], redirect_uri=f"{config['app']['url']}/token", user_agent=config['reddit']['agent'])
-    return reddit.auth.authorize(code)
+    return clients.authorize(code)
 
 
 def status(job_id):
@@ -58,9 +189,13 @@ def status(job_id):
     Queries the current status of a job.
     """
     job = models.read_job(flask.g.db, job_id)
-    data = json.dumps({"status": job['status'], "error_message": error_message(job['failure_reason']), "eta": calculate_estimated_time(job['started_at'], job['nb_replies'], config['runtime']['average'])})
-    
-    if job['status'] == "ongoing":
+    if job['status'] == "attached":
+        # Another job is downloading the same submission for us: its status is ours
+        job = models.read_job(flask.g.db, job['served_by'])
+
+    data = json.dumps(status_payload(flask.g.db, job))
+
+    if job['status'] in ("queued", "ongoing"):
         status = 409
     elif job['status'] == "failure":
         status = 404
@@ -72,17 +207,173 @@ def status(job_id):
     return status, data
 
 
-def calculate_estimated_time(start_time, nb_replies, average):
+def status_payload(db, job):
+    """
+    Status of a job, as sent to the browser
+    """
+    if _averages_calculated_at is None or time.monotonic()-_averages_calculated_at > AVERAGES_MAX_AGE:
+        calculate_average_eta()
+    if job['status'] == "queued":
+        position = models.queue_position(db, job['id'])
+        return {"status": job['status'], "error_message": None, "eta": f"Your request is waiting in queue (position {position})", "position": position}
+    else:
+        return {"status": job['status'], "error_message": error_message(job['failure_reason']), "eta": calculate_estimated_time(job, models.read_phases(db, job['id']), config['runtime']['average'], config['runtime']['render_average'])}
+
+
+def status_stream(job_id):
+    """
+    Follows a job, yielding its status as Server-Sent Events each time it changes, until it is done.
+    The current status is sent first, and then the events published by the worker running the job. Jobs queued or run by another process
+    (another gunicorn worker, or worker.py) publish nothing here: they are followed by reading them in database every STREAM_POLL_INTERVAL seconds.
+    """
+    db = models.connect()
+    job = models.read_job(db, job_id)
+    followed = job['served_by'] if job['status'] == "attached" else job_id
+
+    subscription = events.subscribe(followed)
+    try:
+        # Subscribing before reading the status, so that no event can be missed in between
+        job = models.read_job(db, followed)
+        status = job['status']
+        payload = status_payload(db, job)
+        yield server_sent_event(payload)
+        sent_at = time.monotonic()
+
+        while True:
+            if status in ("success", "failure"):
+                if followed == job_id:
+                    break
+                # The job we were attached to is done: ours may have been put back in queue instead of getting its result
+                # (see models.requeue_attached_jobs), it is followed from now on
+                events.unsubscribe(followed, subscription)
+                followed = job_id
+                subscription = events.subscribe(followed)
+                job = models.read_job(db, followed)
+                status = job['status']
+                update = status_payload(db, job)
+                if update != payload:
+                    payload = update
+                    yield server_sent_event(payload)
+                    sent_at = time.monotonic()
+                continue
+
+            # Jobs run by a worker of this process publish their progress: reading them in database is only a safety net
+            local = job['status'] == "ongoing" and job['worker'] == jobqueue.worker_id()
+            try:
+                event = subscription.get(timeout=STREAM_KEEPALIVE if local else STREAM_POLL_INTERVAL)
+            except queue.Empty:
+                job = models.read_job(db, followed)
+                status = job['status']
+                if status == "ongoing":
+                    update = event_payload(db, followed, job_event(job))
+                else:
+                    update = status_payload(db, job)
+            else:
+                if event['status'] != status:
+                    # Taken by a worker (of this process, as it published it): read once to know which one
+                    job = models.read_job(db, followed)
+                status = event['status']
+                update = event_payload(db, followed, event)
+
+            if status in ("success", "failure") and followed != job_id:
+                # Not sent: the result of our job is read once the one we were attached to is done
+                continue
+            if update != payload:
+                payload = update
+                yield server_sent_event(payload)
+                sent_at = time.monotonic()
+            elif time.monotonic()-sent_at > STREAM_KEEPALIVE:
+                # Keeping the connection open
+                yield ': keepalive\n\n'
+                sent_at = time.monotonic()
+    finally:
+        events.unsubscribe(followed, subscription)
+
+
+def open_stream():
+    """
+    Counts a status stream being opened. Returns False (and counts nothing) if app.max-status-streams are already open in this process.
+    """
+    global _streams_open
+    with _streams_lock:
+        if _streams_open >= config['app'].get('max-status-streams', 8):
+            return False
+        _streams_open += 1
+        return True
+
+
+def close_stream():
+    """
+    Counts a status stream being closed (see open_stream)
+    """
+    global _streams_open
+    with _streams_lock:
+        _streams_open -= 1
+
+
+def job_event(job):
+    """
+    Makes the event the worker would publish, from the progress of a job written in database
+    """
+    if job['phase'] == 'render':
+        return {'status': job['status'], 'phase': job['phase'], 'done': job['nb_rendered'] or 0, 'total': job['nb_fetched'] or 0}
+    else:
+        return {'status': job['status'], 'phase': job['phase'], 'done': job['nb_fetched'] or 0, 'total': job['nb_replies'] or 0}
+
+
+def event_payload(db, job_id, event):
+    """
+    Turns an event published for a job into the status sent to the browser
+    """
+    if event['status'] == "failure":
+        return {"status": event['status'], "error_message": error_message(event.get('failure_reason')), "eta": None}
+    elif event['status'] == "success":
+        return {"status": event['status'], "error_message": None, "eta": None}
+
+    if event.get('phase') in ('replace_more', 'tree_build'):
+        eta = f"Downloading comments: {event['done']} of about {event['total']}"
+    elif event.get('phase') == 'render':
+        eta = f"Generating the archive: {event['done']} of {event['total']} comments"
+    else:
+        eta = None
+
+    estimated_time = calculate_estimated_time(models.read_job(db, job_id), models.read_phases(db, job_id), config['runtime']['average'], config['runtime']['render_average'])
+    if estimated_time is not None:
+        eta = estimated_time if eta is None else f"{eta}<br/>{estimated_time}"
+    return {"status": event['status'], "error_message": None, "eta": eta}
+
+
+def server_sent_event(data):
+    return f'data: {json.dumps(data)}\n\n'
+
+
+def calculate_estimated_time(job, phases, average, render_average=None):
     """
-    Tries to do an estimation on the remaining time - based on the average time of previous jobs.
+    Tries to do an estimation on the remaining time - based on the progress of the job: the download and rendering speeds measured so far
+    give the time needed for the rest. Until the job makes progress, it is based on the average time of previous jobs.
     """
+    nb_replies = job['nb_replies']
     if nb_replies is None:
         return None
-    
+
     now = datetime.datetime.now(datetime.timezone.utc).timestamp()
-    elapsed = now-start_time
-    estimated_total = nb_replies/average
-    estimated_remaining = int(estimated_total-elapsed)
+    if render_average is None:
+        render_average = average
+
+    if job['phase'] in ('render', 'write') and 'render' in phases:
+        nb_comments = job['nb_fetched'] or nb_replies
+        if job['nb_rendered']:
+            rate = job['nb_rendered']/max(now-phases['render']['started_at'], 1)
+            estimated_remaining = int((nb_comments-job['nb_rendered'])/rate)
+        else:
+            estimated_remaining = int(nb_comments/render_average-(now-phases['render']['started_at']))
+    elif job['phase'] in ('replace_more', 'tree_build') and job['nb_fetched'] and 'replace_more' in phases:
+        rate = job['nb_fetched']/max(now-phases['replace_more']['started_at'], 1)
+        estimated_remaining = int(max(nb_replies-job['nb_fetched'], 0)/rate+nb_replies/render_average)
+    else:
+        elapsed = now-job['started_at']
+        estimated_total = nb_replies/average
+        estimated_remaining = int(estimated_total-elapsed)
 
     if estimated_remaining < 0:
         return "It seems that the retrieval is taking a bit more time than expected. Please stand by..."
@@ -97,10 +388,53 @@ def calculate_estimated_time(start_time, nb_replies, average):
 
 def get_filename(job_id):
     """
-    Get filename of a downloaded submission (taking job ID as input)
+    Get filename of a downloaded submission, and the name it is downloaded under (taking job ID as input)
     """
     job = models.read_job(flask.g.db, job_id)
-    return job["filename"]
+    return job["filename"], job["download_name"]
+
+
+def send_archive(filename, download_name=None):
+    """
+    Sends a downloaded submission to the browser. Range requests and ETags are handled by Flask, so interrupted downloads can be resumed.
+    Compressed archives are sent as they are, with a Content-Encoding header, if the browser accepts it. Otherwise, they are decompressed on the fly.
+    Files are stored under the hash of their content: they are downloaded as download_name (the name given by downloader.output_name).
+    """
+    import downloader
+    directory = os.path.join(os.getcwd(), 'output')
+    compression = next((compression for compression, suffix in downloader.COMPRESSION_SUFFIXES.items() if filename.endswith(suffix)), None)
+    if download_name is None:
+        download_name = filename if compression is None else filename[:-len(downloader.COMPRESSION_SUFFIXES[compression])]
+
+    # Downloaded files are the last to be evicted
+    models.touch_file(flask.g.db, filename)
+    if compression is None:
+        return flask.send_from_directory(directory, filename, as_attachment=True, download_name=download_name, mimetype=downloader.mimetype(filename))
+
+    if flask.request.accept_encodings[compression]:
+        response = flask.send_from_directory(directory, filename, as_attachment=True, download_name=download_name, mimetype=downloader.mimetype(filename))
+        response.headers['Content-Encoding'] = compression
+    else:
+        path = werkzeug.utils.safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            flask.abort(404)
+
+        def decompress():
+            with open(path, 'rb') as f:
+                if compression == 'gzip':
+                    reader = gzip.GzipFile(fileobj=f, mode='rb')
+                else:
+                    reader = downloader.zstandard.ZstdDecompressor().stream_reader(f)
+                while True:
+                    chunk = reader.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        response = flask.Response(decompress(), mimetype=downloader.mimetype(filename))
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 
 def error_message(reason):
@@ -113,6 +447,8 @@ def error_message(reason):
         message = "It looks like your Reddit account does no longer allow Reddit Archiver to read Reddit on its behalf. Please try to allow it again by clicking here. If it still does not work, please <a href=\""+config['app']['project']+"\" target=\"_blank\">open an issue on the GitHub</a>."
     elif reason == 'BAD_URL':
         message = "The link you provided is not a valid Reddit submission. Please check it and submit it again."
+    elif reason == 'BAD_FORMAT':
+        message = "The requested format is not valid. Please choose one of the formats offered."
     elif reason == 'BAD_PERMISSIONS':
         message = "Your request cannot be completed because of an issue in the server. Please contact the administrator and tell them to look in the error logs. If you are the administrator and cannot resolve the problem, please <a href=\""+config['app']['project']+"\" target=\"_blank\">open an issue on the GitHub</a>."
     elif reason == 'UNKNOWN':
@@ -124,14 +460,21 @@ def error_message(reason):
 
 def cleanup_downloads():
     """
-    Remove all files in output older than 24 hours
+    Remove the files in output that do not fit in the quota, or that were not used for too long (see downloader.evict_outputs)
     """
-    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
-    files = os.listdir('output')
-    for file in files:
-        mtime = os.path.getmtime(os.path.join('output', file))
-        if (now-mtime) > 86400:
-            os.remove(os.path.join('output', file))
+    import downloader
+    downloader.evict_outputs(models.connect())
+    metrics.CLEANUP_RUNS.inc(task='downloads')
+
+
+def cleanup_snapshots():
+    """
+    Remove all stored snapshots that are too old to be used anymore
+    """
+    db = models.connect()
+    removed = models.cleanup_snapshots(db, max(config['app'].get('archive-max-age', 600), config['app'].get('archive-refresh-max-age', 0)))
+    metrics.CLEANUP_RUNS.inc(task='snapshots')
+    metrics.CLEANUP_REMOVED.inc(removed, task='snapshots')
 
 
 def cleanup_sessions():
@@ -139,15 +482,30 @@ def cleanup_sessions():
     Remove all sessions unused since 3 months
     """
     db = models.connect()
-    models.cleanup_sessions(db)
+    removed = models.cleanup_sessions(db)
+    metrics.CLEANUP_RUNS.inc(task='sessions')
+    metrics.CLEANUP_REMOVED.inc(removed, task='sessions')
+
+
+def metrics_text():
+    """
+    Returns the metrics of the app, in the text format read by Prometheus
+    """
+    for status, count in models.count_jobs(flask.g.db).items():
+        metrics.JOBS.set(count, status=status)
+    return metrics.expose()
 
 
 def calculate_average_eta():
     """
     Calculates average time to download a thread (depending on the number of replies) so we can give a good ETA estimation.
+    Each process calculates its own, when it first estimates the time of a job and then once a day.
     """
+    global _averages_calculated_at
+    _averages_calculated_at = time.monotonic()
     db = models.connect()
     average = models.calculate_average_eta(db)
+    config['runtime']['render_average'] = models.calculate_average_render_rate(db)
     if average is None:
         log.info(f"Cannot calculate average, default value of 30 is going to be taken")
         config['runtime']['average'] = 30
@@ -1,91 +1,419 @@
 # Project modules
 from sqlite3 import connect
 from config import config
-import models
+from tree import CommentTree, CommentRecord, NONE
+from formatting import commentParser, render_bodies, RenderCache, DateFormatter
+from fetcher import MoreChildrenFetcher
+import clients, events, metrics, models, rawstore, search
 
 # 3rd party modules
-from anytree import Node, PreOrderIter
-from anytree import util as anytree_util
-import praw, prawcore, markdown2
+import praw, prawcore
 
 # stdlib
-import datetime, os, logging, sys
+import datetime, os, logging, collections, contextlib, io, time, gzip, json, sqlite3, tempfile, hashlib
+
+# zstd compression of the output files is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger('redditarchiver_main')
 
+# Size of the buffer used when writing output files
+WRITE_BUFFER_SIZE = 1024*1024
+
+# Fragments of HTML are encoded (and compressed) by batches of about this many characters
+WRITE_BATCH_SIZE = 64*1024
+
+# Output files can be compressed while they are written: suffix of their names, by compression
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+output_compression = config['app'].get('output-compression', 'none')
+if output_compression == 'zstd' and zstandard is None:
+    log.warning('app.output-compression is "zstd" but the zstandard module is not installed: gzip is used instead')
+    output_compression = 'gzip'
+
+# Progress of jobs is reported every time this many comments have been downloaded or rendered
+PROGRESS_INTERVAL = 500
+
+# Lazy-loading archives (see generate_lazy_html): comments per chunk, and size from which "auto" output format switches to them
+LAZY_CHUNK_SIZE = 1000
+LAZY_AUTO_THRESHOLD = 20000
+
+# Static parts of the HTML documents, built once rather than for every job: stylesheet, and scripts of the classic
+# and lazy-loading formats (the latter renders the chunks, the first one right away, the others when the reader gets close
+# to the end of the page, or navigates to one of their comments)
+HTML_STYLE = "html{font-family: 'Arial', 'Helvetica', sans-serif;font-size: 15px;box-sizing: border-box;}div{margin: 0px -5px 0px 0px;padding: 5px;}header{font-weight: bold;}.f{margin-top: 15px;}.o{background-color: #eaeaea;}.e{background-color: #fafafa;}.l1{border-left: 4px solid #3867d6;}.l1 > header, .l1 > a, .l1 > header a{color: #3867d6;}.l2{border-left: 4px solid #e74c3c;}.l2 > header, .l2 > a, .l2 > header a{color: #e74c3c;}.l3{border-left: 4px solid #20bf6b;}.l3 > header, .l3 > a, .l3 > header a{color: #20bf6b;}.l4{border-left: 4px solid #f7b731;}.l4 > header, .l4 > a, .l4 > header a{color: #f7b731;}.l5{border-left: 4px solid #9b59b6;}.l5 > header, .l5 > a, .l5 > header a{color: #9b59b6;}.l6{border-left: 4px solid #fa8231;}.l6 > header, .l6 > a, .l6 > header a{color: #fa8231;}.l7{border-left: 4px solid #a5b1c2;}.l7 > header, .l7 > a, .l7 > header a{color: #a5b1c2;}.l8{border-left: 4px solid #4b6584;}.l8 > header, .l8 > a, .l8 > header a{color: #4b6584;}.l9{border-left: 4px solid #0fb9b1;}.l9 > header, .l9 > a, .l9 > header a{color: #0fb9b1;}.l0{border-left: 4px solid #fd79a8;}.l0 > header, .l0 > a, .l0 > header a{color: #fd79a8;}.m{background-color: #c8ffc8;}.a{background-color: #ffdcd2;}.p{background-color: #b4c8ff;}.n{text-decoration: none;}.D{cursor:not-allowed!important;color:#ccc!important;}"
+HTML_JS = '<script>function checkKey(e){"38"==(e=e||window.event).keyCode?(e.preventDefault(),scrollToSibling("A")):"40"==e.keyCode?(e.preventDefault(),scrollToSibling("B")):"37"!=e.keyCode&&"80"!=e.keyCode||scrollToParent()}function scrollToSibling(e){var o,t=window.location.hash.substr(1),n=document.getElementById(t).getElementsByClassName(e)[0];n.classList.contains("D")||(o=n.getAttribute("href").substr(1),document.getElementById(o).scrollIntoView(!0),window.location.hash=o)}function scrollToParent(){var e=window.location.hash.substr(1);document.getElementById(e).parentNode.id.scrollIntoView(!0),window.location.hash=target_id}document.onkeydown=checkKey;</script>'
+LAZY_STYLE = '#comments,#more{margin:0;padding:0;}'
+LAZY_JS = '<script>var archive=JSON.parse(document.getElementById("archive").textContent),rendered=0;function renderChunk(){var e=document.getElementById("c"+rendered);if(null===e)return!1;var n=JSON.parse(e.textContent),t=rendered,r=archive.chunks,o=[],c=[archive.root],a=[],l=[],i=[],s=0,d,u,h,f,m,p;for(e.remove(),d=0;d<n.length;d++)u=n[d][1],l[d]=void 0===a[u]?-1:a[u],l[d]>=0&&(i[l[d]]=d),a[u]=d,a.length=u+1,c[u]=n[d][0];for(c=[archive.root],d=0;d<n.length;d++)u=(h=n[d])[1],c[u]=h[0],f=l[d]>=0?n[l[d]][0]:1==u&&t>0?r[t-1][1]:"",m=void 0!==i[d]?n[i[d]][0]:1==u&&t+1<r.length?r[t+1][0]:"",p=(1==u?"f ":"")+(h[7]?h[7]+" ":u%2==0?"e ":"o ")+"l"+String(u).slice(-1),u<=s&&o.push("</div>".repeat(s-u+1)),o.push(\'<div class="\'+p+\'" id="\'+h[0]+\'"><header><a href="\'+archive.reddit+"/u/"+h[2]+\'">\'+h[2]+\'</a>, on <a href="\'+archive.reddit+h[3]+\'">\'+h[4]+"</a> ("+h[5]+(h[6]?", edited":"")+\') <a href="#\'+c[u-1]+\'" class="n P">▣</a> <a href="#\'+f+\'" class="n A\'+(f?"":" D")+\'">🠉</a> <a href="#\'+m+\'" class="n B\'+(m?"":" D")+\'">🠋</a> <a href="#\'+h[0]+\'" class="n S">◯</a></header>\'+h[8]),s=u;return o.push("</div>".repeat(s)),document.getElementById("comments").insertAdjacentHTML("beforeend",o.join("")),rendered++,!0}function show(e){for(;null===document.getElementById(e)&&renderChunk(););return document.getElementById(e)}function go(e){var n=show(e);n&&(n.scrollIntoView(!0),window.location.hash=e)}function follow(e){var n=document.getElementById(window.location.hash.substr(1)),t;n&&((t=n.getElementsByClassName(e)[0]).classList.contains("D")||go(t.getAttribute("href").substr(1)))}function checkKey(e){"38"==(e=e||window.event).keyCode?(e.preventDefault(),follow("A")):"40"==e.keyCode?(e.preventDefault(),follow("B")):"37"!=e.keyCode&&"80"!=e.keyCode||follow("P")}function fill(){for(var e=document.getElementById("more");e.getBoundingClientRect().top<window.innerHeight+2e3&&renderChunk(););}document.onkeydown=checkKey,document.addEventListener("click",function(e){var n=e.target.closest?e.target.closest(\'a[href^="#"]\'):null;n&&show(n.getAttribute("href").substr(1))}),"IntersectionObserver"in window?new IntersectionObserver(function(e){e[0].isIntersecting&&fill()},{rootMargin:"2000px 0px"}).observe(document.getElementById("more")):window.addEventListener("scroll",fill),document.addEventListener("DOMContentLoaded",function(){window.location.hash&&go(window.location.hash.substr(1)),fill()}),renderChunk();</script>'
+
+# Cache of rendered comment bodies, shared by all jobs
+if config['app'].get('render-cache-size', 10000) > 0:
+    render_cache = RenderCache(config['app'].get('render-cache-size', 10000), "data/render-cache.sqlite3" if config['app'].get('render-cache-persistent', False) else None)
+else:
+    render_cache = None
 
-# -------------------------- #
-# Functions                  #
-# -------------------------- #
 
-def commentParser(initialText):
+class JobProgress:
     """
-    Parses Reddit's pseudo-markdown into HTML formatting
+    Keeps track of the progress of a job: its counters and the start and end of its phases are written in database,
+    and published to the ones following the job (see events).
+    Without a job ID (submissions downloaded outside of a job), nothing is recorded.
     """
-    # removing HTML characters
-    text = initialText.replace('<', '&lt;')
-    text = text.replace('>', '&gt;')
+    def __init__(self, db=None, job_id=None):
+        self.db = db
+        self.job_id = job_id
+        self.current = None
+        # Requests made by the current thread through PRAW are counted by clients, the others (such as the ones of fetcher) are given
+        self.other_requests = 0
+        self._requests_start = clients.nb_requests()
+
+
+    @property
+    def nb_requests(self):
+        return clients.nb_requests()-self._requests_start+self.other_requests
+
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Records the start and the end of a phase of the job (the end is not recorded if the phase fails)
+        """
+        started_at = time.time()
+        self.start(name, started_at)
+        yield
+        self.finish(name, started_at, time.time())
+
+
+    def start(self, name, started_at):
+        self.current = name
+        if self.job_id is not None:
+            models.start_phase(self.db, self.job_id, name, started_at)
+
+
+    def finish(self, name, started_at, finished_at, duration=None):
+        """
+        Records the end of a phase. Its duration is the time since its start, unless given (for phases interleaved with another one)
+        """
+        if duration is None:
+            duration = finished_at-started_at
+        if self.job_id is not None:
+            models.finish_phase(self.db, self.job_id, name, finished_at, duration=duration)
+            metrics.JOB_PHASE_DURATION.observe(duration, phase=name)
+
+
+    def fetched(self, done, total, other_requests=None):
+        """
+        Records the number of comments downloaded so far (out of about "total")
+        """
+        if other_requests is not None:
+            self.other_requests = other_requests
+        if self.job_id is not None:
+            models.write_progress(self.db, self.job_id, nb_fetched=done, nb_requests=self.nb_requests)
+            events.publish(self.job_id, {'status': 'ongoing', 'phase': self.current, 'done': done, 'total': total})
+
+
+    def rendered(self, done, total):
+        """
+        Records the number of comments rendered so far (out of "total")
+        """
+        if self.job_id is not None:
+            models.write_progress(self.db, self.job_id, nb_rendered=done)
+            events.publish(self.job_id, {'status': 'ongoing', 'phase': self.current, 'done': done, 'total': total})
+
+
+class TimedFile(io.FileIO):
+    """
+    File measuring the time spent writing to disk (in seconds), and the number of bytes written, and hashing them
+    """
+    seconds = 0
+    written = 0
+
 
-    # transforming markdown to HTML
-    text = markdown2.markdown(text)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.hash = hashlib.sha256()
 
-    # converting linebreaks to HTML
-    text = text.replace('\n\n', '</p><p>')
-    text = text.replace('\n', '<br>')
-    
-    # removing the last <br> that is here for a weird reason
-    if text[-4:] == '<br>':
-        text = text[:-4]
 
-    return text
+    def write(self, b):
+        start = time.perf_counter()
+        written = super().write(b)
+        self.seconds += time.perf_counter()-start
+        self.written += written
+        self.hash.update(b[:written])
+        return written
 
 
-def connect_to_submission(submission_id, token):
+# -------------------------- #
+# Functions                  #
+# -------------------------- #
+
+def connect_to_submission(submission_id, token, sort=None):
     """
     Initiates "connection" to submission and returns the submission object.
+    If sort is given, the comments of the submission will be sorted that way.
     """
-    reddit = praw.Reddit(client_id=config['reddit']['client-id'], client_secret=config['reddit']['client-secret'], refresh_token=token, user_agent=config['reddit']['agent'])
+    reddit = clients.get(token)
     submission = reddit.submission(id=submission_id)
+    if sort is not None:
+        submission.comment_sort = sort
     log.info(f'Submission ID: {submission_id}')
     nb_replies = submission.num_comments
     return submission, nb_replies
 
 
-def download_submission(submission, submission_id):
+def served_output(db, job_id):
+    """
+    Returns the job whose file a job can take, or None: the job it was attached to (see models.create_job), if it succeeded
+    and its file is still in the output directory. The file is only given once the submission has been read with the token of the job.
+    """
+    job = models.read_job(db, job_id)
+    if job == "notfound" or job['served_by'] is None:
+        return None
+    leader = models.read_job(db, job['served_by'])
+    if leader == "notfound" or leader['status'] != "success" or not os.path.exists(os.path.join(config['paths']['output'], leader['filename'])):
+        return None
+    return leader
+
+
+def download_submission(submission, submission_id, progress=None):
     """
     Retrieves the submission and its comments from Reddit API.
-    Returns two lists, one being a flat list of comments with their attributes (comments_forest), the other one being the tree structure of the submission (comments_index)
+    Returns two structures, one being a flat list of comments with their attributes (comments_forest), the other one being the tree structure of the submission (comments_index)
+    Both are indexed the same way: comments_forest[i] holds the attributes of the node i of the tree.
+    The progress of the download is recorded with progress (see JobProgress), if given.
     """
-    # Contains all the node objects (for the tree structure)
-    comments_index = {}
-    # Contains all the comment objects
-    comments_forest = {}
+    if progress is None:
+        progress = JobProgress()
 
-    # Creating root node: the submission itself
-    comments_index['t3_'+submission_id] = Node('t3_'+submission_id)
+    # Tree structure, whose root node is the submission itself
+    comments_index = CommentTree('t3_'+submission_id)
+    # Contains all the comment records (the first one stands for the submission, which has none)
+    comments_forest = [None]
 
     # Getting all comments in tree order, according to the sorting algorithm defined.
     # See https://praw.readthedocs.io/en/latest/tutorials/comments.html#extracting-comments
-    submission.comments.replace_more(limit=None)
+    if config['app'].get('fetch-workers', 0) > 1:
+        submission, comments_index, comments_forest = download_submission_parallel(submission, submission_id, config['app']['fetch-workers'], progress=progress)
+        index_submission(submission, submission_id, comments_index, comments_forest, progress=progress)
+        store_raw(submission, submission_id, comments_index, comments_forest, progress=progress)
+        return submission, comments_index, comments_forest
+    with progress.phase('replace_more'):
+        submission.comments.replace_more(limit=None)
 
     # Filling index and forest
-    comment_queue = submission.comments[:] 
+    comment_queue = collections.deque(submission.comments)
+
+    # Detaching the comments from the submission object: that way, each PRAW comment can be
+    # garbage-collected as soon as it has been extracted, instead of living until the end of the job
+    submission.comments._update([])
+    submission._comments_by_id = {}
+
+    with progress.phase('tree_build'):
+        while comment_queue:
+            comment = comment_queue.popleft()
+            comments_index.add('t1_'+comment.id, comment.parent_id)
+            comments_forest.append(extract_comment(comment))
+            comment_queue.extend(comment.replies)
+            if (len(comments_forest)-1) % PROGRESS_INTERVAL == 0:
+                progress.fetched(len(comments_forest)-1, submission.num_comments)
+        progress.fetched(len(comments_forest)-1, submission.num_comments)
+
+    index_submission(submission, submission_id, comments_index, comments_forest, progress=progress)
+    store_raw(submission, submission_id, comments_index, comments_forest, progress=progress)
+    return submission, comments_index, comments_forest
+
+
+def index_submission(submission, submission_id, comments_index, comments_forest, start=1, progress=None):
+    """
+    Adds the comments (from the node "start" of the tree) to the full-text index, if it is enabled (see app.search-index and search.index_comments)
+    """
+    if not config['app'].get('search-index', False):
+        return
+    if progress is None:
+        progress = JobProgress()
+    with progress.phase('index'):
+        written = search.index_comments(submission, submission_id, comments_index, comments_forest, start=start)
+    log.info(f'Submission ID: {submission_id}: {written} comments added or updated in the search index')
+
+
+def allow_search(submission_id, token):
+    """
+    Lets the requestors using this token find the comments of the submission in the full-text index, if it is enabled (see search.allow).
+    Anonymous jobs (cli.py without token) give nobody access, as searches need a token.
+    """
+    if not config['app'].get('search-index', False) or token is None:
+        return
+    search.allow(submission_id, token)
+
+
+def download_submission_parallel(submission, submission_id, workers, progress=None):
+    """
+    Same as download_submission, but the "load more comments" stubs are expanded by several requests
+    to Reddit at the same time (see fetcher.MoreChildrenFetcher), instead of one after the other by PRAW.
+    """
+    if progress is None:
+        progress = JobProgress()
+
+    # Comments that are known, by parent: lists of (order, fullname, record)
+    children = collections.defaultdict(list)
+    stubs = []
+
+    with progress.phase('replace_more'):
+        # Walking the comments loaded with the submission, and noting the stubs
+        comment_queue = collections.deque(submission.comments)
+        submission.comments._update([])
+        submission._comments_by_id = {}
+        position = 0
+        while comment_queue:
+            comment = comment_queue.popleft()
+            if isinstance(comment, praw.models.MoreComments):
+                stubs.append((comment.parent_id, list(comment.children)))
+                continue
+            position += 1
+            children[comment.parent_id].append(((0, position), 't1_'+comment.id, extract_comment(comment)))
+            comment_queue.extend(comment.replies)
+
+        # Fetching what is behind the stubs
+        reddit = submission._reddit
+        fetcher = MoreChildrenFetcher(reddit._core._authorizer._authenticator._requestor.oauth_url, config['reddit']['agent'], lambda expired: access_token(reddit, expired), submission.fullname, sort=submission.comment_sort, workers=workers, budget=clients.budget(reddit))
+        for parent_id, order, data in fetcher.expand(stubs):
+            children[parent_id].append((order, data['name'], record_from_json(data)))
+            position += 1
+            if position % PROGRESS_INTERVAL == 0:
+                progress.fetched(position, submission.num_comments, other_requests=fetcher.nb_requests)
+        log.info(f'Submission ID: {submission_id}: {len(stubs)} "load more comments" stubs expanded with {fetcher.nb_requests} requests')
+
+    with progress.phase('tree_build'):
+        # Building the tree from the root, each comment coming after its parent and its previous siblings
+        comments_index = CommentTree('t3_'+submission_id)
+        comments_forest = [None]
+        node_queue = collections.deque(['t3_'+submission_id])
+        while node_queue:
+            parent_id = node_queue.popleft()
+            for order, name, record in sorted(children.pop(parent_id, ()), key=lambda child: child[0]):
+                if name in comments_index: # sent twice by Reddit
+                    continue
+                comments_index.add(name, parent_id)
+                comments_forest.append(record)
+                node_queue.append(name)
+        progress.fetched(len(comments_forest)-1, submission.num_comments, other_requests=fetcher.nb_requests)
+
+    return submission, comments_index, comments_forest
+
+
+def access_token(reddit, expired=False):
+    """
+    Returns the OAuth access token PRAW uses, getting a new one if it expired (or if expired is True: it was refused by Reddit)
+    """
+    authorizer = reddit._core._authorizer
+    # Called by the threads of the fetcher at the same time
+    with clients.lock(reddit):
+        if expired or not authorizer.is_valid():
+            authorizer.refresh()
+        return authorizer.access_token
+
+
+def refresh_submission(submission, comments_index, comments_forest):
+    """
+    Completes a stored snapshot with the comments present on the first page of the submission, without expanding the "load more comments" links.
+    With the submission sorted by new, this catches most comments posted since the snapshot was taken (but not the replies hidden deep in long threads).
+    Returns the number of comments added.
+    """
+    added = 0
+    comment_queue = collections.deque(submission.comments)
     while comment_queue:
-        comment = comment_queue.pop(0)
-        comments_index['t1_'+comment.id] = Node('t1_'+comment.id, parent=comments_index[comment.parent_id])
-        comments_forest['t1_'+comment.id] = {'a': '(deleted)' if comment.author is None else comment.author.name, 'b': '(deleted)' if comment.body is None else comment.body, 'd': comment.distinguished, 'e': comment.edited, 'l': comment.permalink ,'o': comment.is_submitter, 's': comment.score, 't': comment.created_utc}
+        comment = comment_queue.popleft()
+        if isinstance(comment, praw.models.MoreComments):
+            continue
+
+        name = 't1_'+comment.id
+        if name not in comments_index and comment.parent_id in comments_index:
+            comments_index.add(name, comment.parent_id)
+            comments_forest.append(extract_comment(comment))
+            added += 1
         comment_queue.extend(comment.replies)
 
-    return submission, comments_index, comments_forest
+    return added
 
 
-def generate_html(submission, submission_id, now_str, sort, comments_index, comments_forest):
+def load_snapshot(db, submission_id):
     """
-    Generates HTML structure with the submission, its replies and all its info in it.
-    Note: As now, "sort" is unused. Todo?
+    Rebuilds the tree structure and the comment list of a submission from its stored snapshot (see download_submission).
+    """
+    return tree_from_rows(submission_id, models.read_snapshot_comments(db, submission_id))
+
+
+def tree_from_rows(submission_id, rows):
+    """
+    Rebuilds the tree structure and the comment list of a submission from rows in the format of snapshot_rows
+    """
+    comments_index = CommentTree('t3_'+submission_id)
+    comments_forest = [None]
+    for name, parent, author, body, distinguished, edited, permalink, is_submitter, score, created_utc in rows:
+        comments_index.add(name, parent)
+        comments_forest.append(CommentRecord(author, body, distinguished, False if edited is None else edited, permalink, bool(is_submitter), score, created_utc))
+    return comments_index, comments_forest
+
+
+def store_raw(submission, submission_id, comments_index, comments_forest, progress=None):
+    """
+    Stores the raw data of the submission and its comments (if enabled, see app.raw-data and rawstore), so that its files can be generated again without Reddit
+    """
+    if not config['app'].get('raw-data', False):
+        return
+    if progress is None:
+        progress = JobProgress()
+    with progress.phase('store_raw'):
+        fetched_at = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+        rawstore.write(rawstore.submission_data(submission), snapshot_rows(comments_index, comments_forest), fetched_at, rawstore.path(submission_id))
+    log.info(f'Submission ID: {submission_id}: raw data stored ({len(comments_index)-1} comments)')
+
+
+def load_raw(submission_id):
+    """
+    Rebuilds a submission, its tree structure and its comment list from its stored raw data (see store_raw).
+    Returns them along with the time they were downloaded.
+    """
+    with rawstore.RawSnapshot(rawstore.path(submission_id)) as snapshot:
+        comments_index, comments_forest = tree_from_rows(submission_id, snapshot.rows())
+        return rawstore.submission_object(snapshot.submission), comments_index, comments_forest, snapshot.fetched_at
+
+
+def snapshot_rows(comments_index, comments_forest, start=1):
+    """
+    Converts the comments (from the node "start" of the tree) into rows to be stored by models.write_snapshot
+    """
+    for node in range(start, len(comments_index)):
+        comment = comments_forest[node]
+        yield (comments_index.names[node], comments_index.names[comments_index.parent[node]], comment.author, comment.body, comment.distinguished, None if comment.edited is False else comment.edited, comment.permalink, comment.is_submitter, comment.score, comment.created_utc)
+
+
+def extract_comment(comment):
+    """
+    Extracts the attributes we need from a PRAW comment
+    """
+    return CommentRecord('(deleted)' if comment.author is None else comment.author.name, '(deleted)' if comment.body is None else comment.body, comment.distinguished, comment.edited, comment.permalink, comment.is_submitter, comment.score, comment.created_utc)
+
+
+def record_from_json(data):
+    """
+    Same as extract_comment, for a comment given as JSON by Reddit API
+    """
+    return CommentRecord('(deleted)' if data.get('author') in (None, '[deleted]') else data['author'], '(deleted)' if data.get('body') is None else data['body'], data.get('distinguished'), data.get('edited', False), data['permalink'], data.get('is_submitter', False), data.get('score'), data['created_utc'])
+
+
+def submission_header(submission, submission_id, now_str, sort, style=''):
+    """
+    Returns the beginning of the HTML document (<head> section, submission info and OP's post), as three fragments.
+    style is added to the stylesheet of the document.
     """
     # Beginning of file, with <head> section
-    html_head = f"""<!doctype html><html><head><meta charset="utf-8"/><title>{submission.subreddit.display_name} – {submission.title}</title><style>html{{font-family: 'Arial', 'Helvetica', sans-serif;font-size: 15px;box-sizing: border-box;}}div{{margin: 0px -5px 0px 0px;padding: 5px;}}header{{font-weight: bold;}}.f{{margin-top: 15px;}}.o{{background-color: #eaeaea;}}.e{{background-color: #fafafa;}}.l1{{border-left: 4px solid #3867d6;}}.l1 > header, .l1 > a, .l1 > header a{{color: #3867d6;}}.l2{{border-left: 4px solid #e74c3c;}}.l2 > header, .l2 > a, .l2 > header a{{color: #e74c3c;}}.l3{{border-left: 4px solid #20bf6b;}}.l3 > header, .l3 > a, .l3 > header a{{color: #20bf6b;}}.l4{{border-left: 4px solid #f7b731;}}.l4 > header, .l4 > a, .l4 > header a{{color: #f7b731;}}.l5{{border-left: 4px solid #9b59b6;}}.l5 > header, .l5 > a, .l5 > header a{{color: #9b59b6;}}.l6{{border-left: 4px solid #fa8231;}}.l6 > header, .l6 > a, .l6 > header a{{color: #fa8231;}}.l7{{border-left: 4px solid #a5b1c2;}}.l7 > header, .l7 > a, .l7 > header a{{color: #a5b1c2;}}.l8{{border-left: 4px solid #4b6584;}}.l8 > header, .l8 > a, .l8 > header a{{color: #4b6584;}}.l9{{border-left: 4px solid #0fb9b1;}}.l9 > header, .l9 > a, .l9 > header a{{color: #0fb9b1;}}.l0{{border-left: 4px solid #fd79a8;}}.l0 > header, .l0 > a, .l0 > header a{{color: #fd79a8;}}.m{{background-color: #c8ffc8;}}.a{{background-color: #ffdcd2;}}.p{{background-color: #b4c8ff;}}.n{{text-decoration: none;}}.D{{cursor:not-allowed!important;color:#ccc!important;}}</style></head><body>"""
+    html_head = f"""<!doctype html><html><head><meta charset="utf-8"/><title>{submission.subreddit.display_name} – {submission.title}</title><style>{HTML_STYLE}{style}</style></head><body>"""
 
     # Header of file, with submission info
     html_submission = f"""<h1><a href="{config['reddit']['root']}/r/{submission.subreddit.display_name}/">/r/{submission.subreddit.display_name}</a> – <a href="{config['reddit']['root']}{submission.permalink}">{submission.title}</a></h1><h2>Snapshot taken on {now_str}<br/>Posts: {submission.num_comments} – Score: {submission.score} ({int(submission.upvote_ratio*100)}% upvoted) – Flair: {'None' if submission.link_flair_text is None else submission.link_flair_text} – Sorted by: {sort}<br/>Sticky: {'No' if submission.stickied is False else 'Yes'} – Spoiler: {'No' if submission.spoiler is False else 'Yes'} – NSFW: {'No' if submission.over_18 is False else 'Yes'} – OC: {'No' if submission.is_original_content is False else 'Yes'} – Locked: {'No' if submission.locked is False else 'Yes'}</h2><p><em>Snapshot taken from <a href="{config['app']['url']}">{config['app']['name']}</a> v{config['app']['version']}. All times are UTC.</em></p>"""
@@ -93,168 +421,547 @@ def generate_html(submission, submission_id, now_str, sort, comments_index, comm
     # First comment (which is actually OP's post)
     html_firstpost = f"""<h3>Original post</h3><div class="b p f l1" id="t3_{submission_id}"><header><a href="{config['reddit']['root']}/u/{'(deleted)' if submission.author is None else submission.author.name}">{'(deleted)' if submission.author is None else submission.author.name}</a>, on {datetime.datetime.fromtimestamp(submission.created_utc).strftime(config["defaults"]["dateformat"])}</header>{commentParser(submission.selftext)}</div><h3>Comments</h3>"""
 
-    # Iterating through the tree to put comments in right order
+    return html_head, html_submission, html_firstpost
+
+
+def comment_classes(level, distinguished, is_submitter):
+    """
+    Returns the CSS classes of a comment in the classic HTML format
+    """
+    # If first-level comment, we put a margin
+    classes = 'f ' if level == 1 else ''
 
-    html_comments = ''
+    if distinguished == 'admin':
+        classes += 'a ' # Distinguished administrator post color
+    elif distinguished == 'moderator':
+        classes += 'm ' # Distinguished moderator post color
+    elif is_submitter:
+        classes += 'p ' #  OP post color
+    elif level % 2 == 0:
+        classes += 'e ' # Even post color
+    else:
+        classes += 'o ' # Odd post color
+
+    # Post level
+    return classes+'l'+str(level)[-1] # only taking the last digit
+
+
+def generate_html(submission, submission_id, now_str, sort, comments_index, comments_forest, stats=None, progress=None):
+    """
+    Generates HTML structure with the submission, its replies and all its info in it.
+    This is a generator: the HTML is yielded fragment by fragment as the tree is walked, so the whole document never has to be held in memory.
+    If a Counter is given as stats, rendering statistics (cache hits and misses) are added to it.
+    The progress of the rendering is recorded with progress (see JobProgress), if given.
+    Note: As now, "sort" is unused. Todo?
+    """
+    html_head, html_submission, html_firstpost = submission_header(submission, submission_id, now_str, sort)
+
+    if progress is None:
+        progress = JobProgress()
+
+    yield html_head
+    yield html_submission
+    yield html_firstpost
+
+    # Comment bodies are rendered ahead of the walk (possibly in other processes), in the order they will be needed
+    rendered_bodies = render_bodies((comments_forest[node].body for node in comments_index.walk()), processes=config['app'].get('render-processes', 0), cache=render_cache, stats=stats)
+
+    # Values used for every comment, looked up once
+    root = config['reddit']['root']
+    format_date = DateFormatter(config["defaults"]["dateformat"])
+    names, depths, parents = comments_index.names, comments_index.depth, comments_index.parent
+    previous_siblings, next_siblings = comments_index.previous_sibling, comments_index.next_sibling
+    nb_comments = len(comments_index)-1
+    # CSS classes of the comments, by (level, distinguished, is_submitter)
+    classes_cache = {}
+
+    # Iterating through the tree to put comments in right order
     previous_comment_level = 1 # We begin at level 1.
     comment_counter = 1 # Comment counter
 
-    #for comment in generator:
-    for node in PreOrderIter(comments_index['t3_'+submission_id]):
-        current_comment_level = node.depth
-        current_comment_id = node.name
-
-        if node.name[:2] == 't3': # root is the submission itself, we ignore it
-            continue
+    # The root node (the submission itself) is not part of the walk
+    for node in comments_index.walk():
+        current_comment_level = depths[node]
+        current_comment_id = names[node]
+        comment = comments_forest[node]
 
         # We close as much comments as we need to.
         # Is this is a sibling (= same level), we just close one comment.
         # If this is on another branch, we close as much comments as we need to to close the branch.
         if current_comment_level <= previous_comment_level:
-            for i in range(0, previous_comment_level-current_comment_level+1):
-                html_comments += '</div>'
+            closing = '</div>'*(previous_comment_level-current_comment_level+1)
+        else:
+            closing = ''
 
         # CSS classes to be applied.
-        classes = ''
-
-        # If first-level comment, we put a margin
-        if current_comment_level == 1:
-            classes += 'f '
-
-        if comments_forest[current_comment_id]['d'] == 'admin':
-            classes += 'a ' # Distinguished administrator post color
-        elif comments_forest[current_comment_id]['d'] == 'moderator':
-            classes += 'm ' # Distinguished moderator post color
-        elif comments_forest[current_comment_id]['o']:
-            classes += 'p ' #  OP post color
-        elif current_comment_level % 2 == 0:
-            classes += 'e ' # Even post color
+        classes_key = (current_comment_level, comment.distinguished, comment.is_submitter)
+        classes = classes_cache.get(classes_key)
+        if classes is None:
+            classes = comment_classes(*classes_key)
+            classes_cache[classes_key] = classes
+
+        # Getting parents and siblings for easy navigation ("D": class "disabled" for first and last siblings)
+        previous_sibling_node = previous_siblings[node]
+        if previous_sibling_node == NONE:
+            previous_sibling, previous_sibling_d = '', ' D'
         else:
-            classes += 'o ' # Odd post color
+            previous_sibling, previous_sibling_d = names[previous_sibling_node], ''
 
-        # Post level
-        classes += 'l'+str(current_comment_level)[-1] # only taking the last digit
-        html_comments += f'<div class="{classes}" id="{current_comment_id}">'
+        next_sibling_node = next_siblings[node]
+        if next_sibling_node == NONE:
+            next_sibling, next_sibling_d = '', ' D'
+        else:
+            next_sibling, next_sibling_d = names[next_sibling_node], ''
 
-        # Getting parents and siblings for easy navigation
-        try:
-            previous_sibling = anytree_util.leftsibling(node).name
-            previous_sibling_d = ''
-        except AttributeError: # first sibling
-            previous_sibling = ''
-            previous_sibling_d = ' D' # class "disabled" for first and last siblings
+        # Adding the comment to the list
+        yield f"""{closing}<div class="{classes}" id="{current_comment_id}"><header><a href="{root}/u/{comment.author}">{comment.author}</a>, on <a href="{root}{comment.permalink}">{format_date(comment.created_utc)}</a> ({comment.score}{'' if comment.edited is False else ', edited'}) <a href="#{names[parents[node]]}" class="n P">▣</a> <a href="#{previous_sibling}" class="n A{previous_sibling_d}">🠉</a> <a href="#{next_sibling}" class="n B{next_sibling_d}">🠋</a> <a href="#{current_comment_id}" class="n S">◯</a></header>{next(rendered_bodies)}"""
 
-        try:
-            next_sibling = anytree_util.rightsibling(node).name
-            next_sibling_d = ''
-        except AttributeError: # last sibling
-            next_sibling = ''
-            next_sibling_d = ' D'
+        previous_comment_level = current_comment_level
+        if comment_counter % PROGRESS_INTERVAL == 0:
+            progress.rendered(comment_counter, nb_comments)
+        comment_counter += 1
 
-        parent = node.parent.name
+    progress.rendered(comment_counter-1, len(comments_index)-1)
 
-        time_comment = datetime.datetime.fromtimestamp(comments_forest[current_comment_id]['t'])
-        time_comment_str = time_comment.strftime(config["defaults"]["dateformat"])
+    yield HTML_JS
 
-        # Adding the comment to the list
-        html_comments += f"""<header><a href="{config['reddit']['root']}/u/{comments_forest[current_comment_id]['a']}">{comments_forest[current_comment_id]['a']}</a>, on <a href="{config['reddit']['root']}{comments_forest[current_comment_id]['l']}">{time_comment_str}</a> ({comments_forest[current_comment_id]['s']}{'' if comments_forest[current_comment_id]['e'] is False else ', edited'}) <a href="#{parent}" class="n P">▣</a> <a href="#{previous_sibling}" class="n A{previous_sibling_d}">🠉</a> <a href="#{next_sibling}" class="n B{next_sibling_d}">🠋</a> <a href="#{current_comment_id}" class="n S">◯</a></header>{commentParser(comments_forest[current_comment_id]['b'])}"""
-        
-        previous_comment_level = current_comment_level
+
+def generate_lazy_html(submission, submission_id, now_str, sort, comments_index, comments_forest, stats=None, progress=None):
+    """
+    Same as generate_html, for very large submissions: instead of being written as HTML, comments are embedded as chunks of JSON records
+    (whole top-level branches, about LAZY_CHUNK_SIZE comments per chunk), that the browser only turns into HTML as the reader scrolls down.
+    The page stays light and is shown as soon as the first chunk is rendered, whatever the size of the submission.
+    Each record is [id, level, author, permalink, date, score, edited, color, body], color being "a" (admin), "m" (moderator), "p" (OP) or "".
+    """
+    html_head, html_submission, html_firstpost = submission_header(submission, submission_id, now_str, sort, style=LAZY_STYLE)
+
+    if progress is None:
+        progress = JobProgress()
+
+    yield html_head
+    yield html_submission
+    yield html_firstpost
+
+    # Splitting the top-level branches in chunks: the browser needs to know the first and last top-level comments of each chunk,
+    # so that siblings can be navigated from one chunk to another
+    chunks = []
+    chunk_size = LAZY_CHUNK_SIZE
+    for node in comments_index.walk():
+        if comments_index.depth[node] == 1:
+            if chunk_size >= LAZY_CHUNK_SIZE:
+                chunks.append([comments_index.names[node], comments_index.names[node]])
+                chunk_size = 0
+            else:
+                chunks[-1][1] = comments_index.names[node]
+        chunk_size += 1
+    chunk_starts = set(first for first, last in chunks)
+
+    yield '<div id="comments"></div><div id="more"></div>'
+    yield f'<script type="application/json" id="archive">{json_for_script({"root": "t3_"+submission_id, "reddit": config["reddit"]["root"], "chunks": chunks})}</script>'
+
+    # Comment bodies are rendered ahead of the walk (possibly in other processes), in the order they will be needed
+    rendered_bodies = render_bodies((comments_forest[node].body for node in comments_index.walk()), processes=config['app'].get('render-processes', 0), cache=render_cache, stats=stats)
+
+    format_date = DateFormatter(config["defaults"]["dateformat"])
+    names, depths = comments_index.names, comments_index.depth
+    records = []
+    chunk_number = 0
+    comment_counter = 1
+    for node in comments_index.walk():
+        current_comment_id = names[node]
+        if current_comment_id in chunk_starts and records:
+            yield f'<script type="application/json" id="c{chunk_number}">{json_for_script(records)}</script>'
+            if chunk_number == 0:
+                yield LAZY_JS
+            records = []
+            chunk_number += 1
+
+        comment = comments_forest[node]
+        if comment.distinguished == 'admin':
+            color = 'a'
+        elif comment.distinguished == 'moderator':
+            color = 'm'
+        elif comment.is_submitter:
+            color = 'p'
+        else:
+            color = ''
+        records.append((current_comment_id, depths[node], comment.author, comment.permalink, format_date(comment.created_utc), comment.score, 0 if comment.edited is False else 1, color, next(rendered_bodies)))
+
+        if comment_counter % PROGRESS_INTERVAL == 0:
+            progress.rendered(comment_counter, len(comments_index)-1)
+        comment_counter += 1
+
+    if records:
+        yield f'<script type="application/json" id="c{chunk_number}">{json_for_script(records)}</script>'
+    if chunk_number == 0:
+        yield LAZY_JS
+    progress.rendered(comment_counter-1, len(comments_index)-1)
+
+
+def json_for_script(data):
+    """
+    Serializes data as JSON that can be embedded in a <script> element (which would be closed by any "</" in it)
+    """
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/').replace('<!--', '<\\u0021--')
+
+
+def comment_data(comments_index, comments_forest):
+    """
+    Yields the node of each comment along with its data as a dict (with the IDs of the comment and of its parent, and its depth),
+    in the order of the tree: parents always come before their children.
+    """
+    names, depths, parents = comments_index.names, comments_index.depth, comments_index.parent
+    for node in comments_index.walk():
+        comment = comments_forest[node]
+        yield node, {'id': names[node], 'parent_id': names[parents[node]], 'depth': depths[node], 'author': comment.author, 'body': comment.body, 'score': comment.score, 'created_utc': comment.created_utc, 'edited': comment.edited, 'distinguished': comment.distinguished, 'is_submitter': comment.is_submitter, 'permalink': comment.permalink}
+
+
+def generate_ndjson(submission, submission_id, now_str, sort, comments_index, comments_forest, stats=None, progress=None):
+    """
+    Generates the comments as JSON Lines (NDJSON): one JSON object per comment and per line, parents before their children.
+    Bodies are given as they are sent by Reddit (markdown). Like generate_html, this is a generator.
+    """
+    if progress is None:
+        progress = JobProgress()
+
+    comment_counter = 1
+    for node, data in comment_data(comments_index, comments_forest):
+        yield json.dumps(data, ensure_ascii=False, separators=(',', ':'))+'\n'
+        if comment_counter % PROGRESS_INTERVAL == 0:
+            progress.rendered(comment_counter, len(comments_index)-1)
         comment_counter += 1
 
-    # JS managing scrolling features
-    html_js = '<script>function checkKey(e){"38"==(e=e||window.event).keyCode?(e.preventDefault(),scrollToSibling("A")):"40"==e.keyCode?(e.preventDefault(),scrollToSibling("B")):"37"!=e.keyCode&&"80"!=e.keyCode||scrollToParent()}function scrollToSibling(e){var o,t=window.location.hash.substr(1),n=document.getElementById(t).getElementsByClassName(e)[0];n.classList.contains("D")||(o=n.getAttribute("href").substr(1),document.getElementById(o).scrollIntoView(!0),window.location.hash=o)}function scrollToParent(){var e=window.location.hash.substr(1);document.getElementById(e).parentNode.id.scrollIntoView(!0),window.location.hash=target_id}document.onkeydown=checkKey;</script>'
+    progress.rendered(comment_counter-1, len(comments_index)-1)
+
+
+def generate_markdown(submission, submission_id, now_str, sort, comments_index, comments_forest, stats=None, progress=None):
+    """
+    Generates the submission and its comments as a Markdown document: replies are quoted in their parent, one level of quote by level of reply.
+    Bodies are given as they are sent by Reddit (markdown). Like generate_html, this is a generator.
+    """
+    if progress is None:
+        progress = JobProgress()
+
+    root = config['reddit']['root']
+    format_date = DateFormatter(config["defaults"]["dateformat"])
+    author = '(deleted)' if submission.author is None else submission.author.name
+
+    yield f"""# [{submission.title}]({root}{submission.permalink})\n\n"""
+    yield f"""[/r/{submission.subreddit.display_name}]({root}/r/{submission.subreddit.display_name}/) – Snapshot taken on {now_str} – Posts: {submission.num_comments} – Score: {submission.score} ({int(submission.upvote_ratio*100)}% upvoted) – Flair: {'None' if submission.link_flair_text is None else submission.link_flair_text}\n\n"""
+    yield f"""*Snapshot taken from [{config['app']['name']}]({config['app']['url']}) v{config['app']['version']}. All times are UTC.*\n\n"""
+    yield f"""## Original post\n\n**[{author}]({root}/u/{author})**, on {format_date(submission.created_utc)}\n\n{submission.selftext}\n\n## Comments\n\n"""
+
+    comment_counter = 1
+    for node, data in comment_data(comments_index, comments_forest):
+        # Replies are quoted: every line of the comment (empty ones included, so that the quote is not interrupted) starts with the quote marks of its level
+        quote = '> '*(data['depth']-1)
+        header = f"""**[{data['author']}]({root}/u/{data['author']})**, on [{format_date(data['created_utc'])}]({root}{data['permalink']}) ({data['score']}{'' if data['edited'] is False else ', edited'})"""
+        lines = [header, '']+data['body'].split('\n')
+        yield ''.join(f'{quote}{line}\n' if line else f'{quote.rstrip()}\n' for line in lines)+'\n'
+        if comment_counter % PROGRESS_INTERVAL == 0:
+            progress.rendered(comment_counter, len(comments_index)-1)
+        comment_counter += 1
 
-    # Merging this all together
-    html_total = html_head+html_submission+html_firstpost+html_comments+html_js
+    progress.rendered(comment_counter-1, len(comments_index)-1)
 
-    return html_total
+
+def generate_sqlite(submission, submission_id, now_str, sort, comments_index, comments_forest, stats=None, progress=None):
+    """
+    Generates a standalone SQLite database with the submission (table "submission") and its comments (table "comments", in the order of the tree).
+    The database is built in a temporary file, then yielded by blocks of bytes. Like generate_html, this is a generator.
+    """
+    if progress is None:
+        progress = JobProgress()
+
+    descriptor, path = tempfile.mkstemp(prefix='redditarchiver-', suffix='.sqlite3')
+    os.close(descriptor)
+    try:
+        base = sqlite3.connect(path)
+        try:
+            cursor = base.cursor()
+            # The file is thrown away if anything fails: no need for a journal
+            cursor.execute('PRAGMA journal_mode=OFF')
+            cursor.execute('PRAGMA synchronous=OFF')
+            cursor.execute('CREATE TABLE "submission" ("id" TEXT, "subreddit" TEXT, "title" TEXT, "author" TEXT, "selftext" TEXT, "permalink" TEXT, "num_comments" INTEGER, "score" INTEGER, "upvote_ratio" REAL, "created_utc" REAL, "snapshot" TEXT, PRIMARY KEY("id"))')
+            cursor.execute('CREATE TABLE "comments" ("position" INTEGER, "id" TEXT, "parent_id" TEXT, "depth" INTEGER, "author" TEXT, "body" TEXT, "score" INTEGER, "created_utc" REAL, "edited" REAL, "distinguished" TEXT, "is_submitter" INTEGER, "permalink" TEXT, PRIMARY KEY("position"))')
+            cursor.execute('INSERT INTO submission VALUES (:id, :subreddit, :title, :author, :selftext, :permalink, :num_comments, :score, :upvote_ratio, :created_utc, :snapshot)', {'id': 't3_'+submission_id, 'subreddit': submission.subreddit.display_name, 'title': submission.title, 'author': '(deleted)' if submission.author is None else submission.author.name, 'selftext': submission.selftext, 'permalink': submission.permalink, 'num_comments': submission.num_comments, 'score': submission.score, 'upvote_ratio': submission.upvote_ratio, 'created_utc': submission.created_utc, 'snapshot': now_str})
+
+            def rows():
+                for position, (node, data) in enumerate(comment_data(comments_index, comments_forest), start=1):
+                    data['position'] = position
+                    data['edited'] = None if data['edited'] is False else data['edited']
+                    yield data
+                    if position % PROGRESS_INTERVAL == 0:
+                        progress.rendered(position, len(comments_index)-1)
+
+            # Rows are inserted as they are generated, never all held in memory
+            cursor.executemany('INSERT INTO comments VALUES (:position, :id, :parent_id, :depth, :author, :body, :score, :created_utc, :edited, :distinguished, :is_submitter, :permalink)', rows())
+            cursor.execute('CREATE INDEX "comments_parent_id" ON "comments" ("parent_id")')
+            base.commit()
+        finally:
+            base.close()
+        progress.rendered(len(comments_index)-1, len(comments_index)-1)
+
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(WRITE_BUFFER_SIZE)
+                if not block:
+                    break
+                yield block
+    finally:
+        os.remove(path)
+
+
+# Output formats (see app.output-format): function generating the file (as fragments of text, or as blocks of bytes for binary formats),
+# extension and media type of the files. Other formats can be added here: their function takes the same arguments as generate_html.
+EXPORTERS = {
+    'html': (generate_html, '.html', 'text/html'),
+    'lazy': (generate_lazy_html, '.html', 'text/html'),
+    'ndjson': (generate_ndjson, '.ndjson', 'application/x-ndjson'),
+    'markdown': (generate_markdown, '.md', 'text/markdown'),
+    'sqlite': (generate_sqlite, '.sqlite3', 'application/vnd.sqlite3'),
+}
+# "auto" is html or lazy, depending on the size of the submission
+OUTPUT_FORMATS = tuple(EXPORTERS)+('auto',)
+
+
+def mimetype(filename):
+    """
+    Returns the media type of an output file (compressed or not), from its name
+    """
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    return next((mimetype for generate, extension, mimetype in EXPORTERS.values() if filename.endswith(extension)), 'application/octet-stream')
 
 
-def write_file(content, submission, now, output_directory):
+def output_name(submission, now, extension='.html'):
     """
-    Writes the HTML content into a file. Returns the filename
+    Returns the name under which an output file is downloaded (files are stored under the hash of their content, see write_file)
     """
-    # keeping the submission name in URL
+    # keeping the submission name in URL
     sanitized_name = submission.permalink.split('/')[-2]
 
     # Reducing filename to 200 characters
     sanitized_name = (sanitized_name[:150]) if len(sanitized_name) > 150 else sanitized_name
-    path = os.path.join(output_directory, f"{submission.subreddit.display_name}-{sanitized_name}-{now.strftime('%Y%m%d-%H%M%S')}.html")
-    filename = f"{submission.subreddit.display_name}-{sanitized_name}-{now.strftime('%Y%m%d-%H%M%S')}.html"
+    return f"{submission.subreddit.display_name}-{sanitized_name}-{now.strftime('%Y%m%d-%H%M%S')}{extension}"
 
-    f = open(path, "wb")
-    f.write(content.encode('utf-8'))
-    f.close()
+
+def resolve_format(output_format, nb_comments):
+    """
+    Returns the format in which a submission of nb_comments comments is written: output_format, or app.output-format if it is None.
+    "auto" is the lazy HTML file above LAZY_AUTO_THRESHOLD comments, the full one below.
+    """
+    if output_format is None:
+        output_format = config['app'].get('output-format', 'html')
+    if output_format == 'auto':
+        output_format = 'lazy' if nb_comments > LAZY_AUTO_THRESHOLD else 'html'
+    return output_format
+
+
+def write_file(content, output_directory, stats=None, compression='none', extension='.html', db=None):
+    """
+    Writes the content into a file named after the hash of its content (and ending with extension). Returns the filename
+    If a database is given, the file is added to the index of output files (see models.store_file), so that it can be evicted.
+    "content" can be a string or an iterable of strings (such as the generator returned by generate_html), in which case each fragment is written as soon as it is produced.
+    Binary formats (see generate_sqlite) give blocks of bytes instead, which are written as they are.
+    If a Counter is given as stats, the time spent writing to disk is added to it (as "write_seconds").
+    With compression "gzip" or "zstd", the file is compressed as it is written, and its name ends with .gz or .zst.
+
+    The content is written in a temporary file, then renamed: identical content (such as the same submission generated twice from
+    its snapshot) is stored only once, in the same file.
+    """
+    if isinstance(content, str):
+        content = (content,)
+
+    # Fragments are small: they are grouped before being encoded, and the buffered writer groups them again into large writes to disk
+    descriptor, temporary_path = tempfile.mkstemp(dir=output_directory, prefix='.', suffix='.tmp')
+    raw = TimedFile(descriptor, "wb")
+    buffered = io.BufferedWriter(raw, buffer_size=WRITE_BUFFER_SIZE)
+    if compression == 'gzip':
+        # No name nor date in the gzip header, so that the same content always gives the same file
+        f = gzip.GzipFile(filename='', mode='wb', fileobj=buffered, compresslevel=GZIP_LEVEL, mtime=0)
+    elif compression == 'zstd':
+        f = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(buffered, closefd=False)
+    else:
+        f = buffered
+
+    try:
+        try:
+            batch = []
+            batch_size = 0
+            for fragment in content:
+                if isinstance(fragment, bytes):
+                    f.write(''.join(batch).encode('utf-8'))
+                    batch = []
+                    batch_size = 0
+                    f.write(fragment)
+                    continue
+                batch.append(fragment)
+                batch_size += len(fragment)
+                if batch_size >= WRITE_BATCH_SIZE:
+                    f.write(''.join(batch).encode('utf-8'))
+                    batch = []
+                    batch_size = 0
+            f.write(''.join(batch).encode('utf-8'))
+        finally:
+            f.close()
+            buffered.close()
+
+        filename = raw.hash.hexdigest()+extension+COMPRESSION_SUFFIXES.get(compression, '')
+        path = os.path.join(output_directory, filename)
+        if os.path.exists(path):
+            metrics.OUTPUT_DEDUPLICATED.inc()
+        # Replacing the file even if it exists: the content is the same, and it is then sure to be there (see evict_outputs)
+        if db is not None:
+            models.store_file(db, filename, os.path.getsize(temporary_path), temporary_path=temporary_path)
+        else:
+            os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    metrics.OUTPUT_BYTES.inc(raw.written)
+    if stats is not None:
+        stats['write_seconds'] += raw.seconds
 
     return filename
 
 
+def evict_outputs(db):
+    """
+    Removes the output files used least recently, until they fit in app.output-quota (in megabytes), and the ones unused
+    for app.output-max-age seconds. Files are found in their index in database (see models.store_file), without reading the directory.
+    Returns the number of files removed.
+    """
+    evicted = models.evict_files(db, config['paths']['output'], config['app'].get('output-quota', 0)*1024*1024, config['app'].get('output-max-age', 86400))
+    if evicted:
+        log.info(f'{len(evicted)} output file(s) evicted')
+    metrics.CLEANUP_REMOVED.inc(len(evicted), task='downloads')
+    return len(evicted)
+
+
 
 # -------------------------- #
 # Main function              #
 # -------------------------- #
 
-def main(submission_id, token, job_id, sort="confidence"):
+def main(submission_id, token, job_id, sort="confidence", output_format=None):
+    """
+    Runs a job: downloads the submission (or takes it from its stored snapshot), and writes it in output_format (one of OUTPUT_FORMATS,
+    defaults to app.output-format)
+    """
     try:
         db = models.connect()
-        models.start_job(db, job_id)
 
         now = datetime.datetime.now(datetime.timezone.utc)
         now_str = now.strftime(config["defaults"]["dateformat"])
 
+        # Jobs attached to another one, requested with another token, only check they can read the submission to take its file
+        leader = served_output(db, job_id)
+
+        # Submissions fetched recently are taken from the stored snapshots, possibly refreshed with the latest comments
+        archive_max_age = config['app'].get('archive-max-age', 600)
+        archive_refresh_max_age = config['app'].get('archive-refresh-max-age', 0)
+        snapshot = models.read_snapshot(db, submission_id) if max(archive_max_age, archive_refresh_max_age) > 0 else None
+        if snapshot is not None and now.timestamp()-snapshot['refreshed_at'] <= archive_max_age:
+            mode = 'stored'
+        elif snapshot is not None and now.timestamp()-snapshot['fetched_at'] <= archive_refresh_max_age:
+            mode = 'refresh'
+        else:
+            mode = 'full'
+
+        progress = JobProgress(db, job_id)
         try:
             # "Connecting" to submission and getting information
-            submission_api, nb_replies = connect_to_submission(submission_id, token)
+            with progress.phase('connect'):
+                submission_api, nb_replies = connect_to_submission(submission_id, token, sort='new' if mode == 'refresh' else None)
+            # The submission could be read with the token of the job: its comments can be searched with it
+            allow_search(submission_id, token)
+
+            if leader is not None:
+                # (nb_replies is read from Reddit, so the submission can be read)
+                log.info(f"{job_id}: submission readable with the token of the job ({nb_replies} comments), file of {leader['id']} taken")
+                models.touch_file(db, leader['filename'])
+                models.mark_job_success(db, job_id, filename=leader['filename'], download_name=leader['download_name'])
+                return
 
             # Marking right now the number of comments in DB so we can calculate estimated remaining time
             models.write_nb_replies(db, job_id, nb_replies=nb_replies)
-        
+
             # Getting the comment list and comment forest
-            submission, comments_index, comments_forest = download_submission(submission_api, submission_id)
+            if mode == 'full':
+                submission, comments_index, comments_forest = download_submission(submission_api, submission_id, progress=progress)
+                if max(archive_max_age, archive_refresh_max_age) > 0:
+                    models.write_snapshot(db, submission_id, snapshot_rows(comments_index, comments_forest), int(now.timestamp()))
+            else:
+                submission = submission_api
+                with progress.phase('snapshot'):
+                    comments_index, comments_forest = load_snapshot(db, submission_id)
+                if mode == 'refresh':
+                    stored = len(comments_index)
+                    with progress.phase('refresh'):
+                        added = refresh_submission(submission, comments_index, comments_forest)
+                    index_submission(submission, submission_id, comments_index, comments_forest, start=stored, progress=progress)
+                    store_raw(submission, submission_id, comments_index, comments_forest, progress=progress)
+                    models.write_snapshot(db, submission_id, snapshot_rows(comments_index, comments_forest, start=stored), int(now.timestamp()), append=True)
+                    log.info(f'{job_id}: snapshot refreshed ({added} new comments)')
+                else:
+                    now_str = datetime.datetime.fromtimestamp(snapshot['refreshed_at'], datetime.timezone.utc).strftime(config["defaults"]["dateformat"])
+                    log.info(f'{job_id}: submission taken from stored snapshot')
+                progress.fetched(len(comments_index)-1, nb_replies)
         except prawcore.exceptions.NotFound as e:
             log.error(f'{job_id}: prawcore.exceptions.NotFound ({e})')
+            models.rollback()
             models.mark_job_failure(db, job_id, reason='SUBMISSION_NOT_FOUND')
             return
         except prawcore.exceptions.ResponseException as e:
             log.error(f'{job_id}: prawcore.exceptions.ResponseException ({e})', exc_info=True)
+            models.rollback()
             models.mark_job_failure(db, job_id, reason='BAD_AUTHENTICATION')
             return
         else:
             log.info(f'{job_id}: submission downloaded')
 
-        # Generating HTML structure
-        while True: # allows to retry
-            try:
-                html = generate_html(submission, submission_id, now_str, None, comments_index, comments_forest)
-            except RecursionError:
-                if config["app"]["disable-recursion-limit"]:
-                    sys.setrecursionlimit(sys.getrecursionlimit()*2)
-                else:
-                    log.error(f"The HTML structure could not be generated because the structure of the replies is going too deep for the program to handle. If you really want to handle such submissions, set the parameter \"disable-recursion-limit\" to true in the configuration. However, please note that this may lead to higher resource usage, and might potentially crash the app.")
-                    models.mark_job_failure(db, job_id, reason='UNKNOWN')
-                    return
-            else:
-                log.info(f'{job_id}: submission structured')
-                break
-
-        # Saving to disk
+        # Generating HTML structure and saving it to disk at the same time
+        render_stats = collections.Counter()
         try:
-            filename = write_file(html, submission, now, config['paths']['output'])
+            # Rendering and writing are interleaved: both phases span the same time, but their durations are the time actually spent in each
+            started_at = time.time()
+            progress.start('write', started_at)
+            progress.start('render', started_at)
+            generate, extension, _ = EXPORTERS[resolve_format(output_format, len(comments_index)-1)]
+            content = generate(submission, submission_id, now_str, None, comments_index, comments_forest, stats=render_stats, progress=progress)
+            filename = write_file(content, config['paths']['output'], stats=render_stats, compression=output_compression, extension=extension, db=db)
+            finished_at = time.time()
+            progress.finish('render', started_at, finished_at, duration=finished_at-started_at-render_stats['write_seconds'])
+            progress.finish('write', started_at, finished_at, duration=render_stats['write_seconds'])
         except PermissionError as e:
             log.error(f'{job_id}: PermissionError when writing the file ({e})')
+            models.rollback()
             models.mark_job_failure(db, job_id, reason='BAD_PERMISSIONS')
             return
         except Exception as e:
             log.error(f'{job_id}: Uncaught exception when writing the file: {e}', exc_info=True)
+            models.rollback()
             models.mark_job_failure(db, job_id, reason='UNKNOWN')
             return
 
         log.info(f'{job_id}: submission saved ({filename})')
+        log.info(f"{job_id}: render cache: {render_stats['hits']} hits, {render_stats['misses']} misses, {render_stats['plain']} plain text bodies")
+        log.info(f"{job_id}: {progress.nb_requests} requests to Reddit, phases: " + ', '.join(f"{phase} {line['duration']:.2f}s" for phase, line in models.read_phases(db, job_id).items()))
+
+        models.mark_job_success(db, job_id, filename=filename, download_name=output_name(submission, now, extension))
 
-        models.mark_job_success(db, job_id, filename=filename)
+        # Making room for the next files (the one just written being the last to go)
+        try:
+            evict_outputs(db)
+        except Exception as e:
+            log.error(f'{job_id}: could not evict output files ({e})', exc_info=True)
     except Exception as e:
         # general catch
         log.error(f'{job_id}: Uncaught exception: {e}', exc_info=True)
+        models.rollback()
         models.mark_job_failure(db, job_id, reason='UNKNOWN')
         return
@@ -0,0 +1,49 @@
+# stdlib
+import collections, queue, threading
+
+
+# Maximum number of events waiting for a slow subscriber: older progress events are dropped first
+QUEUE_SIZE = 50
+
+# Subscribers (queues of events), by job ID
+_subscribers = collections.defaultdict(list)
+_lock = threading.Lock()
+
+
+def publish(job_id, event):
+    """
+    Sends an event (a dict with at least a "status" key) to everyone following a job
+    """
+    with _lock:
+        subscribers = list(_subscribers.get(job_id, ()))
+
+    for subscriber in subscribers:
+        while True:
+            try:
+                subscriber.put_nowait(event)
+                break
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+
+
+def subscribe(job_id):
+    """
+    Starts following a job. Returns a queue from which its events can be read.
+    """
+    subscriber = queue.Queue(maxsize=QUEUE_SIZE)
+    with _lock:
+        _subscribers[job_id].append(subscriber)
+    return subscriber
+
+
+def unsubscribe(job_id, subscriber):
+    """
+    Stops following a job
+    """
+    with _lock:
+        _subscribers[job_id].remove(subscriber)
+        if not _subscribers[job_id]:
+            del _subscribers[job_id]
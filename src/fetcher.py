@@ -0,0 +1,216 @@
+# Project modules
+import metrics
+
+# 3rd party modules
+import requests
+
+# stdlib
+import collections, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+log = logging.getLogger('redditarchiver_main')
+
+# Maximum number of comment IDs Reddit accepts in one /api/morechildren request
+MORECHILDREN_MAX_IDS = 100
+
+# Number of attempts for a request failing because of Reddit (5xx) or the network
+MAX_ATTEMPTS = 3
+
+
+class RateBudget:
+    """
+    Token bucket shared by concurrent requests, refilled from the rate-limit headers sent by Reddit.
+    Until Reddit has sent its first headers, "remaining" requests are allowed per "period" seconds.
+    """
+    def __init__(self, remaining=100, period=60):
+        self._condition = threading.Condition()
+        self.remaining = remaining
+        self.reset_at = time.monotonic()+period
+        self.in_flight = 0
+
+
+    def acquire(self):
+        """
+        Blocks until a request can be made
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self.remaining <= 0 and now >= self.reset_at and self.in_flight == 0:
+                    # The period is over: one request is let through to learn the new budget
+                    self.remaining = 1
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    self.in_flight += 1
+                    return
+                self._condition.wait(timeout=max(self.reset_at-now, 0.05))
+
+
+    def update(self, headers=None):
+        """
+        Releases a request previously acquired, and takes into account the budget given by its response headers (if any)
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if headers is not None and 'x-ratelimit-remaining' in headers:
+                # Requests still in flight were not counted by Reddit yet
+                self.remaining = int(float(headers['x-ratelimit-remaining']))-self.in_flight
+                self.reset_at = time.monotonic()+int(headers.get('x-ratelimit-reset', 0))
+            self._condition.notify_all()
+
+
+    def wait_for_reset(self, headers):
+        """
+        Empties the budget until the reset announced by Reddit, after a request was refused for rate limiting (429)
+        """
+        with self._condition:
+            self.remaining = 0
+            self.reset_at = time.monotonic()+int(headers.get('x-ratelimit-reset', 5))
+
+
+class MoreChildrenFetcher:
+    """
+    Expands the "load more comments" and "continue this thread" stubs of a submission, by running
+    several requests to Reddit at the same time within a shared rate-limit budget.
+
+    token_provider is a function returning the OAuth access token to use. It is called with expired=True
+    when Reddit refused the current one, and should then return a new one.
+    Once done, nb_requests holds the number of requests made to Reddit.
+    """
+    def __init__(self, base_url, user_agent, token_provider, link_id, sort="confidence", workers=4, budget=None):
+        self.base_url = base_url.rstrip('/')
+        self.link_id = link_id
+        self.sort = sort
+        self.workers = workers
+        self.budget = RateBudget() if budget is None else budget
+        self.nb_requests = 0
+
+        self._token_provider = token_provider
+        self._lock = threading.Lock()
+        self._token = None
+
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = user_agent
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+
+    def expand(self, stubs):
+        """
+        Fetches all the comments hidden behind stubs, and the ones hidden behind the stubs found along the way.
+        "stubs" is an iterable of (parent fullname, children IDs) tuples, an empty list of children meaning "continue this thread".
+
+        Yields (parent fullname, order, comment data) for every comment found, comment data being the JSON object sent by Reddit.
+        Among the children of a comment, sorting by "order" gives the order in which Reddit would show them
+        after the comments that were already known.
+        """
+        sequence = 0
+        pending = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submit(parent_id, children):
+                nonlocal sequence
+                if not children:
+                    sequence += 1
+                    pending.add(executor.submit(self.continue_thread, parent_id, sequence))
+                for i in range(0, len(children), MORECHILDREN_MAX_IDS):
+                    sequence += 1
+                    pending.add(executor.submit(self.morechildren, children[i:i+MORECHILDREN_MAX_IDS], sequence))
+
+            for parent_id, children in stubs:
+                submit(parent_id, children)
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    sequence_done, things = future.result()
+                    for i, (kind, data) in enumerate(things):
+                        if kind == 'more':
+                            submit(data['parent_id'], data['children'])
+                        else:
+                            yield data['parent_id'], (sequence_done, i), data
+
+
+    def morechildren(self, children, sequence):
+        """
+        Fetches a batch of comments by their IDs
+        """
+        response = self.request('POST', '/api/morechildren', data={'api_type': 'json', 'children': ','.join(children), 'link_id': self.link_id, 'sort': self.sort})
+        things = response['json']['data']['things']
+        return sequence, [(thing['kind'], thing['data']) for thing in things]
+
+
+    def continue_thread(self, parent_id, sequence):
+        """
+        Fetches the replies of a comment that are too deep to be shown with the submission ("continue this thread")
+        """
+        response = self.request('GET', f"/comments/{self.link_id.split('_', 1)[1]}/_/{parent_id.split('_', 1)[1]}", params={'sort': self.sort})
+        things = []
+
+        # The listing holds the parent comment itself, with its replies nested inside: flattening them
+        queue = collections.deque(thing for thing in response[1]['data']['children'] if thing['kind'] == 't1' and thing['data']['name'] == parent_id)
+        while queue:
+            thing = queue.popleft()
+            replies = thing['data'].get('replies')
+            if replies:
+                for child in replies['data']['children']:
+                    things.append((child['kind'], child['data']))
+                    if child['kind'] == 't1':
+                        queue.append(child)
+        return sequence, things
+
+
+    def request(self, method, path, params=None, data=None):
+        """
+        Makes a request to Reddit API within the rate-limit budget, and returns the decoded JSON response
+        """
+        params = dict(params or {}, raw_json=1)
+        refused_token = None
+        attempt = 0
+
+        while True:
+            attempt += 1
+            token = self.token(refused_token)
+            self.budget.acquire()
+            start = time.perf_counter()
+            try:
+                response = self._session.request(method, self.base_url+path, params=params, data=data, headers={'Authorization': f'bearer {token}'}, timeout=30)
+            except requests.RequestException:
+                self.budget.update()
+                if attempt >= MAX_ATTEMPTS:
+                    raise
+                time.sleep(attempt)
+                continue
+            metrics.REDDIT_REQUEST_DURATION.observe(time.perf_counter()-start, client='fetcher')
+            if 'x-ratelimit-remaining' in response.headers:
+                metrics.REDDIT_RATELIMIT_REMAINING.set(float(response.headers['x-ratelimit-remaining']))
+            self.budget.update(response.headers)
+            with self._lock:
+                self.nb_requests += 1
+
+            if response.status_code == 401 and refused_token is None:
+                refused_token = token
+                continue
+            elif response.status_code == 429:
+                log.warning(f'Rate limit reached, waiting for {response.headers.get("x-ratelimit-reset")} seconds')
+                self.budget.wait_for_reset(response.headers)
+                continue
+            elif response.status_code >= 500 and attempt < MAX_ATTEMPTS:
+                time.sleep(attempt)
+                continue
+
+            response.raise_for_status()
+            return response.json()
+
+
+    def token(self, refused_token=None):
+        """
+        Returns the access token, asking for a new one if it is the one Reddit refused
+        (other threads may have got a new one in the meantime)
+        """
+        with self._lock:
+            if self._token is None or self._token == refused_token:
+                self._token = self._token_provider(expired=refused_token is not None)
+            return self._token
@@ -0,0 +1,293 @@
+# This module is imported by the rendering processes: it must stay free of side effects
+# (no config loading, no logging setup), and only depend on what is needed to render.
+
+# 3rd party modules
+import markdown2
+
+# stdlib
+import collections, datetime, hashlib, itertools, logging, multiprocessing, re, sqlite3, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+# Number of comment bodies sent at once to a rendering process
+RENDER_CHUNK_SIZE = 500
+
+# Bodies made only of letters, digits, spaces and basic punctuation, on a single line, which markdown
+# would just wrap in a paragraph
+PLAIN_TEXT = re.compile(r"[A-Za-z](?:[A-Za-z0-9 ,.;?!'\"]*[A-Za-z0-9.?!'\"])?")
+
+# strftime directives showing seconds (or their fraction): dates formatted with them cannot be cached by minute (see DateFormatter)
+SECONDS_DIRECTIVES = set('STXcrs')
+FRACTION_DIRECTIVES = set('f')
+
+# The database of a persistent RenderCache keeps this many times as many bodies as its memory, the least recently used being removed first
+PERSISTENT_CACHE_FACTOR = 10
+
+log = logging.getLogger('redditarchiver_main')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class RenderCache:
+    """
+    Bounded cache of rendered comment bodies, keyed by a hash of their content, with LRU eviction.
+    If a path is given, entries are also stored in a SQLite database, so they survive restarts and evictions
+    (up to PERSISTENT_CACHE_FACTOR times size entries). Can be shared between threads, and the database between processes.
+    The cache never fails a render: if its database cannot be read or written, bodies are just rendered again.
+    """
+    def __init__(self, size, path=None):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._base = None
+        self._written = 0
+
+        if path is not None:
+            try:
+                self._base = sqlite3.connect(path, timeout=5, check_same_thread=False)
+                # WAL lets jobs of other processes read the cache while one of them writes to it
+                self._base.execute('PRAGMA journal_mode=WAL')
+                self._base.execute('PRAGMA synchronous=NORMAL')
+                self._base.execute('CREATE TABLE IF NOT EXISTS "rendered" ("key" BLOB, "html" TEXT, "used_at" INTEGER DEFAULT 0, PRIMARY KEY("key"))')
+                # Databases made before entries were evicted
+                if 'used_at' not in [column[1] for column in self._base.execute('PRAGMA table_info(rendered)')]:
+                    self._base.execute('ALTER TABLE rendered ADD COLUMN "used_at" INTEGER DEFAULT 0')
+                self._base.execute('CREATE INDEX IF NOT EXISTS "rendered_used_at" ON "rendered" ("used_at")')
+                self._base.commit()
+            except sqlite3.Error as e:
+                log.warning(f'Render cache: cannot use {path} ({e}), rendered bodies are only kept in memory')
+                if self._base is not None:
+                    self._base.close()
+                self._base = None
+
+
+    @staticmethod
+    def key(body):
+        return hashlib.blake2b(body.encode('utf-8'), digest_size=16).digest()
+
+
+    def get_many(self, keys):
+        """
+        Returns a dict with the rendered bodies that are in cache, among the ones asked
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                html = self._entries.get(key)
+                if html is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = html
+
+            missing = [key for key in keys if key not in found]
+            if self._base is not None and missing:
+                query = 'SELECT key, html FROM rendered WHERE key IN ({})'.format(','.join('?'*len(missing)))
+                try:
+                    stored = self._base.execute(query, missing).fetchall()
+                    if stored:
+                        self._base.execute('UPDATE rendered SET used_at=? WHERE key IN ({})'.format(','.join('?'*len(stored))), [int(time.time())]+[key for key, html in stored])
+                        self._base.commit()
+                except sqlite3.Error as e:
+                    log.warning(f'Render cache: cannot read the database ({e})')
+                    self._rollback()
+                    stored = []
+                for key, html in stored:
+                    found[key] = html
+                    self._remember(key, html)
+        return found
+
+
+    def put_many(self, entries):
+        """
+        Stores rendered bodies, "entries" being a dict {key: html}
+        """
+        with self._lock:
+            for key, html in entries.items():
+                self._remember(key, html)
+            if self._base is not None and entries:
+                now = int(time.time())
+                try:
+                    self._base.executemany('INSERT OR REPLACE INTO rendered VALUES (?, ?, ?)', ((key, html, now) for key, html in entries.items()))
+                    self._written += len(entries)
+                    # Least recently used entries beyond the limit are removed every time as many entries as the memory holds have been written
+                    if self._written >= self.size:
+                        self._base.execute('DELETE FROM rendered WHERE key IN (SELECT key FROM rendered ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.size*PERSISTENT_CACHE_FACTOR,))
+                        self._written = 0
+                    self._base.commit()
+                except sqlite3.Error as e:
+                    log.warning(f'Render cache: cannot write to the database ({e})')
+                    self._rollback()
+
+
+    def _remember(self, key, html):
+        self._entries[key] = html
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+    def _rollback(self):
+        try:
+            self._base.rollback()
+        except sqlite3.Error:
+            pass
+
+
+class DateFormatter:
+    """
+    Formats timestamps as local dates with a strftime format, like datetime.fromtimestamp(timestamp).strftime(format).
+    Comments of a thread are mostly posted within the same minutes: the result of each minute is cached
+    (of each second, if the format shows seconds; nothing is cached if it shows fractions of seconds).
+    """
+    def __init__(self, format):
+        self.format = format
+        directives = set(re.findall(r'%[-#_^0]?(.)', format))
+        if directives & FRACTION_DIRECTIVES:
+            self.granularity = None
+        elif directives & SECONDS_DIRECTIVES:
+            self.granularity = 1
+        else:
+            self.granularity = 60
+        self._cache = {}
+
+
+    def __call__(self, timestamp):
+        if self.granularity is None:
+            return datetime.datetime.fromtimestamp(timestamp).strftime(self.format)
+        key = timestamp//self.granularity
+        formatted = self._cache.get(key)
+        if formatted is None:
+            formatted = self._cache[key] = datetime.datetime.fromtimestamp(timestamp).strftime(self.format)
+        return formatted
+
+
+def commentParser(initialText):
+    """
+    Parses Reddit's pseudo-markdown into HTML formatting
+    """
+    # removing HTML characters
+    text = initialText.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+
+    # transforming markdown to HTML
+    text = markdown2.markdown(text)
+
+    # converting linebreaks to HTML
+    text = text.replace('\n\n', '</p><p>')
+    text = text.replace('\n', '<br>')
+
+    # removing the last <br> that is here for a weird reason
+    if text[-4:] == '<br>':
+        text = text[:-4]
+
+    return text
+
+
+def render_chunk(bodies):
+    """
+    Renders a chunk of comment bodies (run in the rendering processes)
+    """
+    return [commentParser(body) for body in bodies]
+
+
+def get_executor(processes):
+    """
+    Returns the pool of rendering processes, creating it on first use.
+    Processes are spawned rather than forked, as the app process runs many threads.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def reset_executor():
+    """
+    Drops the pool of rendering processes (for instance when one of them died), a new one is created on next use
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def render_bodies(bodies, processes=0, cache=None, stats=None):
+    """
+    Renders an iterable of comment bodies, and yields their HTML in the same order.
+    If processes is 0, bodies are rendered in the current thread. Otherwise, they are sent by chunks
+    to a pool of processes, so that rendering runs on several cores and does not hold the GIL of the app process.
+    Only a few chunks per process are in flight at a time, so memory use does not depend on the number of bodies.
+
+    Plain text bodies skip markdown entirely, and bodies found in cache (a RenderCache) are not rendered again.
+    If a Counter is given as stats, the number of plain bodies, cache hits and cache misses are added to it.
+    """
+    if stats is None:
+        stats = collections.Counter()
+    executor = get_executor(processes) if processes > 0 else None
+    pending = collections.deque()
+    bodies = iter(bodies)
+
+    try:
+        while True:
+            chunk = list(itertools.islice(bodies, RENDER_CHUNK_SIZE))
+            if not chunk:
+                break
+            pending.append(start_chunk(chunk, executor, cache, stats))
+            if len(pending) >= max(processes*2, 1):
+                yield from finish_chunk(*pending.popleft(), cache)
+
+        while pending:
+            yield from finish_chunk(*pending.popleft(), cache)
+    except BrokenProcessPool:
+        reset_executor()
+        raise
+
+
+def start_chunk(chunk, executor, cache, stats):
+    """
+    Fills in what can be rendered right away in a chunk (plain text and cached bodies).
+    The rest is rendered, in the pool of processes if there is one.
+    """
+    results = [None]*len(chunk)
+    missing = {} # key: (body, indexes in chunk)
+    for i, body in enumerate(chunk):
+        if PLAIN_TEXT.fullmatch(body):
+            results[i] = f'<p>{body}</p>'
+            stats['plain'] += 1
+        elif cache is None:
+            missing.setdefault(body, (body, []))[1].append(i)
+        else:
+            missing.setdefault(RenderCache.key(body), (body, []))[1].append(i)
+
+    if cache is not None and missing:
+        for key, html in cache.get_many(list(missing)).items():
+            for i in missing.pop(key)[1]:
+                results[i] = html
+                stats['hits'] += 1
+    stats['misses'] += sum(len(indexes) for body, indexes in missing.values())
+
+    to_render = [body for body, indexes in missing.values()]
+    if executor is not None and to_render:
+        rendered = executor.submit(render_chunk, to_render)
+    else:
+        rendered = render_chunk(to_render)
+    return results, missing, rendered
+
+
+def finish_chunk(results, missing, rendered, cache):
+    """
+    Completes a chunk with the bodies that had to be rendered, and returns it
+    """
+    if not isinstance(rendered, list):
+        rendered = rendered.result()
+
+    for (key, (body, indexes)), html in zip(missing.items(), rendered):
+        for i in indexes:
+            results[i] = html
+
+    if cache is not None and missing:
+        cache.put_many(dict(zip(missing, rendered)))
+    return results
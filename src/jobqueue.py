@@ -0,0 +1,142 @@
+# Project modules
+# (downloader is imported by the workers when they get their first job, see run)
+import events, metrics, models
+
+# stdlib
+import threading, time, logging, os, socket, atexit
+
+log = logging.getLogger('redditarchiver_main')
+
+# Signals the workers that a job has been queued
+_condition = threading.Condition()
+_workers = []
+_heartbeat = None
+
+# How often (in seconds) idle workers look at the queue even if they were not notified
+POLL_INTERVAL = 60
+# How long (in seconds) workers wait before trying again when the queue cannot be read (database locked, or being migrated by another process)
+RETRY_INTERVAL = 5
+
+# Jobs can be run by several processes (gunicorn workers, worker.py, cli.py), all on the same host: each one writes regularly
+# that its jobs are still running (every HEARTBEAT_INTERVAL seconds). Jobs without news for HEARTBEAT_TIMEOUT seconds are put back in queue.
+HEARTBEAT_INTERVAL = 15
+HEARTBEAT_TIMEOUT = 120
+
+
+def start(nb_workers, poll_interval=POLL_INTERVAL):
+    """
+    Starts the pool of workers that take jobs from the queue (the jobs table).
+    Workers of other processes are only notified of new jobs through the database: they should look at it more often (poll_interval).
+    """
+    if _workers:
+        return
+    if nb_workers <= 0:
+        log.info('No job worker in this process: jobs are run by other processes (see worker.py)')
+        return
+
+    start_heartbeat()
+    for i in range(nb_workers):
+        worker = threading.Thread(target=work, args=(poll_interval,))
+        worker.name = f'jobqueue-worker-{i}'
+        worker.daemon = True
+        worker.start()
+        _workers.append(worker)
+    metrics.WORKERS.set(len(_workers))
+
+    log.info(f'Job queue started with {nb_workers} worker(s) (worker ID {worker_id()})')
+
+
+def worker_id():
+    """
+    Identifies this process in the jobs it runs
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def start_heartbeat():
+    """
+    Starts writing the heartbeat of the jobs run by this process, and putting back in queue the jobs of the processes that stopped
+    (including the ones of a previous run of this one)
+    """
+    global _heartbeat
+    if _heartbeat is not None:
+        return
+
+    def beat():
+        while True:
+            try:
+                db = models.connect()
+                models.write_heartbeat(db, worker_id())
+                requeued = models.requeue_stale_jobs(db, HEARTBEAT_TIMEOUT)
+                if requeued:
+                    log.info(f'{requeued} interrupted job(s) put back in queue')
+                    notify()
+            except Exception as e:
+                log.error(f'Could not write heartbeat ({e})')
+                models.rollback()
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    _heartbeat = threading.Thread(target=beat, name='jobqueue-heartbeat', daemon=True)
+    _heartbeat.start()
+    atexit.register(release)
+
+
+def release():
+    """
+    Puts back in queue the jobs this process did not finish, when it stops
+    """
+    released = models.release_jobs(models.connect(), worker_id())
+    if released:
+        log.info(f'{released} unfinished job(s) put back in queue')
+
+
+def notify():
+    """
+    Wakes up a worker, to be called when a job has been queued
+    """
+    with _condition:
+        _condition.notify()
+
+
+def work(poll_interval=POLL_INTERVAL):
+    """
+    Worker loop: takes the job at the head of the queue and runs it, or waits for one to be queued.
+    """
+    while True:
+        try:
+            db = models.connect()
+            with _condition:
+                job = models.claim_job(db, worker_id())
+                if job is None:
+                    _condition.wait(timeout=poll_interval)
+                    continue
+        except Exception as e:
+            log.error(f'Could not take a job from the queue, trying again in {RETRY_INTERVAL} seconds ({e})', exc_info=True)
+            models.rollback()
+            time.sleep(RETRY_INTERVAL)
+            continue
+        run(db, job['id'], job['submission'], job['token'], job['output_format'])
+
+
+def run(db, job_id, submission, token, output_format=None):
+    """
+    Runs a job taken from the queue (see models.claim_job)
+    """
+    import downloader
+    log.info(f"{job_id}: Job starting (submission {submission}, token {token})")
+    metrics.WORKERS_BUSY.inc()
+    start = time.monotonic()
+    try:
+        downloader.main(submission, token, job_id, output_format=output_format)
+    finally:
+        metrics.WORKERS_BUSY.dec()
+    duration = time.monotonic()-start
+
+    # Telling the ones following the job (and the jobs attached to it) that it is done
+    job = models.read_job(db, job_id)
+    events.publish(job['id'], {'status': job['status'], 'failure_reason': job['failure_reason']})
+
+    metrics.JOBS_FINISHED.inc(status=job['status'])
+    metrics.JOB_DURATION.observe(duration, status=job['status'])
+    if job['status'] == "success" and job['nb_fetched']:
+        metrics.JOB_COMMENTS_RATE.observe(job['nb_fetched']/max(duration, 0.001))
@@ -0,0 +1,267 @@
+# stdlib
+import threading, time, os, json, bisect, atexit, logging
+
+log = logging.getLogger('redditarchiver_main')
+
+# Each process (gunicorn worker) writes its metrics in this directory, so that the one answering /metrics can add them to its own
+DIRECTORY = "data/metrics"
+DUMP_INTERVAL = 10
+
+# Buckets of the histograms (in seconds, unless told otherwise)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RATE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+_metrics = []
+
+# Counters and histograms are updated without lock: each thread adds to its own values (its shard), that are only summed when metrics are collected.
+# The values of finished threads are moved to _retired, so that threads coming and going (such as the ones of fetcher) do not pile up.
+_local = threading.local()
+_shards = []
+_retired = {}
+_shards_lock = threading.Lock()
+
+# Gauges are set, not added: their values are shared by all threads
+_gauges = {}
+_gauges_lock = threading.Lock()
+
+_dumper = None
+
+
+def shard():
+    """
+    Returns the values of the current thread
+    """
+    values = getattr(_local, 'values', None)
+    if values is None:
+        values = {}
+        with _shards_lock:
+            _shards.append((threading.current_thread(), values))
+        _local.values = values
+    return values
+
+
+def add(values, into):
+    """
+    Adds the values of a shard (or of another process) to others
+    """
+    for key, value in values.items():
+        if isinstance(value, list):
+            if key in into:
+                into[key] = [a+b for a, b in zip(into[key], value)]
+            else:
+                into[key] = list(value)
+        else:
+            into[key] = into.get(key, 0)+value
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+
+    def key(self, labels):
+        return (self.name,)+tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        values = shard()
+        key = self.key(labels)
+        values[key] = values.get(key, 0)+amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value, **labels):
+        values = shard()
+        key = self.key(labels)
+        counts = values.get(key)
+        if counts is None:
+            # One count per bucket, one for +Inf, then the sum of the observed values
+            counts = values[key] = [0]*(len(self.buckets)+1)+[0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+class Gauge(Metric):
+    """
+    Gauge, whose values from the different processes are summed ("sum"), reduced to the lowest one ("min"),
+    or not gathered at all ("local", for values read from the database, that are the same for all processes)
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), aggregate='sum'):
+        super().__init__(name, help, labels)
+        self.aggregate = aggregate
+
+
+    def set(self, value, **labels):
+        _gauges[self.key(labels)] = value
+
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with _gauges_lock:
+            _gauges[key] = _gauges.get(key, 0)+amount
+
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+def collect():
+    """
+    Returns the current values of all metrics in this process, by (name, label values...)
+    """
+    values = {}
+    with _shards_lock:
+        for thread, thread_values in list(_shards):
+            if not thread.is_alive():
+                add(thread_values.copy(), _retired)
+                _shards.remove((thread, thread_values))
+            else:
+                add(thread_values.copy(), values)
+        add(_retired, values)
+    values.update(_gauges.copy())
+    return values
+
+
+def dump():
+    """
+    Writes the values of this process in the metrics directory
+    """
+    path = os.path.join(DIRECTORY, f'{os.getpid()}.json')
+    with open(path+'.tmp', 'w') as f:
+        json.dump([[list(key), value] for key, value in collect().items()], f)
+    os.replace(path+'.tmp', path)
+
+
+def remove_dump():
+    try:
+        os.remove(os.path.join(DIRECTORY, f'{os.getpid()}.json'))
+    except FileNotFoundError:
+        pass
+
+
+def start():
+    """
+    Starts writing the metrics of this process regularly in the metrics directory (see dump)
+    """
+    global _dumper
+    if _dumper is not None:
+        return
+
+    def work():
+        while True:
+            time.sleep(DUMP_INTERVAL)
+            try:
+                dump()
+            except OSError as e:
+                log.warning(f'Could not write metrics ({e})')
+
+    os.makedirs(DIRECTORY, exist_ok=True)
+    _dumper = threading.Thread(target=work, name='metrics-dumper', daemon=True)
+    _dumper.start()
+    atexit.register(remove_dump)
+
+
+def gather():
+    """
+    Returns the values of all metrics, those of this process being added to the last ones written by the other processes.
+    Files left by processes that no longer exist are removed.
+    """
+    kinds = {metric.name: metric for metric in _metrics}
+    values = collect()
+    others = []
+    if os.path.isdir(DIRECTORY):
+        for filename in os.listdir(DIRECTORY):
+            if not filename.endswith('.json') or filename == f'{os.getpid()}.json':
+                continue
+            try:
+                os.kill(int(filename[:-5]), 0)
+            except ProcessLookupError:
+                os.remove(os.path.join(DIRECTORY, filename))
+                continue
+            except (ValueError, PermissionError):
+                pass
+            try:
+                with open(os.path.join(DIRECTORY, filename), 'r') as f:
+                    others.append({tuple(key): value for key, value in json.load(f)})
+            except (OSError, ValueError):
+                continue
+
+    for other in others:
+        for key, value in other.items():
+            metric = kinds.get(key[0])
+            if metric is None or metric.kind == 'gauge' and metric.aggregate == 'local':
+                continue
+            elif metric.kind == 'gauge' and metric.aggregate == 'min' and key in values:
+                values[key] = min(values[key], value)
+            else:
+                add({key: value}, values)
+    return values
+
+
+def labels_text(names, values, extra=()):
+    pairs = list(zip(names, values))+list(extra)
+    if not pairs:
+        return ''
+    return '{'+','.join(f'{name}="{value}"' for name, value in pairs)+'}'
+
+
+def expose():
+    """
+    Returns all metrics in the text format read by Prometheus
+    """
+    values = gather()
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for key in sorted(key for key in values if key[0] == metric.name):
+            value = values[key]
+            if metric.kind == 'histogram':
+                cumulated = 0
+                for bound, count in zip(metric.buckets+('+Inf',), value[:-1]):
+                    cumulated += count
+                    lines.append(f'{metric.name}_bucket{labels_text(metric.labels, key[1:], [("le", bound)])} {cumulated}')
+                lines.append(f'{metric.name}_sum{labels_text(metric.labels, key[1:])} {value[-1]}')
+                lines.append(f'{metric.name}_count{labels_text(metric.labels, key[1:])} {cumulated}')
+            else:
+                lines.append(f'{metric.name}{labels_text(metric.labels, key[1:])} {value}')
+    return '\n'.join(lines)+'\n'
+
+
+
+# -------------------------- #
+# Metrics                    #
+# -------------------------- #
+
+JOB_PHASE_DURATION = Histogram('redditarchiver_job_phase_duration_seconds', 'Time spent by jobs in each phase', ('phase',), buckets=DURATION_BUCKETS)
+JOB_DURATION = Histogram('redditarchiver_job_duration_seconds', 'Time taken by jobs, from their start to their end', ('status',), buckets=DURATION_BUCKETS)
+JOB_COMMENTS_RATE = Histogram('redditarchiver_job_comments_per_second', 'Comments archived per second by successful jobs', buckets=RATE_BUCKETS)
+JOBS_FINISHED = Counter('redditarchiver_jobs_finished_total', 'Jobs finished, by status', ('status',))
+JOBS = Gauge('redditarchiver_jobs', 'Jobs waiting in queue or running', ('status',), aggregate='local')
+WORKERS = Gauge('redditarchiver_workers', 'Worker threads running jobs')
+WORKERS_BUSY = Gauge('redditarchiver_workers_busy', 'Worker threads currently running a job')
+REDDIT_REQUEST_DURATION = Histogram('redditarchiver_reddit_request_duration_seconds', 'Latency of the requests to Reddit API', ('client',))
+REDDIT_RATELIMIT_REMAINING = Gauge('redditarchiver_reddit_ratelimit_remaining', 'Requests left in the rate-limit window of Reddit API, as last seen (lowest value of all processes)', aggregate='min')
+SQLITE_QUERY_DURATION = Histogram('redditarchiver_sqlite_query_duration_seconds', 'Latency of the queries to the database', ('statement',))
+OUTPUT_BYTES = Counter('redditarchiver_output_bytes_total', 'Bytes of archives written to disk')
+OUTPUT_DEDUPLICATED = Counter('redditarchiver_output_deduplicated_total', 'Archives identical to a file already stored, and so not stored again')
+CLEANUP_REMOVED = Counter('redditarchiver_cleanup_removed_total', 'Items removed by the cleanup tasks', ('task',))
+CLEANUP_RUNS = Counter('redditarchiver_cleanup_runs_total', 'Runs of the cleanup tasks', ('task',))
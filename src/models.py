@@ -1,39 +1,219 @@
+# Project modules
+import metrics
+from config import config
+
 # stdlib
-import sqlite3, datetime, os, statistics
+import sqlite3, datetime, statistics, threading, time, os
+
+
+DATABASE = "data/redditarchiver.sqlite3"
+
+# Each thread keeps its own connection (sqlite3 connections cannot be shared between threads)
+_local = threading.local()
+_migrated = False
+_migration_lock = threading.Lock()
+
+# Tokens read since the last flush, by cookie: their last_seen_at is written by batches (see flush_last_seen),
+# at most every FLUSH_INTERVAL seconds. Each process flushes its own.
+FLUSH_INTERVAL = 60
+_last_seen = {}
+_last_seen_lock = threading.Lock()
+_last_flush = time.monotonic()
 
+# Condition on the jobs attached to the job :job_id that were requested with the same token (or both anonymously), see create_job
+SAME_TOKEN = '(SELECT token FROM tokens WHERE id=jobs.requestor) IS (SELECT tokens.token FROM jobs AS leader LEFT JOIN tokens ON tokens.id=leader.requestor WHERE leader.id=:job_id)'
 
-def create():
+
+class TimedCursor(sqlite3.Cursor):
     """
-    Create the sqlite database if it does not exist
+    Cursor measuring the time taken by the queries (see metrics.SQLITE_QUERY_DURATION)
     """
-    base = sqlite3.connect("data/redditarchiver.sqlite3")
-    cursor = base.cursor()
-    cursor.execute('CREATE TABLE "tokens" ("id" TEXT, "ip" TEXT, "created_at" INTEGER, "last_seen_at" INTEGER, "token" TEXT, PRIMARY KEY("id"))')
-    cursor.execute('CREATE TABLE "jobs" ("id" TEXT, "started_at" INTEGER, "finished_at" INTEGER, "submission" TEXT, "nb_replies" INTEGER, "requestor" TEXT, "status" TEXT, "failure_reason" INTEGER, "filename" TEXT, PRIMARY KEY("id"), FOREIGN KEY("requestor") REFERENCES "tokens"("id"))')
-    base.commit()
-    base.close()
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.SQLITE_QUERY_DURATION.observe(time.perf_counter()-start, statement=sql.split(None, 1)[0].upper())
+
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            metrics.SQLITE_QUERY_DURATION.observe(time.perf_counter()-start, statement=sql.split(None, 1)[0].upper())
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
 
 
 def connect():
     """
-    Connects to sqlite database
+    Connects to sqlite database. Each thread gets its own connection, opened on first use and reused afterwards
+    (which also lets sqlite3 reuse its prepared statements).
 
     Returns a tuple with base and cursor, to be used in all other functions
     """
-    if not os.path.exists("data/redditarchiver.sqlite3"):
-        create()
-    base = sqlite3.connect("data/redditarchiver.sqlite3")
-    base.row_factory = sqlite3.Row # having column names! cf https://stackoverflow.com/a/18788347
-    cursor = base.cursor()
-    return (base, cursor)
+    model = getattr(_local, 'model', None)
+    if model is None:
+        base = sqlite3.connect(DATABASE, timeout=10, cached_statements=256, factory=TimedConnection)
+        base.row_factory = sqlite3.Row # having column names! cf https://stackoverflow.com/a/18788347
+        # WAL lets readers work while a job is writing, and only needs a full sync at checkpoints
+        base.execute('PRAGMA journal_mode=WAL')
+        base.execute('PRAGMA synchronous=NORMAL')
+        base.execute('PRAGMA temp_store=MEMORY')
+        model = (base, base.cursor())
+        try:
+            migrate(model)
+        except Exception:
+            base.close()
+            raise
+        _local.model = model
+    return model
+
+
+def rollback():
+    """
+    Rolls back what the connection of the current thread left uncommitted (after a statement failed), so that it is not committed
+    by the next write made with it
+    """
+    model = getattr(_local, 'model', None)
+    if model is not None:
+        model[0].rollback()
+
+
+# -------------------------- #
+# Schema migrations          #
+# -------------------------- #
+
+def migration_base(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS "tokens" ("id" TEXT, "ip" TEXT, "created_at" INTEGER, "last_seen_at" INTEGER, "token" TEXT, PRIMARY KEY("id"))')
+    cursor.execute('CREATE TABLE IF NOT EXISTS "jobs" ("id" TEXT, "started_at" INTEGER, "finished_at" INTEGER, "submission" TEXT, "nb_replies" INTEGER, "requestor" TEXT, "status" TEXT, "failure_reason" INTEGER, "filename" TEXT, PRIMARY KEY("id"), FOREIGN KEY("requestor") REFERENCES "tokens"("id"))')
+
+
+def migration_queue(cursor):
+    add_columns(cursor, 'jobs', (('queued_at', 'INTEGER'), ('priority', 'INTEGER DEFAULT 0'), ('served_by', 'TEXT')))
+
 
+def migration_snapshots(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS "snapshots" ("submission" TEXT, "fetched_at" INTEGER, "refreshed_at" INTEGER, "nb_comments" INTEGER, PRIMARY KEY("submission"))')
+    cursor.execute('CREATE TABLE IF NOT EXISTS "comments" ("submission" TEXT, "position" INTEGER, "id" TEXT, "parent" TEXT, "author" TEXT, "body" TEXT, "distinguished" TEXT, "edited" REAL, "permalink" TEXT, "is_submitter" INTEGER, "score" INTEGER, "created_utc" REAL, PRIMARY KEY("submission", "position"))')
 
-def create_job(model, job_id, submission, requestor):
+
+def migration_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS "jobs_status_finished_at" ON "jobs" ("status", "finished_at")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "jobs_queue" ON "jobs" ("status", "priority" DESC, "queued_at")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "jobs_submission_status" ON "jobs" ("submission", "status")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "tokens_last_seen_at" ON "tokens" ("last_seen_at")')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "snapshots_fetched_at" ON "snapshots" ("fetched_at")')
+
+
+def migration_progress(cursor):
+    add_columns(cursor, 'jobs', (('phase', 'TEXT'), ('nb_fetched', 'INTEGER'), ('nb_rendered', 'INTEGER'), ('nb_requests', 'INTEGER')))
+    cursor.execute('CREATE TABLE IF NOT EXISTS "phases" ("job" TEXT, "phase" TEXT, "started_at" REAL, "finished_at" REAL, "duration" REAL, PRIMARY KEY("job", "phase"), FOREIGN KEY("job") REFERENCES "jobs"("id"))')
+
+
+def migration_batches(cursor):
+    add_columns(cursor, 'jobs', (('batch', 'TEXT'),))
+    cursor.execute('CREATE INDEX IF NOT EXISTS "jobs_batch" ON "jobs" ("batch")')
+
+
+def migration_workers(cursor):
+    add_columns(cursor, 'jobs', (('worker', 'TEXT'), ('heartbeat_at', 'INTEGER')))
+
+
+def migration_formats(cursor):
+    add_columns(cursor, 'jobs', (('output_format', 'TEXT'),))
+
+
+def migration_outputs(cursor):
+    add_columns(cursor, 'jobs', (('download_name', 'TEXT'),))
+    cursor.execute('CREATE TABLE IF NOT EXISTS "files" ("filename" TEXT, "size" INTEGER, "created_at" INTEGER, "last_used_at" INTEGER, PRIMARY KEY("filename"))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS "files_last_used_at" ON "files" ("last_used_at")')
+    # Files written before the index existed are added to it once, so that they are evicted like the others
+    cursor.execute('SELECT DISTINCT filename, finished_at FROM jobs WHERE status=\'success\' AND filename IS NOT NULL')
+    for row in cursor.fetchall():
+        try:
+            size = os.path.getsize(os.path.join(config['paths']['output'], row[0]))
+        except OSError:
+            continue
+        cursor.execute('INSERT OR IGNORE INTO files (filename, size, created_at, last_used_at) VALUES (:filename, :size, :finished_at, :finished_at)', {'filename': row[0], 'size': size, 'finished_at': row[1]})
+
+
+def migration_private_batches(cursor):
+    add_columns(cursor, 'jobs', (('private', 'INTEGER DEFAULT 0'),))
+
+
+# Schema versions, in order: the version of a database is the number of migrations applied to it.
+# Migrations must not fail on a database that already has (part of) their changes, as databases
+# created before this mechanism existed are all at version 0.
+MIGRATIONS = (migration_base, migration_queue, migration_snapshots, migration_indexes, migration_progress, migration_batches, migration_workers, migration_formats, migration_outputs, migration_private_batches)
+
+
+def add_columns(cursor, table, columns):
+    """
+    Adds columns to a table, skipping the ones that already exist
     """
-    Adds a job in database.
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = [line['name'] for line in cursor.fetchall()]
+    for name, definition in columns:
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE "{table}" ADD COLUMN "{name}" {definition}')
+
+
+def migrate(model):
     """
-    model[1].execute('INSERT INTO jobs VALUES (:job_id, NULL, NULL, :submission, NULL, :requestor, "created", NULL, NULL)', {'job_id': job_id, 'submission': submission, 'requestor': requestor})
+    Brings the database schema up to date (once per process), the current version being stored in "PRAGMA user_version".
+    Several processes (gunicorn workers, worker.py) may start at the same time: migrations are applied under a write lock
+    (BEGIN IMMEDIATE), by the first process to get it, and the others find the database up to date once they get it.
+    """
+    global _migrated
+    with _migration_lock:
+        if _migrated:
+            return
+        model[1].execute('PRAGMA user_version')
+        if model[1].fetchall()[0][0] < len(MIGRATIONS):
+            model[0].commit()
+            model[1].execute('BEGIN IMMEDIATE')
+            try:
+                # Read again under the lock: another process may have migrated the database in the meantime
+                model[1].execute('PRAGMA user_version')
+                version = model[1].fetchall()[0][0]
+                for migration in MIGRATIONS[version:]:
+                    migration(model[1])
+                model[1].execute(f'PRAGMA user_version = {max(version, len(MIGRATIONS))}')
+                model[0].commit()
+            except Exception:
+                model[0].rollback()
+                raise
+        _migrated = True
+
+
+# -------------------------- #
+# Queries                    #
+# -------------------------- #
+
+def create_job(model, job_id, submission, requestor, priority=0, batch=None, output_format=None, private=False):
+    """
+    Adds a job in database, at the end of the queue.
+    Jobs with a higher priority are taken first. Jobs requested together can be grouped under a batch ID.
+    Jobs of a private batch are only taken by the workers of this batch (see claim_job), such as the ones of cli.py, which run them with their own token.
+    The output format of the job (see downloader.OUTPUT_FORMATS) defaults to app.output-format if None.
+
+    If the same submission is already queued or being downloaded by another job, in the same format, the new job is attached to it
+    instead of being queued: it will get the result of the other job. In that case, the ID of the other job is returned.
+    Only the jobs requested with the same token get that result right away: the others are queued again once it is known,
+    to check that their requestor can read the submission too (see mark_job_success).
+    """
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    # Done in a single statement, so that the job we attach to cannot finish in the meantime
+    # Jobs of a private batch are only joined by the jobs of the same batch: nobody else could run them if their batch stopped
+    model[1].execute('INSERT INTO jobs (id, submission, requestor, status, queued_at, priority, served_by, batch, output_format, private) SELECT :job_id, :submission, :requestor, CASE WHEN leader.id IS NULL THEN \'queued\' ELSE \'attached\' END, :queued_at, :priority, leader.id, :batch, :output_format, :private FROM (SELECT NULL) LEFT JOIN (SELECT id FROM jobs WHERE submission=:submission AND output_format IS :output_format AND status IN (\'queued\', \'ongoing\') AND served_by IS NULL AND (private = 0 OR batch IS :batch) LIMIT 1) AS leader', {'job_id': job_id, 'submission': submission, 'requestor': requestor, 'queued_at': now, 'priority': priority, 'batch': batch, 'output_format': output_format, 'private': int(private)})
     model[0].commit()
+    model[1].execute('SELECT served_by FROM jobs WHERE id=:job_id', {'job_id': job_id})
+    return model[1].fetchall()[0]['served_by']
 
 
 def read_job(model, job_id):
@@ -48,30 +228,96 @@ def read_job(model, job_id):
         return "notfound"
 
 
-def start_job(model, job_id):
+def claim_job(model, worker, batch=None):
     """
-    Mark a job as started in database.
+    Takes the job at the head of the queue for a worker, and returns it (with the token of its requestor), or None if the queue is empty.
+    Done in a single statement, so that a job can only be taken by one worker, even if they run in different processes.
+    If a batch ID is given, only the jobs of this batch are considered. Otherwise, the jobs of private batches are left to their own workers.
     """
     now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-    model[1].execute('UPDATE jobs SET status="ongoing", started_at=:started_at WHERE id=:job_id', {'job_id': job_id, 'started_at': now})
+    model[1].execute('UPDATE jobs SET status=\'ongoing\', started_at=:now, worker=:worker, heartbeat_at=:now WHERE id=(SELECT id FROM jobs WHERE status = \'queued\' AND (batch = :batch OR (:batch IS NULL AND private = 0)) ORDER BY priority DESC, queued_at, rowid LIMIT 1) AND status=\'queued\' RETURNING id', {'now': now, 'worker': worker, 'batch': batch})
+    result = model[1].fetchall()
     model[0].commit()
+    if not result:
+        return None
+    model[1].execute('SELECT jobs.id, jobs.submission, jobs.output_format, tokens.token FROM jobs LEFT JOIN tokens ON jobs.requestor = tokens.id WHERE jobs.id=:job_id', {'job_id': result[0]['id']})
+    return model[1].fetchall()[0]
 
 
-def mark_job_success(model, job_id, filename=None):
+def queue_position(model, job_id):
     """
-    Mark a job as successful in database.
+    Returns the position of a queued job in the queue (1 being the next job to be taken). Jobs of private batches are not counted, as they are taken by their own workers.
+    """
+    model[1].execute('SELECT COUNT(*) AS ahead FROM jobs, (SELECT priority, queued_at, rowid AS position FROM jobs WHERE id=:job_id) AS job WHERE jobs.status = \'queued\' AND jobs.private = 0 AND (jobs.priority > job.priority OR (jobs.priority = job.priority AND (jobs.queued_at < job.queued_at OR (jobs.queued_at = job.queued_at AND jobs.rowid < job.position))))', {'job_id': job_id})
+    return model[1].fetchall()[0]['ahead']+1
+
+
+def read_batch(model, batch):
+    """
+    Returns the jobs of a batch, in the order they were requested.
+    """
+    model[1].execute('SELECT * FROM jobs WHERE batch=:batch ORDER BY queued_at, rowid', {'batch': batch})
+    return model[1].fetchall()
+
+
+def write_heartbeat(model, worker):
+    """
+    Marks the jobs run by a worker as still being run
     """
     now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
-    model[1].execute('UPDATE jobs SET status="success", filename=:filename, finished_at=:finished_at WHERE id=:job_id', {'job_id': job_id, 'filename': filename, 'finished_at': now})
+    model[1].execute('UPDATE jobs SET heartbeat_at=:now WHERE worker=:worker AND status=\'ongoing\'', {'now': now, 'worker': worker})
     model[0].commit()
 
 
+def requeue_stale_jobs(model, timeout):
+    """
+    Puts back in queue the ongoing jobs whose worker gave no sign of life for timeout seconds (it was stopped, or crashed).
+    Returns the number of jobs put back in queue.
+    """
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    model[1].execute('UPDATE jobs SET status=\'queued\', started_at=NULL, worker=NULL, heartbeat_at=NULL, phase=NULL, nb_fetched=NULL, nb_rendered=NULL, nb_requests=NULL WHERE status=\'ongoing\' AND (heartbeat_at IS NULL OR heartbeat_at < :limit)', {'limit': now-timeout})
+    model[0].commit()
+    return model[1].rowcount
+
+
+def release_jobs(model, worker):
+    """
+    Puts back in queue the jobs run by a worker, for another one to take them (when the worker stops).
+    Returns the number of jobs put back in queue.
+    """
+    model[1].execute('UPDATE jobs SET status=\'queued\', started_at=NULL, worker=NULL, heartbeat_at=NULL, phase=NULL, nb_fetched=NULL, nb_rendered=NULL, nb_requests=NULL WHERE status=\'ongoing\' AND worker=:worker', {'worker': worker})
+    model[0].commit()
+    return model[1].rowcount
+
+
+def mark_job_success(model, job_id, filename=None, download_name=None):
+    """
+    Mark a job as successful in database. filename is the name of its file in the output directory, download_name the one it is downloaded under.
+    """
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    # The jobs attached to this one get the same result if they were requested with the same token (see requeue_attached_jobs)
+    with model[0]:
+        model[1].execute(f'UPDATE jobs SET status=\'success\', filename=:filename, download_name=:download_name, finished_at=:finished_at WHERE id=:job_id OR (served_by=:job_id AND status=\'attached\' AND {SAME_TOKEN})', {'job_id': job_id, 'filename': filename, 'download_name': download_name, 'finished_at': now})
+        requeue_attached_jobs(model, job_id)
+
+
 def mark_job_failure(model, job_id, reason=None):
     """
     Mark a job as failed in database.
     """
-    model[1].execute('UPDATE jobs SET status="failure", failure_reason=:failure_reason WHERE id=:job_id', {'job_id': job_id, 'failure_reason': reason})
-    model[0].commit()
+    with model[0]:
+        model[1].execute(f'UPDATE jobs SET status=\'failure\', failure_reason=:failure_reason WHERE id=:job_id OR (served_by=:job_id AND status=\'attached\' AND {SAME_TOKEN})', {'job_id': job_id, 'failure_reason': reason})
+        requeue_attached_jobs(model, job_id)
+
+
+def requeue_attached_jobs(model, job_id):
+    """
+    Puts back in queue the jobs still attached to a job that just finished: they were requested with another token, which may not
+    read the submission (a private subreddit...), or may read it when the other one could not. They keep the ID of the job
+    they were attached to: if it succeeded, they only check the submission can be read with their token, and take its file
+    (see downloader.served_output). Not committed: to be done in the transaction that finishes the job.
+    """
+    model[1].execute('UPDATE jobs SET status=\'queued\' WHERE served_by=:job_id AND status=\'attached\'', {'job_id': job_id})
 
 
 def write_nb_replies(model, job_id, nb_replies=None):
@@ -82,6 +328,40 @@ def write_nb_replies(model, job_id, nb_replies=None):
     model[0].commit()
 
 
+def write_progress(model, job_id, nb_fetched=None, nb_rendered=None, nb_requests=None):
+    """
+    Write the progress of a job in database (counters left to None are not changed)
+    """
+    model[1].execute('UPDATE jobs SET nb_fetched=COALESCE(:nb_fetched, nb_fetched), nb_rendered=COALESCE(:nb_rendered, nb_rendered), nb_requests=COALESCE(:nb_requests, nb_requests) WHERE id=:job_id', {'job_id': job_id, 'nb_fetched': nb_fetched, 'nb_rendered': nb_rendered, 'nb_requests': nb_requests})
+    model[0].commit()
+
+
+def start_phase(model, job_id, phase, started_at):
+    """
+    Mark in database that a job entered a phase (connect, replace_more, tree_build, render, write...)
+    """
+    with model[0]:
+        model[1].execute('INSERT OR REPLACE INTO phases VALUES (:job_id, :phase, :started_at, NULL, NULL)', {'job_id': job_id, 'phase': phase, 'started_at': started_at})
+        model[1].execute('UPDATE jobs SET phase=:phase WHERE id=:job_id', {'job_id': job_id, 'phase': phase})
+
+
+def finish_phase(model, job_id, phase, finished_at, duration=None):
+    """
+    Mark in database that a job finished a phase.
+    The duration is the time between the start and the end of the phase, unless given (for phases that run interleaved with another one).
+    """
+    model[1].execute('UPDATE phases SET finished_at=:finished_at, duration=COALESCE(:duration, :finished_at-started_at) WHERE job=:job_id AND phase=:phase', {'job_id': job_id, 'phase': phase, 'finished_at': finished_at, 'duration': duration})
+    model[0].commit()
+
+
+def read_phases(model, job_id):
+    """
+    Returns the phases of a job, by name
+    """
+    model[1].execute('SELECT * FROM phases WHERE job=:job_id ORDER BY started_at', {'job_id': job_id})
+    return {line['phase']: line for line in model[1].fetchall()}
+
+
 def create_token(model, cookie, token):
     """
     Creates a token (connection to Reddit API) in database
@@ -100,28 +380,57 @@ def read_token(model,  cookie):
     result = model[1].fetchall()
     if result:
         token = result[0]['token']
-        # mark token as freshly read
-        model[1].execute('UPDATE tokens SET last_seen_at=:last_seen_at WHERE id=:id', {'id': cookie, 'last_seen_at': now})
-        model[0].commit()
+        # mark token as freshly read (written to database with the next flush_last_seen)
+        with _last_seen_lock:
+            _last_seen[cookie] = now
+            flush = time.monotonic()-_last_flush > FLUSH_INTERVAL
+        if flush:
+            flush_last_seen(model)
         return token
     else:
         return None
 
 
+def flush_last_seen(model):
+    """
+    Writes in database, in a single transaction, when the tokens read since the last flush were last seen
+    """
+    global _last_flush
+    with _last_seen_lock:
+        seen = list(_last_seen.items())
+        _last_seen.clear()
+        _last_flush = time.monotonic()
+    if seen:
+        with model[0]:
+            model[1].executemany('UPDATE tokens SET last_seen_at=? WHERE id=?', ((last_seen_at, cookie) for cookie, last_seen_at in seen))
+
+
 def cleanup_sessions(model):
     """
-    Remove all tokens unused since 3 months
+    Remove all tokens unused since 3 months. Returns the number of tokens removed.
     """
+    flush_last_seen(model)
     now = datetime.datetime.now(datetime.timezone.utc).timestamp()
-    model[1].execute('DELETE FROM tokens WHERE (:now - last_seen_at) > 7760000', {'now': now})
+    model[1].execute('DELETE FROM tokens WHERE last_seen_at < :limit', {'limit': now-7760000})
     model[0].commit()
+    return model[1].rowcount
+
+
+def count_jobs(model):
+    """
+    Returns the number of jobs queued and ongoing, by status
+    """
+    model[1].execute('SELECT status, COUNT(*) AS nb FROM jobs WHERE status IN (\'queued\', \'ongoing\') GROUP BY status')
+    counts = {"queued": 0, "ongoing": 0}
+    counts.update({line['status']: line['nb'] for line in model[1].fetchall()})
+    return counts
 
 
 def calculate_average_eta(model):
     """
     Calculates average time to download a thread (depending on the number of replies) so we can give a good ETA estimation.
     """
-    model[1].execute('SELECT started_at, finished_at, nb_replies FROM jobs WHERE status = "success" ORDER BY finished_at DESC LIMIT 100')
+    model[1].execute('SELECT started_at, finished_at, nb_replies FROM jobs WHERE status = \'success\' AND served_by IS NULL AND started_at IS NOT NULL AND nb_replies IS NOT NULL ORDER BY finished_at DESC LIMIT 100')
     result = model[1].fetchall()
     if len(result) == 0:
         return None
@@ -133,3 +442,127 @@ def calculate_average_eta(model):
                 duration = 1
             times.append(line['nb_replies']/duration)
         return statistics.median(times)
+
+
+def calculate_average_render_rate(model):
+    """
+    Calculates the average number of comments rendered per second, from the latest successful jobs
+    """
+    model[1].execute('SELECT jobs.nb_rendered, phases.duration FROM phases JOIN jobs ON jobs.id=phases.job WHERE phases.phase=\'render\' AND jobs.status=\'success\' AND jobs.nb_rendered > 0 ORDER BY phases.finished_at DESC LIMIT 100')
+    result = model[1].fetchall()
+    if len(result) == 0:
+        return None
+    else:
+        return statistics.median(line['nb_rendered']/max(line['duration'], 0.001) for line in result)
+
+
+def read_snapshot(model, submission):
+    """
+    Returns the information about the last snapshot of a submission, or None if it was never fetched.
+    """
+    model[1].execute('SELECT * FROM snapshots WHERE submission=:submission', {'submission': submission})
+    result = model[1].fetchall()
+    if result:
+        return result[0]
+    else:
+        return None
+
+
+def read_snapshot_comments(model, submission):
+    """
+    Iterates over the stored comments of a submission, parents always coming before their children.
+    """
+    cursor = model[0].cursor()
+    cursor.execute('SELECT id, parent, author, body, distinguished, edited, permalink, is_submitter, score, created_utc FROM comments WHERE submission=:submission ORDER BY position', {'submission': submission})
+    return iter(cursor)
+
+
+def write_snapshot(model, submission, comments, fetched_at, append=False):
+    """
+    Stores the comments of a submission, replacing the previous snapshot (or completing it, if append is True).
+    "comments" is an iterable of (id, parent, author, body, distinguished, edited, permalink, is_submitter, score, created_utc) tuples.
+    fetched_at is the time of the last full retrieval of the submission, refreshed_at the time of the last update of the snapshot.
+    Done in a single transaction, rolled back if anything fails: a snapshot is never left half written.
+    """
+    with model[0]:
+        if append:
+            model[1].execute('SELECT COALESCE(MAX(position), -1)+1 AS next FROM comments WHERE submission=:submission', {'submission': submission})
+            start = model[1].fetchall()[0]['next']
+        else:
+            model[1].execute('DELETE FROM comments WHERE submission=:submission', {'submission': submission})
+            start = 0
+
+        model[1].executemany('INSERT INTO comments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', ((submission, position)+comment for position, comment in enumerate(comments, start)))
+        if append:
+            model[1].execute('UPDATE snapshots SET refreshed_at=:refreshed_at, nb_comments=(SELECT COUNT(*) FROM comments WHERE submission=:submission) WHERE submission=:submission', {'submission': submission, 'refreshed_at': fetched_at})
+        else:
+            model[1].execute('INSERT OR REPLACE INTO snapshots VALUES (:submission, :fetched_at, :fetched_at, (SELECT COUNT(*) FROM comments WHERE submission=:submission))', {'submission': submission, 'fetched_at': fetched_at})
+
+
+def store_file(model, filename, size, temporary_path=None):
+    """
+    Adds a file written in the output directory to the index of files (or marks it as used, if the same content was already there).
+    If temporary_path is given, the file is first moved from there to its name. Both are done under the write lock of the database,
+    like evictions (see evict_files): a file written again is never deleted by an eviction that chose it just before.
+    """
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    model[0].commit()
+    model[1].execute('BEGIN IMMEDIATE')
+    try:
+        if temporary_path is not None:
+            os.replace(temporary_path, os.path.join(os.path.dirname(temporary_path), filename))
+        model[1].execute('INSERT INTO files (filename, size, created_at, last_used_at) VALUES (:filename, :size, :now, :now) ON CONFLICT(filename) DO UPDATE SET last_used_at=:now', {'filename': filename, 'size': size, 'now': now})
+        model[0].commit()
+    except BaseException:
+        model[0].rollback()
+        raise
+
+
+def touch_file(model, filename):
+    """
+    Marks a file of the output directory as used (when it is downloaded), so that it is evicted after the ones used less recently
+    """
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    model[1].execute('UPDATE files SET last_used_at=:now WHERE filename=:filename', {'filename': filename, 'now': now})
+    model[0].commit()
+
+
+def evict_files(model, directory, quota, max_age):
+    """
+    Removes the files unused for max_age seconds, then the least recently used ones until all the others fit in quota (in bytes),
+    from the index and from directory. The file used last is always kept. 0 disables either limit.
+    Files are deleted under the same write lock as they are removed from the index (see store_file). Returns their names.
+    """
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    evicted = []
+    model[0].commit()
+    model[1].execute('BEGIN IMMEDIATE')
+    try:
+        if max_age > 0:
+            model[1].execute('DELETE FROM files WHERE last_used_at < :limit RETURNING filename', {'limit': now-max_age})
+            evicted.extend(row['filename'] for row in model[1].fetchall())
+        if quota > 0:
+            # Files are kept from the most recently used, as long as their total size fits
+            model[1].execute('DELETE FROM files WHERE filename IN (SELECT filename FROM (SELECT filename, size, SUM(size) OVER (ORDER BY last_used_at DESC, created_at DESC, filename) AS total FROM files) WHERE total > :quota AND total > size) RETURNING filename', {'quota': quota})
+            evicted.extend(row['filename'] for row in model[1].fetchall())
+        for filename in evicted:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+        model[0].commit()
+    except BaseException:
+        model[0].rollback()
+        raise
+    return evicted
+
+
+def cleanup_snapshots(model, max_age):
+    """
+    Remove all snapshots older than max_age (in seconds). Returns the number of snapshots removed.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    with model[0]:
+        model[1].execute('DELETE FROM comments WHERE submission IN (SELECT submission FROM snapshots WHERE fetched_at < :limit)', {'limit': now-max_age})
+        model[1].execute('DELETE FROM snapshots WHERE fetched_at < :limit', {'limit': now-max_age})
+    return model[1].rowcount
@@ -0,0 +1,157 @@
+# stdlib
+import json, mmap, os, struct, tempfile, types, zlib
+
+# msgpack and zstd make the stored data smaller and faster to read, but are optional:
+# without them, comments are stored as JSON, compressed with zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Raw data of the downloaded submissions (see app.raw-data), one file per submission, from which they can be generated
+# again without Reddit (see replay.py)
+RAW_DIRECTORY = "data/raw"
+RAW_SUFFIX = '.raw'
+
+# Layout of the files:
+#   MAGIC, length of the header (4 bytes), header (JSON: submission, time of the download, encoding of the frames)
+#   frames: blocks of FRAME_SIZE comments, encoded then compressed one by one, so that they can be read one at a time
+#   index of the frames (JSON: offset, length and number of comments of each), position of the index (8 bytes), MAGIC
+MAGIC = b'RARAW\x00\x01\x00'
+FRAME_SIZE = 2000
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Attributes of the submission needed to generate its files
+SUBMISSION_FIELDS = ('id', 'title', 'permalink', 'num_comments', 'score', 'upvote_ratio', 'link_flair_text', 'stickied', 'spoiler', 'over_18', 'is_original_content', 'locked', 'created_utc', 'selftext')
+
+
+def path(submission_id):
+    return os.path.join(RAW_DIRECTORY, submission_id+RAW_SUFFIX)
+
+
+def submission_data(submission):
+    """
+    Extracts the attributes of a submission (a PRAW object) that are stored with its comments
+    """
+    data = {field: getattr(submission, field) for field in SUBMISSION_FIELDS}
+    data['subreddit'] = submission.subreddit.display_name
+    data['author'] = None if submission.author is None else submission.author.name
+    return data
+
+
+def submission_object(data):
+    """
+    Rebuilds from stored attributes an object that can stand for the PRAW submission when files are generated
+    """
+    submission = types.SimpleNamespace(**data)
+    submission.subreddit = types.SimpleNamespace(display_name=data['subreddit'])
+    submission.author = None if data['author'] is None else types.SimpleNamespace(name=data['author'])
+    return submission
+
+
+def encode(rows, encoding):
+    data = msgpack.packb(rows, use_bin_type=True) if encoding['codec'] == 'msgpack' else json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if encoding['compression'] == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decode(frame, encoding):
+    if encoding['compression'] == 'zstd':
+        data = zstandard.ZstdDecompressor().decompress(frame)
+    else:
+        data = zlib.decompress(frame)
+    return msgpack.unpackb(data, raw=False) if encoding['codec'] == 'msgpack' else json.loads(data)
+
+
+def write(submission, rows, fetched_at, destination):
+    """
+    Stores the raw data of a submission in the file destination: submission is given as returned by submission_data,
+    rows as returned by downloader.snapshot_rows (one tuple by comment, parents before their children).
+    The file is written frame by frame, and replaces the previous one only once it is complete.
+    """
+    encoding = {'codec': 'json' if msgpack is None else 'msgpack', 'compression': 'zlib' if zstandard is None else 'zstd'}
+    header = json.dumps({'submission': submission, 'fetched_at': fetched_at, 'encoding': encoding}, ensure_ascii=False).encode('utf-8')
+
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(destination) or '.', prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(MAGIC+struct.pack('<I', len(header))+header)
+            frames = []
+            batch = []
+
+            def flush():
+                frame = encode(batch, encoding)
+                frames.append((f.tell(), len(frame), len(batch)))
+                f.write(frame)
+
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= FRAME_SIZE:
+                    flush()
+                    batch = []
+            if batch:
+                flush()
+
+            index_position = f.tell()
+            f.write(json.dumps(frames).encode('utf-8')+struct.pack('<Q', index_position)+MAGIC)
+        os.replace(temporary_path, destination)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+class RawSnapshot:
+    """
+    Stored raw data of a submission, read through a memory map: frames are decompressed one at a time, when they are read,
+    and the file itself is never loaded in memory as a whole. To be used as a context manager.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self._file.close()
+            raise
+
+        size = len(self._map)
+        if size < 2*len(MAGIC)+12 or self._map[:len(MAGIC)] != MAGIC or self._map[size-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a complete raw data file')
+
+        header_length = struct.unpack_from('<I', self._map, len(MAGIC))[0]
+        header = json.loads(self._map[len(MAGIC)+4:len(MAGIC)+4+header_length])
+        index_position = struct.unpack_from('<Q', self._map, size-len(MAGIC)-8)[0]
+        self.frames = json.loads(self._map[index_position:size-len(MAGIC)-8])
+        self.submission = header['submission']
+        self.fetched_at = header['fetched_at']
+        self.encoding = header['encoding']
+        self.nb_comments = sum(count for offset, length, count in self.frames)
+
+
+    def rows(self):
+        """
+        Yields the stored comments, as tuples in the order of downloader.snapshot_rows
+        """
+        for offset, length, count in self.frames:
+            for row in decode(self._map[offset:offset+length], self.encoding):
+                yield tuple(row)
+
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,86 @@
+# Project modules
+import downloader, models, rawstore, utils
+from config import config, setup_logging
+from formatting import RenderCache
+
+# stdlib
+import argparse, collections, concurrent.futures, datetime, logging, os, sys
+
+log = logging.getLogger('redditarchiver_main')
+
+
+def read_submissions(arguments, everything):
+    """
+    Returns the IDs of the submissions to generate again: the ones given (URLs or IDs), or all those with stored raw data
+    """
+    if everything:
+        if not os.path.isdir(rawstore.RAW_DIRECTORY):
+            return []
+        return sorted(name[:-len(rawstore.RAW_SUFFIX)] for name in os.listdir(rawstore.RAW_DIRECTORY) if name.endswith(rawstore.RAW_SUFFIX))
+    return [utils.extract_id(submission) or submission for submission in arguments]
+
+
+def setup_worker():
+    """
+    Runs once in each worker process: bodies are rendered in the worker itself (the workers are already as many as the processors),
+    and the cache of rendered bodies is opened again, as its database connection cannot be shared between processes
+    """
+    setup_logging()
+    config['app']['render-processes'] = 0
+    if downloader.render_cache is not None:
+        downloader.render_cache = RenderCache(config['app'].get('render-cache-size', 10000), "data/render-cache.sqlite3" if config['app'].get('render-cache-persistent', False) else None)
+
+
+def render(submission_id, output_format):
+    """
+    Writes the file of a submission from its stored raw data alone, as it was when it was downloaded.
+    Returns the name of the file, and the name under which it is downloaded.
+    """
+    submission, comments_index, comments_forest, fetched_at = downloader.load_raw(submission_id)
+    fetched = datetime.datetime.fromtimestamp(fetched_at, datetime.timezone.utc)
+
+    render_stats = collections.Counter()
+    generate, extension, _ = downloader.EXPORTERS[downloader.resolve_format(output_format, len(comments_index)-1)]
+    content = generate(submission, submission_id, fetched.strftime(config["defaults"]["dateformat"]), None, comments_index, comments_forest, stats=render_stats)
+    # Files written by replay are indexed like the others, so that app.output-quota applies to them
+    filename = downloader.write_file(content, config['paths']['output'], stats=render_stats, compression=downloader.output_compression, extension=extension, db=models.connect())
+    log.info(f'Submission ID: {submission_id}: generated again from raw data ({filename})')
+    return filename, downloader.output_name(submission, fetched, extension)
+
+
+def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description=f"Generates files (in {config['paths']['output']}) again from the raw data of the submissions stored when they were downloaded (see app.raw-data), without Reddit. Run it from the directory of the app, where its config file is.")
+    parser.add_argument('submissions', nargs='*', help='URLs or IDs of the submissions to generate again')
+    parser.add_argument('-a', '--all', action='store_true', help=f'generate again all the submissions with raw data (in {rawstore.RAW_DIRECTORY})')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='number of submissions generated at the same time, each in its own process (defaults to the number of processors)')
+    parser.add_argument('-o', '--format', choices=downloader.OUTPUT_FORMATS, help='format of the files (defaults to app.output-format)')
+    args = parser.parse_args()
+
+    submissions = read_submissions(args.submissions, args.all)
+    if not submissions:
+        parser.error('no submission given')
+
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(args.workers, 1), initializer=setup_worker) as executor:
+        futures = [executor.submit(render, submission_id, args.format) for submission_id in submissions]
+        for submission_id, future in zip(submissions, futures):
+            try:
+                filename, download_name = future.result()
+            except FileNotFoundError:
+                failures += 1
+                print(f'{submission_id}\tfailure\tNO_RAW_DATA')
+                continue
+            except Exception as e:
+                log.error(f'Submission ID: {submission_id}: could not be generated again ({e})', exc_info=True)
+                failures += 1
+                print(f'{submission_id}\tfailure\tUNKNOWN')
+                continue
+            print(f'{submission_id}\tsuccess\t{filename}\t{download_name}')
+
+    print(f'{len(submissions)-failures} of {len(submissions)} submissions generated', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
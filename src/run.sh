@@ -1,3 +1,3 @@
 #!/bin/bash
 source env/bin/activate
-env/bin/gunicorn --bind unix:run/gunicorn.sock --workers 1 wsgi:app
+env/bin/gunicorn --bind unix:run/gunicorn.sock --workers 1 --threads 16 wsgi:app
@@ -0,0 +1,174 @@
+# Project modules
+from config import config
+
+# stdlib
+import sqlite3, datetime, threading, logging, re, html, hashlib
+
+log = logging.getLogger('redditarchiver_main')
+
+# Full-text index of the archived comments (see app.search-index). It is kept apart from the main database,
+# as it only grows: comments stay in it after their submission has been evicted from the output directory.
+DATABASE = "data/search.sqlite3"
+
+# Results by page of /search
+PAGE_SIZE = 25
+# Longest query accepted (in characters)
+QUERY_MAX_LENGTH = 200
+
+# Around the words found in the extracts of the comments, before they are escaped (see highlight)
+MARK = ('\x02', '\x03')
+
+# Bodies of comments deleted since they were archived: the archived body is kept instead
+DELETED = ('[deleted]', '[removed]', '(deleted)')
+
+# Each thread keeps its own connection (sqlite3 connections cannot be shared between threads)
+_local = threading.local()
+_created = False
+_creation_lock = threading.Lock()
+
+
+def connect():
+    """
+    Connects to the index. Each thread gets its own connection, opened on first use and reused afterwards.
+    Returns a tuple with base and cursor, like models.connect
+    """
+    model = getattr(_local, 'model', None)
+    if model is None:
+        base = sqlite3.connect(DATABASE, timeout=30, cached_statements=64)
+        base.row_factory = sqlite3.Row
+        # WAL lets searches run while a job is indexing its comments
+        base.execute('PRAGMA journal_mode=WAL')
+        base.execute('PRAGMA synchronous=NORMAL')
+        model = (base, base.cursor())
+        create(model)
+        _local.model = model
+    return model
+
+
+def create(model):
+    """
+    Creates the tables of the index (once per process).
+    Comments are stored in "comments", and their author and body indexed in "comments_fts", which is kept up to date by triggers:
+    a comment inserted, updated or deleted is indexed again, and only that comment. "readers" holds who may find them (see allow).
+    """
+    global _created
+    with _creation_lock:
+        if _created:
+            return
+        cursor = model[1]
+        cursor.execute('CREATE TABLE IF NOT EXISTS "submissions" ("id" TEXT, "subreddit" TEXT, "title" TEXT, "author" TEXT, "permalink" TEXT, "created_utc" REAL, "indexed_at" INTEGER, PRIMARY KEY("id"))')
+        cursor.execute('CREATE TABLE IF NOT EXISTS "comments" ("rowid" INTEGER PRIMARY KEY, "id" TEXT UNIQUE, "submission" TEXT, "parent_id" TEXT, "author" TEXT, "body" TEXT, "score" INTEGER, "created_utc" REAL, "permalink" TEXT, "indexed_at" INTEGER)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS "comments_submission" ON "comments" ("submission")')
+        # Submissions each token could read (by hash of the token): searches only look into them (see allow)
+        cursor.execute('CREATE TABLE IF NOT EXISTS "readers" ("token" TEXT, "submission" TEXT, "allowed_at" INTEGER, PRIMARY KEY("token", "submission")) WITHOUT ROWID')
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "comments_fts" USING fts5("author", "body", content="comments", content_rowid="rowid", tokenize="unicode61 remove_diacritics 2")')
+        # Triggers of indexes created before they used single-quoted string literals (rejected by builds of SQLite without double-quoted ones)
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT name FROM sqlite_master WHERE type = \'trigger\' AND tbl_name = \'comments\' AND sql LIKE \'%"delete"%\'')
+        for (name,) in cursor.fetchall():
+            cursor.execute(f'DROP TRIGGER "{name}"')
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS "comments_ai" AFTER INSERT ON "comments" BEGIN INSERT INTO comments_fts (rowid, author, body) VALUES (new.rowid, new.author, new.body); END')
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS "comments_ad" AFTER DELETE ON "comments" BEGIN INSERT INTO comments_fts (comments_fts, rowid, author, body) VALUES (\'delete\', old.rowid, old.author, old.body); END')
+        cursor.execute('CREATE TRIGGER IF NOT EXISTS "comments_au" AFTER UPDATE OF "author", "body" ON "comments" WHEN old.author IS NOT new.author OR old.body IS NOT new.body BEGIN INSERT INTO comments_fts (comments_fts, rowid, author, body) VALUES (\'delete\', old.rowid, old.author, old.body); INSERT INTO comments_fts (rowid, author, body) VALUES (new.rowid, new.author, new.body); END')
+        model[0].commit()
+        _created = True
+
+
+def index_comments(submission, submission_id, comments_index, comments_forest, start=1):
+    """
+    Adds the comments of a submission (from the node "start" of the tree) to the index. Comments already in it are updated
+    if they changed (their score, mostly): only them are indexed again. Returns the number of comments added or updated.
+    """
+    db = connect()
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    deleted = ', '.join(f"'{body}'" for body in DELETED)
+
+    def rows():
+        names, parents = comments_index.names, comments_index.parent
+        for node in range(start, len(comments_index)):
+            comment = comments_forest[node]
+            yield {'id': names[node], 'submission': 't3_'+submission_id, 'parent_id': names[parents[node]], 'author': comment.author, 'body': comment.body, 'score': comment.score, 'created_utc': comment.created_utc, 'permalink': comment.permalink, 'now': now}
+
+    with db[0]:
+        db[1].execute('INSERT INTO submissions VALUES (:id, :subreddit, :title, :author, :permalink, :created_utc, :now) ON CONFLICT(id) DO UPDATE SET title=excluded.title, indexed_at=excluded.indexed_at', {'id': 't3_'+submission_id, 'subreddit': submission.subreddit.display_name, 'title': submission.title, 'author': '(deleted)' if submission.author is None else submission.author.name, 'permalink': submission.permalink, 'created_utc': submission.created_utc, 'now': now})
+
+        # Rows are written as they are generated, in a single transaction. What was archived is kept if the comment has been deleted since.
+        db[1].executemany(f'''INSERT INTO comments (id, submission, parent_id, author, body, score, created_utc, permalink, indexed_at) VALUES (:id, :submission, :parent_id, :author, :body, :score, :created_utc, :permalink, :now)
+            ON CONFLICT(id) DO UPDATE SET score=excluded.score, indexed_at=excluded.indexed_at,
+                author=CASE WHEN excluded.author = '(deleted)' THEN author ELSE excluded.author END,
+                body=CASE WHEN excluded.body IN ({deleted}) THEN body ELSE excluded.body END
+            WHERE score IS NOT excluded.score OR (excluded.author != '(deleted)' AND author IS NOT excluded.author) OR (excluded.body NOT IN ({deleted}) AND body IS NOT excluded.body)''', rows())
+        written = db[1].rowcount
+    return written
+
+
+def reader(token):
+    """
+    Returns what identifies a token in the index: its hash, so that the index holds no token that could be used to read Reddit
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def allow(submission_id, token):
+    """
+    Records that a token could read a submission: its comments are then found by the searches made with this token.
+    A submission archived with another token is not found until this one requests it, as it may not be able to read it (private subreddit...).
+    """
+    db = connect()
+    now = int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    with db[0]:
+        db[1].execute('INSERT INTO readers VALUES (:token, :submission, :now) ON CONFLICT(token, submission) DO UPDATE SET allowed_at=excluded.allowed_at', {'token': reader(token), 'submission': 't3_'+submission_id, 'now': now})
+
+
+def match_expression(query):
+    """
+    Turns a query typed by a user into an FTS5 expression: each word must be found (words ending with * are prefixes).
+    Quotes group words into a phrase. Returns None if there is nothing to look for.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        text = phrase if phrase else word.rstrip('*')
+        if not text.strip():
+            continue
+        terms.append('"'+text.replace('"', '""')+'"'+('*' if word.endswith('*') and not phrase else ''))
+    return ' '.join(terms) if terms else None
+
+
+def highlight(snippet):
+    """
+    Escapes an extract of a comment for HTML, and puts the words found in <mark> elements
+    """
+    return html.escape(snippet, quote=False).replace(MARK[0], '<mark>').replace(MARK[1], '</mark>')
+
+
+def search(query, token, sort='relevance', page=1, before=None, submission=None):
+    """
+    Looks for comments in all the archived submissions the token could read (see allow), or only in one of them. Returns a page of results, and what gives the next one
+    (None if this one is the last):
+    - sorted by relevance, pages are numbered (page);
+    - sorted by "recent" (most recently archived first), the next page starts before the last comment of this one (before).
+      This is the fastest on large indexes, as the index is read in the order of the results, only as far as the page goes.
+    """
+    expression = match_expression(query)
+    if expression is None:
+        return [], None
+
+    db = connect()
+    parameters = {'mark_start': MARK[0], 'mark_end': MARK[1], 'ellipsis': '…', 'expression': expression, 'token': reader(token), 'submission': submission, 'before': before, 'limit': PAGE_SIZE+1, 'offset': (page-1)*PAGE_SIZE}
+    if sort == 'recent':
+        order, offset = 'comments_fts.rowid DESC', ''
+    else:
+        order, offset = 'comments_fts.rank', 'OFFSET :offset'
+        parameters['before'] = None
+
+    db[1].execute(f'SELECT comments.rowid, comments.id, comments.submission, comments.author, comments.score, comments.created_utc, comments.permalink, snippet(comments_fts, 1, :mark_start, :mark_end, :ellipsis, 24) AS snippet, submissions.title, submissions.subreddit FROM comments_fts JOIN comments ON comments.rowid = comments_fts.rowid LEFT JOIN submissions ON submissions.id = comments.submission WHERE comments_fts MATCH :expression AND comments.submission IN (SELECT submission FROM readers WHERE token = :token) AND (:submission IS NULL OR comments.submission = :submission) AND (:before IS NULL OR comments_fts.rowid < :before) ORDER BY {order} LIMIT :limit {offset}', parameters)
+    rows = db[1].fetchall()
+
+    results = [{'id': row['id'], 'submission': row['submission'], 'title': row['title'], 'subreddit': row['subreddit'], 'author': row['author'], 'score': row['score'], 'created_utc': row['created_utc'], 'url': config['reddit']['root']+row['permalink'], 'snippet': highlight(row['snippet'])} for row in rows[:PAGE_SIZE]]
+    if len(rows) <= PAGE_SIZE:
+        following = None
+    elif sort == 'recent':
+        following = {'before': rows[PAGE_SIZE-1]['rowid']}
+    else:
+        following = {'page': page+1}
+    return results, following
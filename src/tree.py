@@ -0,0 +1,109 @@
+# stdlib
+from array import array
+
+
+# Marker for "no node" in the link arrays
+NONE = -1
+
+
+class CommentRecord:
+    """
+    Attributes of a comment that are kept once it has been fetched from Reddit.
+    Slotted, as there is one such object per comment in the submission.
+    """
+    __slots__ = ('author', 'body', 'distinguished', 'edited', 'permalink', 'is_submitter', 'score', 'created_utc')
+
+    def __init__(self, author, body, distinguished, edited, permalink, is_submitter, score, created_utc):
+        self.author = author
+        self.body = body
+        self.distinguished = distinguished
+        self.edited = edited
+        self.permalink = permalink
+        self.is_submitter = is_submitter
+        self.score = score
+        self.created_utc = created_utc
+
+
+class CommentTree:
+    """
+    Compact tree structure of a submission and its replies.
+
+    Nodes are identified by their index (the submission itself being the root, at index 0).
+    The structure is held in parallel arrays (parent, first child, next/previous sibling, depth),
+    so that walking the tree never recurses and getting the siblings of a node is O(1).
+    """
+    __slots__ = ('names', 'parent', 'first_child', 'last_child', 'next_sibling', 'previous_sibling', 'depth', '_indexes')
+
+    def __init__(self, root_name):
+        self.names = [root_name]
+        self.parent = array('l', [NONE])
+        self.first_child = array('l', [NONE])
+        self.last_child = array('l', [NONE])
+        self.next_sibling = array('l', [NONE])
+        self.previous_sibling = array('l', [NONE])
+        self.depth = array('l', [0])
+        self._indexes = {root_name: 0}
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def __contains__(self, name):
+        return name in self._indexes
+
+
+    def index(self, name):
+        """
+        Returns the index of a node from its name (fullname of the comment, such as "t1_abcdef")
+        """
+        return self._indexes[name]
+
+
+    def add(self, name, parent_name):
+        """
+        Adds a node as the last child of its parent. The parent has to be added first.
+        Returns the index of the new node.
+        """
+        parent = self._indexes[parent_name]
+        node = len(self.names)
+
+        self.names.append(name)
+        self.parent.append(parent)
+        self.first_child.append(NONE)
+        self.last_child.append(NONE)
+        self.next_sibling.append(NONE)
+        self.depth.append(self.depth[parent]+1)
+        self._indexes[name] = node
+
+        # Linking the node after the last child of its parent
+        previous = self.last_child[parent]
+        self.previous_sibling.append(previous)
+        if previous == NONE:
+            self.first_child[parent] = node
+        else:
+            self.next_sibling[previous] = node
+        self.last_child[parent] = node
+
+        return node
+
+
+    def walk(self, start=0):
+        """
+        Iterates over the descendants of a node (the whole tree by default) in pre-order, without recursion.
+        The starting node itself is not included.
+        """
+        node = self.first_child[start]
+        while node != NONE:
+            yield node
+
+            if self.first_child[node] != NONE:
+                node = self.first_child[node]
+                continue
+
+            # No children: going up until we find a node that has a next sibling
+            while self.next_sibling[node] == NONE:
+                node = self.parent[node]
+                if node == start:
+                    return
+            node = self.next_sibling[node]
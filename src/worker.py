@@ -0,0 +1,33 @@
+# Project modules
+import jobqueue, metrics
+from config import config, setup_logging
+
+# stdlib
+import argparse, logging, signal, sys, threading
+
+log = logging.getLogger('redditarchiver_main')
+
+# Workers of this process are not notified when a job is queued by the web app: they look at the queue this often (in seconds)
+POLL_INTERVAL = 1
+
+
+def main():
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Downloads the submissions requested on the web app, in a process of its own (see app.standalone-workers). Run it from the directory of the app, where its config file is. Several of them can run at the same time.")
+    parser.add_argument('-w', '--workers', type=int, default=config['app'].get('job-workers', 2), help='number of submissions downloaded at the same time (defaults to app.job-workers)')
+    args = parser.parse_args()
+
+    # Stopping cleanly (see jobqueue.release) when asked to by systemd or Docker
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    jobqueue.start(max(args.workers, 1), poll_interval=POLL_INTERVAL)
+    # Metrics of this process are added to the ones of the web app (see metrics.gather)
+    metrics.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()